@@ -0,0 +1 @@
+default_app_config = 'visitorManagement.mapi.apps.MapiConfig'
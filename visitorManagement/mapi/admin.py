@@ -1,5 +1,5 @@
 from django.contrib.gis import admin
-from visitorManagement.mapi.models import Member, Visitor, WorkBookType, WorkBook
+from visitorManagement.mapi.models import Member, Visitor, WorkBookType, WorkBook, VisitorArchive, VisitorImport
 from visitorManagement.mapi.form import WorkBookTypeAdminForm
 
 
@@ -63,7 +63,27 @@ class WorkBookAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return False
 
+class VisitorArchiveAdmin(admin.ModelAdmin):
+    list_display = ('path', 'member', 'month', 'rows', 'created')
+    list_filter = ('month',)
+
+    def get_actions(self, request):
+        actions = super(VisitorArchiveAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            del actions['delete_selected']
+        return actions
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class VisitorImportAdmin(admin.ModelAdmin):
+    list_display = ('source', 'workbook', 'status', 'rows_done', 'inserted', 'rejected', 'updated')
+    list_filter = ('status',)
+    readonly_fields = ('checksum', 'rows_done', 'inserted', 'rejected', 'errors', 'seconds')
+
 admin.site.register(Member, MemberAdmin)
 admin.site.register(Visitor, VisitorAdmin)
 admin.site.register(WorkBookType, WorkBookTypeAdmin)
 admin.site.register(WorkBook, WorkBookAdmin)
+admin.site.register(VisitorArchive, VisitorArchiveAdmin)
+admin.site.register(VisitorImport, VisitorImportAdmin)
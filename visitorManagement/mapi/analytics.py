@@ -0,0 +1,89 @@
+"""
+Visit counts for the analytics endpoint, read from the VisitCounter rollups
+instead of the Visitor table.
+
+Visitor.save and VisitorManager.bulk_insert add every new visit to the counter
+of its workbook, day and hour of in_time, in the transaction that inserts it. A
+range aggregate reads at most 24 counter rows per workbook and day, however
+many visits there are. Counters are not moved when the in_time of an existing
+visit is edited (admin only); `python manage.py backfill_visit_counters`
+recounts a range of days from the Visitor table and the archive.
+"""
+import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, Min
+from django.utils import timezone
+
+from visitorManagement.mapi.archive import month_start, read_rows
+from visitorManagement.mapi.models import Visitor, VisitorArchive, VisitCounter
+
+GROUPS = ('day', 'week', 'hour')
+
+
+def day_start(day):
+    value = datetime.datetime.combine(day, datetime.time.min)
+    return timezone.make_aware(value) if settings.USE_TZ else value
+
+
+def series_keys(start, end, group):
+    if group == 'hour':
+        return range(24)
+    if group == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    step = datetime.timedelta(days=7 if group == 'week' else 1)
+    keys = []
+    while start <= end:
+        keys.append(start)
+        start += step
+    return keys
+
+
+def visit_counts(workbook_ids, start, end, group='day'):
+    """
+    Visits of the workbooks that came in from day start to day end included, as
+    {workbook id: [(key, visits)]} with a key per day, per week (its Monday) or per hour
+    of the day, zero filled
+    """
+    counters = VisitCounter.objects.filter(workbook_id__in=workbook_ids, day__gte=start, day__lte=end).order_by()
+    counts = dict((workbook_id, Counter()) for workbook_id in workbook_ids)
+    for workbook_id, key, visits in (counters.values_list('workbook_id', 'hour' if group == 'hour' else 'day')
+                                     .annotate(total=Sum('visits'))):
+        if group == 'week':
+            key -= datetime.timedelta(days=key.weekday())
+        counts[workbook_id][key] += visits
+    keys = series_keys(start, end, group)
+    return dict((workbook_id, [(key, workbook_counts[key]) for key in keys])
+                for workbook_id, workbook_counts in counts.items())
+
+
+def first_visit_day():
+    first_in_time = Visitor.object.aggregate(first=Min('in_time'))['first']
+    first_archive = VisitorArchive.objects.aggregate(first=Min('month'))['first']
+    days = [day for day in (first_in_time and first_in_time.date(), first_archive) if day is not None]
+    return min(days) if days else None
+
+
+def backfill(start, end):
+    """
+    Recounts the VisitCounters of the days start to end included, from the Visitor
+    table and the archive. Returns the number of visits counted.
+    """
+    start_time, end_time = day_start(start), day_start(end + datetime.timedelta(days=1))
+    buckets = Counter()
+    visitors = Visitor.object.filter(in_time__gte=start_time, in_time__lt=end_time).order_by()
+    for workbook_id, in_time in visitors.values_list('workbook_id', 'in_time').iterator():
+        buckets[VisitCounter.bucket(workbook_id, in_time)] += 1
+    for archive in VisitorArchive.objects.filter(month__gte=month_start(start), month__lte=month_start(end)):
+        for row in read_rows(archive.path):
+            if row['in_time'] is not None and start_time <= row['in_time'] < end_time:
+                buckets[VisitCounter.bucket(row['workbook_id'], row['in_time'])] += 1
+
+    with transaction.atomic():
+        VisitCounter.objects.filter(day__gte=start, day__lte=end).delete()
+        VisitCounter.objects.bulk_create([VisitCounter(workbook_id=workbook_id, day=day, hour=hour, visits=visits)
+                                          for (workbook_id, day, hour), visits in sorted(buckets.items())],
+                                         batch_size=500)
+    return sum(buckets.values())
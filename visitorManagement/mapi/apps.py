@@ -0,0 +1,16 @@
+from importlib import import_module
+
+from django.apps import AppConfig
+
+# imported for the signal receivers they declare
+RECEIVER_MODULES = ('db', 'push', 'request_handler', 'response_cache', 'search', 'sync')
+
+
+class MapiConfig(AppConfig):
+    name = 'visitorManagement.mapi'
+
+    def ready(self):
+        for module_name in RECEIVER_MODULES:
+            import_module('%s.%s' % (self.name, module_name))
+        from visitorManagement.mapi import schema
+        schema.load()
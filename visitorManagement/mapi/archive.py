@@ -0,0 +1,138 @@
+"""
+Cold storage for visits older than MAPI_ARCHIVE_AFTER_DAYS.
+
+`python manage.py archive_visitors` moves closed visits whose in_time is before
+the start of the month the horizon falls in out of the Visitor table, into gzip
+JSON lines files under MAPI_ARCHIVE_ROOT, one set per member and month:
+
+    <MAPI_ARCHIVE_ROOT>/<yyyy-mm>/member-<member id>-<first visitor id>.jsonl.gz
+
+Each file is a Visitor values() row per line and has a VisitorArchive catalog
+row, written in the transaction that deletes the visits, so a file without a
+catalog row (an archive run that failed) is never read. The Visitor table, and
+with it SearchView and get_all_active_visitor, stays bounded to the horizon;
+SearchView reads the archive only when its in_time asks for archived months.
+"""
+import datetime
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from visitorManagement.mapi.models import Visitor, VisitorArchive
+from visitorManagement.mapi.search import normalize_term, similarity, fuzzy_threshold, SEARCH_FIELDS
+from visitorManagement.mapi.serializers import dumps
+from visitorManagement.mapi.sync import skip_closed_tombstones
+
+DATETIME_FIELDS = frozenset(field.attname for field in Visitor._meta.concrete_fields
+                            if field.get_internal_type() == 'DateTimeField')
+
+
+def archive_root():
+    return getattr(settings, 'MAPI_ARCHIVE_ROOT', os.path.join(settings.BASE_DIR, 'archive'))
+
+
+def month_start(value):
+    return datetime.date(value.year, value.month, 1)
+
+
+def archive_cutoff(now=None):
+    """
+    Visits that came in before this are archived. Whole months are archived
+    at once so a month lives either in the hot table or in the archive.
+    """
+    horizon = (now or timezone.now()) - datetime.timedelta(days=getattr(settings, 'MAPI_ARCHIVE_AFTER_DAYS', 180))
+    cutoff = datetime.datetime(horizon.year, horizon.month, 1)
+    return timezone.make_aware(cutoff) if settings.USE_TZ else cutoff
+
+
+def write_rows(path, rows):
+    full_path = os.path.join(archive_root(), path)
+    directory = os.path.dirname(full_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with gzip.open(full_path + '.tmp', 'wb') as archive_file:
+        for row in rows:
+            archive_file.write(dumps(row))
+            archive_file.write(b'\n')
+    os.rename(full_path + '.tmp', full_path)
+
+
+def read_rows(path):
+    with gzip.open(os.path.join(archive_root(), path), 'rb') as archive_file:
+        for line in archive_file:
+            row = json.loads(line)
+            for field_name in DATETIME_FIELDS:
+                if row[field_name] is not None:
+                    row[field_name] = parse_datetime(row[field_name])
+            yield row
+
+
+def archive_visitors(now=None, batch_size=1000):
+    """
+    Moves the closed visits older than archive_cutoff(now) to the archive,
+    batch_size visits per transaction. Returns the number of visits moved.
+    """
+    visitors = Visitor.object.filter(status=Visitor.CLOSED, in_time__lt=archive_cutoff(now))
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(visitors.select_for_update().order_by('member', 'in_time', 'id').values()[:batch_size])
+            if not rows:
+                return archived
+            partitions = {}
+            for row in rows:
+                partitions.setdefault((row['member_id'], month_start(row['in_time'])), []).append(row)
+            for (member_id, month), partition_rows in sorted(partitions.items()):
+                path = '%s/member-%s-%s.jsonl.gz' % (month.strftime('%Y-%m'), member_id, partition_rows[0]['id'])
+                write_rows(path, partition_rows)
+                VisitorArchive.objects.create(member_id=member_id, month=month, path=path, rows=len(partition_rows))
+            # deleted through the ORM so the search index drops them too, sync clients don't hold closed visits
+            with skip_closed_tombstones():
+                Visitor.object.filter(id__in=[row['id'] for row in rows]).delete()
+        archived += len(rows)
+
+
+def make_comparable(value):
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+
+def search_archive(member, terms, fuzzy=False, in_time=None, out_time=None, **exact):
+    """
+    Archived visits of member matching what SearchView asks of the hot table:
+    terms (SEARCH_FIELDS, substring or fuzzy), exact field values,
+    in_time >= in_time and out_time <= out_time. Only the months from
+    in_time's onwards are read, no in_time reads none of them.
+    """
+    if in_time is None:
+        return []
+    in_time, out_time = make_comparable(in_time), make_comparable(out_time)
+    archives = VisitorArchive.objects.filter(member=member, month__gte=month_start(in_time))
+    if out_time is not None:
+        archives = archives.filter(month__lte=month_start(out_time))
+
+    terms = dict((field_name, normalize_term(field_name, terms.get(field_name))) for field_name in SEARCH_FIELDS)
+    terms = dict((field_name, term) for field_name, term in terms.items() if term)
+    threshold = fuzzy_threshold()
+
+    def matches(row):
+        if row['in_time'] is None or row['in_time'] < in_time:
+            return False
+        if out_time is not None and (row['out_time'] is None or row['out_time'] > out_time):
+            return False
+        for field_name, value in exact.items():
+            if row[field_name] != value:
+                return False
+        for field_name, term in terms.items():
+            value = normalize_term(field_name, row[field_name])
+            if not (similarity(term, value) >= threshold if fuzzy else term in value):
+                return False
+        return True
+
+    return [row for archive in archives.order_by('month', 'id') for row in read_rows(archive.path) if matches(row)]
@@ -0,0 +1,467 @@
+"""
+Micro benchmarks for the mapi hot paths, run them with
+
+    python manage.py benchmark <name> [--rows N]
+"""
+import datetime
+import time
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+def legacy_format_visitor_data(visitors, needed_fields):
+    """
+    format_visitor_data before it was precompiled, kept as the benchmark baseline
+    """
+    from copy import deepcopy
+    from visitorManagement.mapi.utils import get_base_image_url
+    rect_dict = []
+    for visitor in visitors:
+        d = dict()
+        temp_needed_fields = deepcopy(needed_fields)
+        while temp_needed_fields:
+            field_name = temp_needed_fields.pop()
+            field_value = visitor[field_name]
+            if isinstance(field_value, datetime.datetime):
+                field_value = field_value.strftime('%I:%M %p')
+
+            if field_name in ['photo', 'signature'] and field_value:
+                field_value = '%s%s' % (get_base_image_url(), field_value)
+
+            d.update({str(field_name): field_value})
+        if d:
+            rect_dict.append(d)
+    return rect_dict
+
+
+def make_visitor_rows(rows):
+    """
+    Visitor values() rows as returned by get_all_active_visitor
+    """
+    now = datetime.datetime.now()
+    return [{'id': i, 'name': u'Visitor %s' % i, 'mobile_no': u'98%08d' % i, 'vehicle_no': u'KA01AB%04d' % (i % 10000),
+             'from_place': u'Pune', 'destination_place': u'Tower %s' % (i % 20), 'in_time': now,
+             'out_time': now + datetime.timedelta(hours=2), 'photo': u'uploads/member_photos/%s_1.png' % i,
+             'signature': u'uploads/signature_photos/%s_1.png' % i if i % 2 else None,
+             'workbook_id': 1, 'member_id': 1} for i in range(rows)]
+
+
+@benchmark('formatter')
+def bench_formatter(write, rows=100000, **options):
+    from visitorManagement.mapi.models import Visitor
+    from visitorManagement.mapi.utils import format_visitor_data
+
+    visitors = make_visitor_rows(rows)
+    needed_fields = set(Visitor.object.get_all_field_names())
+    legacy, legacy_time = timed(legacy_format_visitor_data, visitors, needed_fields)
+    compiled, compiled_time = timed(format_visitor_data, visitors, needed_fields)
+    write('format_visitor_data on %s rows' % rows)
+    write('  legacy   : %.3fs' % legacy_time)
+    write('  compiled : %.3fs (%.1fx)' % (compiled_time, legacy_time / compiled_time))
+    write('  same rows: %s' % (legacy == compiled))
+
+
+@benchmark('search')
+def bench_search(write, rows=1000000, **options):
+    """
+    LIKE '%name%' on a member's rows against the FTS5 trigram table, on a scratch
+    SQLite database laid out like mapi_visitor so the real tables are untouched
+    """
+    import random
+    import sqlite3
+    from visitorManagement.mapi.search import normalize_term
+
+    members = 50
+    first_names = [u'Ravi', u'Ramesh', u'Suresh', u'Anita', u'Priya', u'Mohan', u'Farhan', u'Lakshmi', u'Joseph']
+    last_names = [u'Kumar', u'Sharma', u'Iyer', u'Patil', u'Khan', u'Das', u'Reddy', u'Nair', u'Gupta']
+    connection = sqlite3.connect(':memory:')
+    connection.executescript('''
+        CREATE TABLE mapi_visitor (id INTEGER PRIMARY KEY, member_id INTEGER, name TEXT,
+                                   mobile_no TEXT, vehicle_no TEXT);
+        CREATE INDEX mapi_visitor_member ON mapi_visitor (member_id);
+        CREATE VIRTUAL TABLE visitor_fts USING fts5(name, mobile_no, vehicle_no, tokenize='trigram');
+        CREATE TABLE visitor_owner (id INTEGER PRIMARY KEY, member_id INTEGER);
+        CREATE INDEX visitor_owner_member ON visitor_owner (member_id);
+    ''')
+    random.seed(rows)
+    batch = []
+    for i in range(1, rows + 1):
+        name = u'%s %s %s' % (random.choice(first_names), random.choice(last_names), i)
+        batch.append((i, i % members, name, u'98%08d' % i, u'KA01AB%04d' % (i % 10000)))
+        if len(batch) == 10000 or i == rows:
+            connection.executemany('INSERT INTO mapi_visitor VALUES (?, ?, ?, ?, ?)', batch)
+            connection.executemany('INSERT INTO visitor_fts (rowid, name, mobile_no, vehicle_no) VALUES (?, ?, ?, ?)',
+                                   [(row[0], normalize_term('name', row[2]), row[3], normalize_term('vehicle_no', row[4]))
+                                    for row in batch])
+            connection.executemany('INSERT INTO visitor_owner VALUES (?, ?)', [(row[0], row[1]) for row in batch])
+            batch = []
+
+    # a desk searches for one particular visitor of its own member
+    queries = [connection.execute('SELECT name FROM mapi_visitor WHERE id = ?', (i,)).fetchone()[0]
+               for i in random.sample(range(7, rows + 1, members), 20)]
+
+    def like():
+        for query in queries:
+            connection.execute('SELECT id FROM mapi_visitor WHERE member_id = ? AND name LIKE ?',
+                               (7, u'%%%s%%' % query)).fetchall()
+
+    def fts():
+        for query in queries:
+            connection.execute('SELECT f.rowid FROM visitor_fts f CROSS JOIN visitor_owner o ON o.id = f.rowid '
+                               'WHERE visitor_fts MATCH ? AND o.member_id = ?',
+                               (u'name : ("%s")' % normalize_term('name', query), 7)).fetchall()
+
+    _, like_time = timed(like)
+    _, fts_time = timed(fts)
+    write('SearchView name search, %s rows, %s members, %s queries' % (rows, members, len(queries)))
+    write('  LIKE     : %.2fms/query' % (like_time * 1000 / len(queries)))
+    write('  FTS5     : %.2fms/query (%.1fx)' % (fts_time * 1000 / len(queries), like_time / fts_time))
+
+
+def make_camera_photo(index, size=(1600, 1200)):
+    """
+    JPEG with smooth photo-like content, plain noise would not compress like a real photo
+    """
+    import random
+    from io import BytesIO
+    from PIL import Image
+    random.seed(index)
+    tiles = Image.new('RGB', (16, 12))
+    tiles.putdata([(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)) for _ in range(16 * 12)])
+    output = BytesIO()
+    tiles.resize(size, Image.BICUBIC).save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+@benchmark('images')
+def bench_images(write, rows=50, **options):
+    """
+    The old create-visitor path (full decode, 200x200 resize, PNG) against normalize_image
+    """
+    from io import BytesIO
+    from PIL import Image
+    from visitorManagement.mapi.images import get_image_options, normalize_image
+
+    photos = [make_camera_photo(i) for i in range(rows)]
+
+    def legacy():
+        written = 0
+        for photo in photos:
+            image = Image.open(BytesIO(photo))
+            (width, height) = image.size
+            if width > 200 or height > 200:
+                image = image.resize((200, 200), Image.ANTIALIAS)
+            output = BytesIO()
+            image.save(output, 'PNG')
+            written += len(output.getvalue())
+        return written
+
+    def normalized(image_options):
+        return sum(len(data) for photo in photos for rendition, data in normalize_image(BytesIO(photo), image_options))
+
+    write('create-visitor image processing, %s photos of 1600x1200' % rows)
+    legacy_bytes, legacy_time = timed(legacy)
+    write('  legacy PNG 200x200       : %.1fms/image, %s bytes/image' % (legacy_time * 1000 / rows, legacy_bytes / rows))
+    for image_format in ('WEBP', 'JPEG'):
+        image_options = dict(get_image_options(), format=image_format)
+        written, elapsed = timed(normalized, image_options)
+        write('  %-4s q%s %-16s: %.1fms/image, %s bytes/image (all renditions)' % (
+            image_format, image_options['quality'], ','.join(name for name, size in image_options['renditions']),
+            elapsed * 1000 / rows, written / rows))
+
+
+@benchmark('writes')
+def bench_writes(write, rows=1000, database='default', **options):
+    """
+    create-visitor row writes per second: the old create + save() for the image paths
+    against the single insert in one transaction. Commits for real, run it against a
+    scratch database (--database picks the alias); the rows it creates are removed.
+    """
+    from django.db import connections, transaction
+    from visitorManagement.mapi.models import Member, Visitor, VisitorTombstone, WorkBook, WorkBookType
+
+    member = Member.objects.using(database).create(email='benchmark-%s@example.com' % time.time(),
+                                                   password='benchmark', name='Benchmark', mobile_no='0',
+                                                   address='-', package='-')
+    workbook_type = WorkBookType.objects.using(database).create(type='Benchmark', mandatory_fields='name,photo')
+    workbook = WorkBook.objects.using(database).create(wb_name='Benchmark', wb_type=workbook_type, member=member)
+
+    def legacy():
+        for i in range(rows):
+            created = Visitor.object.db_manager(database).create(member=member, workbook=workbook,
+                                                                 name=u'Visitor %s' % i, mobile_no=u'98%08d' % i,
+                                                                 in_time=datetime.datetime.now())
+            created.photo = u'uploads/raw/%s_photo.jpg' % i
+            created.image_status = Visitor.IMAGES_PENDING
+            created.save(using=database)
+
+    def single():
+        for i in range(rows):
+            created = Visitor(member=member, workbook=workbook, name=u'Visitor %s' % i, mobile_no=u'98%08d' % i,
+                              in_time=datetime.datetime.now())
+            created.photo = u'uploads/raw/%s_photo.jpg' % i
+            created.image_status = Visitor.IMAGES_PENDING
+            with transaction.atomic(using=database):
+                created.save(force_insert=True, using=database)
+
+    try:
+        write('create-visitor writes, %s rows on %s (%s)' % (rows, database, connections[database].vendor))
+        _, legacy_time = timed(legacy)
+        _, single_time = timed(single)
+        write('  create + save : %.0f visitors/s' % (rows / legacy_time))
+        write('  single insert : %.0f visitors/s (%.1fx)' % (rows / single_time, legacy_time / single_time))
+    finally:
+        Visitor.object.using(database).filter(workbook=workbook).delete()
+        VisitorTombstone.objects.using(database).filter(workbook=workbook).delete()
+        workbook.delete()
+        workbook_type.delete()
+        member.delete()
+
+
+@benchmark('serializers')
+def bench_serializers(write, rows=1000, **options):
+    """
+    A get-visitors response of `rows` visitors: formatting with strftime against the clock
+    table, then the encoders and the response compression
+    """
+    import json
+    import simplejson
+    import zlib
+    from visitorManagement.mapi import serializers
+    from visitorManagement.mapi.models import Visitor
+    from visitorManagement.mapi.utils import format_visitor_data
+    repeat = 20
+
+    visitors = make_visitor_rows(rows)
+    needed_fields = set(Visitor.object.get_all_field_names())
+
+    def repeated(fn, *args):
+        for _ in range(repeat):
+            result = fn(*args)
+        return result
+
+    write('get-visitors payload, %s visitors, %s runs' % (rows, repeat))
+    _, legacy_time = timed(repeated, legacy_format_visitor_data, visitors, needed_fields)
+    payload, format_time = timed(repeated, format_visitor_data, visitors, needed_fields)
+    write('  format strftime    : %.2fms' % (legacy_time * 1000 / repeat))
+    write('  format clock table : %.2fms (%.1fx)' % (format_time * 1000 / repeat, legacy_time / format_time))
+
+    ret_dict = {'status': 0, 'message': 'success', 'response': payload}
+    encoders = [('json.dumps', json.dumps), ('simplejson.dumps', simplejson.dumps),
+                ('compact json', serializers.json_dumps)]
+    baseline = None
+    for name, encode in encoders:
+        content, elapsed = timed(repeated, encode, ret_dict)
+        baseline = baseline or elapsed
+        write('  %-18s : %.2fms, %s bytes (%.1fx)' % (name, elapsed * 1000 / repeat, len(content),
+                                                      baseline / elapsed))
+
+    content = serializers.dumps(ret_dict)
+    compressors = [('gzip 6', lambda: zlib.compress(content, 6))]
+    try:
+        import brotli
+        compressors.append(('brotli 5', lambda: brotli.compress(content, quality=5)))
+    except ImportError:
+        write('  (brotli not installed)')
+    for name, compress in compressors:
+        compressed, elapsed = timed(repeated, compress)
+        write('  %-18s : %.2fms, %s bytes' % (name, elapsed * 1000 / repeat, len(compressed)))
+
+
+@benchmark('tokens')
+def bench_tokens(write, rows=20000, database='default', **options):
+    """
+    Auth token verifications per second, legacy '0' tokens against v1, with the member
+    cached (the hot path) and uncached. Creates and removes a Member in `database`.
+    """
+    from django.test.utils import override_settings
+    from visitorManagement.mapi.models import Member
+    from visitorManagement.mapi.request_handler import make_legacy_token, make_token, verify_token, \
+        verified_token_cache
+
+    member = Member.objects.using(database).create(email='benchmark-%s@example.com' % time.time(),
+                                                   password='benchmark', name='Benchmark', mobile_no='0',
+                                                   address='-', package='-')
+    tokens = [('legacy', make_legacy_token(member)), ('v1', make_token(member))]
+
+    def verify(token, cached):
+        for _ in range(rows):
+            if not cached:
+                verified_token_cache.clear()
+            assert verify_token(token) is not None
+
+    try:
+        write('verify_token, %s verifications' % rows)
+        with override_settings(MAPI_LEGACY_TOKENS_UNTIL=None):
+            for cached in (True, False):
+                for name, token in tokens:
+                    _, elapsed = timed(verify, token, cached)
+                    write('  %-6s %-8s : %.0f/s' % (name, 'cached' if cached else 'uncached', rows / elapsed))
+    finally:
+        verified_token_cache.clear()
+        member.delete()
+
+
+@benchmark('connections')
+def bench_connections(write, rows=2000, database='default', connect_latency=0, **options):
+    """
+    Per request connection overhead: `rows` request cycles (request_started, one query,
+    request_finished) with a new connection per request against persistent ones.
+    connect_latency (ms) is added to every connect, standing in for the TCP and auth
+    handshake with a remote MySQL when benchmarking on SQLite.
+    """
+    from django.core.signals import request_started, request_finished
+    from django.db import connections
+
+    connection = connections[database]
+    get_new_connection = connection.get_new_connection
+    connects = []
+
+    def counted_connect(conn_params):
+        connects.append(1)
+        if connect_latency:
+            time.sleep(connect_latency / 1000.0)
+        return get_new_connection(conn_params)
+
+    def requests():
+        for _ in range(rows):
+            request_started.send(sender=None)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            request_finished.send(sender=None)
+
+    conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+    connection.get_new_connection = counted_connect
+    try:
+        write('%s request cycles on %s (%s), %sms added per connect' % (rows, database, connection.vendor,
+                                                                         connect_latency))
+        for name, max_age in (('new connection', 0), ('persistent', 600)):
+            connection.close()
+            connection.settings_dict['CONN_MAX_AGE'] = max_age
+            del connects[:]
+            _, elapsed = timed(requests)
+            write('  %-15s: %.0f requests/s, %.3fms/request, %s connects' % (
+                name, rows / elapsed, elapsed * 1000 / rows, len(connects)))
+    finally:
+        connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+        del connection.get_new_connection
+        connection.close()
+
+
+@benchmark('push')
+def bench_push(write, rows=200, database='default', **options):
+    """
+    Load test of `rows` desks watching one workbook of 200 open visits while 20 visitors
+    check in over 10 seconds: polling get-visitors every 3 seconds against waiting on
+    visitor-events. The desks are threads with their own connection, use a file
+    database (--database); the rows it creates are removed.
+    """
+    import threading
+    from django.db import connections, transaction
+    from django.test.utils import override_settings
+    from visitorManagement.mapi import schema
+    from visitorManagement.mapi.models import Member, Visitor, VisitorTombstone, WorkBook, WorkBookType
+    from visitorManagement.mapi.push import wait_for_change, shared_changes
+    from visitorManagement.mapi.utils import format_visitor_rows
+    from visitorManagement.mapi.views import SyncView
+
+    duration, poll_interval, check_ins, open_visits = 10.0, 3.0, 20, 200
+    member = Member.objects.using(database).create(email='benchmark-%s@example.com' % time.time(),
+                                                   password='benchmark', name='Benchmark', mobile_no='0',
+                                                   address='-', package='-')
+    workbook_type = WorkBookType.objects.using(database).create(type='Benchmark %s' % time.time(),
+                                                                mandatory_fields='name,mobile_no,in_time,out_time')
+    workbook = WorkBook.objects.using(database).create(wb_name='Benchmark', wb_type=workbook_type, member=member)
+    workbook_fields = schema.workbook_type_fields(workbook_type)
+
+    def check_in(i):
+        now = datetime.datetime.now()
+        with transaction.atomic(using=database):
+            Visitor(member=member, workbook=workbook, name=u'Visitor %s' % i, mobile_no=u'98%08d' % i,
+                    in_time=now, out_time=now + datetime.timedelta(hours=2)).save(using=database)
+
+    def poll():
+        visitors = Visitor.object.db_manager(database).get_all_active_visitor(workbook)
+        return format_visitor_rows(visitors, workbook_fields.format_row)
+
+    def count_queries(fn, *args):
+        connection = connections[database]
+        connection.queries_log.clear()
+        connection.force_debug_cursor = True
+        try:
+            fn(*args)
+        finally:
+            connection.force_debug_cursor = False
+        return len(connection.queries_log)
+
+    results = []
+    stop = threading.Event()
+    started = threading.Semaphore(0)
+
+    def desk():
+        listener = WorkBook.objects.using(database).select_related('wb_type').get(id=workbook.id)
+        token, events, rows_read = listener.change_seq, 0, 0
+
+        def listen():
+            started.release()
+            while not stop.is_set():
+                change_seq = wait_for_change(listener.id, token_box[0], 1)
+                if change_seq is not None:
+                    listener.change_seq = change_seq
+                    changes = shared_changes(listener, token_box[0], SyncView().get_changes)
+                    token_box[0] = int(changes['token'])
+                    counts[0] += 1
+                    counts[1] += len(changes['rows'])
+
+        token_box, counts = [token], [events, rows_read]
+        queries = count_queries(listen)
+        connections[database].close()
+        results.append((queries, counts[0], counts[1]))
+
+    try:
+        for i in range(open_visits):
+            check_in(i)
+        write('%s desks, %s open visits, %s check-ins in %ss, on %s (%s)' % (
+            rows, open_visits, check_ins, duration, database, connections[database].vendor))
+
+        polls = int(rows * duration / poll_interval)
+        queries = count_queries(lambda: [poll() for _ in range(polls)])
+        poll_time = timed(lambda: [poll() for _ in range(polls)])[1]
+        write('  polling every %ss   : %s queries, %s rows read, %.2fs of database and formatting' % (
+            poll_interval, queries, polls * open_visits, poll_time))
+
+        with override_settings(MAPI_PUSH_TICK=0.5, MAPI_PUSH_RECHECK_SECONDS=None):
+            desks = [threading.Thread(target=desk) for _ in range(rows)]
+            for thread in desks:
+                thread.start()
+            for _ in desks:
+                started.acquire()
+            start = time.time()
+            for i in range(check_ins):
+                time.sleep(duration / check_ins)
+                check_in(open_visits + i)
+            stop.set()
+            for thread in desks:
+                thread.join()
+        write('  visitor-events       : %s queries, %s rows read, %s events in %.1fs' % (
+            sum(result[0] for result in results), sum(result[2] for result in results),
+            sum(result[1] for result in results), time.time() - start))
+    finally:
+        Visitor.object.using(database).filter(workbook=workbook).delete()
+        VisitorTombstone.objects.using(database).filter(workbook=workbook).delete()
+        workbook.delete()
+        workbook_type.delete()
+        member.delete()
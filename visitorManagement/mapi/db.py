@@ -0,0 +1,36 @@
+"""
+Health checks for persistent database connections (CONN_MAX_AGE).
+
+Django 1.9 reuses a connection across requests until CONN_MAX_AGE, but only drops
+it after an error; one the server closed meanwhile (MySQL wait_timeout, a failover)
+fails the next request's first query. A connection idle for more than
+MAPI_DB_HEALTH_CHECK_IDLE seconds is pinged when a request starts and replaced if
+the ping fails.
+"""
+import time
+
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+from django.db import connections
+from django.dispatch import receiver
+
+
+@receiver(request_started)
+def check_idle_connections(**kwargs):
+    idle = getattr(settings, 'MAPI_DB_HEALTH_CHECK_IDLE', 30)
+    if idle is None:
+        return
+    now = time.time()
+    for connection in connections.all():
+        if connection.connection is None or now - getattr(connection, 'mapi_last_used', now) < idle:
+            continue
+        if not connection.is_usable():
+            connection.close()
+
+
+@receiver(request_finished)
+def mark_connections_used(**kwargs):
+    now = time.time()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.mapi_last_used = now
@@ -0,0 +1,204 @@
+"""
+Visitor history export to CSV, JSON lines or Parquet, for the export endpoint
+and `python manage.py export_visitors`.
+
+Visits are read batch_size at a time, the archived months first (mapi/archive.py)
+then the Visitor table in id order, each batch a keyset query continuing after
+the last id of the previous one. Django 1.9's iterator() has no chunk_size and
+the MySQL driver buffers a whole result set, batches keep the memory of an
+export of any size to one batch. Each batch is written out before the next one
+is read.
+
+Parquet needs pyarrow; every batch becomes a row group.
+"""
+import csv
+import datetime
+import io
+
+from visitorManagement.mapi.analytics import day_start
+from visitorManagement.mapi.archive import month_start, read_rows
+from visitorManagement.mapi.models import Visitor, VisitorArchive
+from visitorManagement.mapi.serializers import dumps
+from visitorManagement.mapi.utils import get_base_image_url
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FIELDS = ('id', 'workbook_id', 'name', 'mobile_no', 'vehicle_no', 'from_place', 'destination_place',
+          'in_time', 'out_time', 'status', 'photo', 'signature')
+DATETIME_FIELDS = ('in_time', 'out_time')
+IMAGE_FIELDS = ('photo', 'signature')
+DATETIME_POSITIONS = tuple(FIELDS.index(field_name) for field_name in DATETIME_FIELDS)
+IMAGE_POSITIONS = tuple(FIELDS.index(field_name) for field_name in IMAGE_FIELDS)
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def visitor_batches(member=None, workbook=None, start=None, end=None, batch_size=1000):
+    """
+    Lists of Visitor values() rows of member and / or workbook whose in_time is
+    from day start to day end included (open ended when None)
+    """
+    start_time = day_start(start) if start is not None else None
+    end_time = day_start(end + datetime.timedelta(days=1)) if end is not None else None
+
+    def in_range(row):
+        in_time = row['in_time']
+        if start_time is not None and (in_time is None or in_time < start_time):
+            return False
+        return end_time is None or (in_time is not None and in_time < end_time)
+
+    archives = VisitorArchive.objects.order_by('month', 'id')
+    if member is not None:
+        archives = archives.filter(member=member)
+    if workbook is not None:
+        archives = archives.filter(member=workbook.member_id)
+    if start is not None:
+        archives = archives.filter(month__gte=month_start(start))
+    if end is not None:
+        archives = archives.filter(month__lte=month_start(end))
+    batch = []
+    for archive in archives:
+        for row in read_rows(archive.path):
+            if (workbook is None or row['workbook_id'] == workbook.id) and in_range(row):
+                batch.append(row)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+    visitors = Visitor.object.order_by('id')
+    if member is not None:
+        visitors = visitors.filter(member=member)
+    if workbook is not None:
+        visitors = visitors.filter(workbook=workbook)
+    if start_time is not None:
+        visitors = visitors.filter(in_time__gte=start_time)
+    if end_time is not None:
+        visitors = visitors.filter(in_time__lt=end_time)
+    last_id = 0
+    while True:
+        batch = list(visitors.filter(id__gt=last_id).values(*FIELDS)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]['id']
+
+
+def format_batch(batch):
+    """
+    Rows of FIELDS values, image paths turned into urls with a base url looked up once per batch
+    """
+    image_url = get_base_image_url()
+    rows = []
+    for visitor in batch:
+        row = [visitor[field_name] for field_name in FIELDS]
+        for position in IMAGE_POSITIONS:
+            if row[position]:
+                row[position] = image_url + row[position]
+        rows.append(row)
+    return rows
+
+
+def encode_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def write_csv(batches):
+    buffer = io.BytesIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for batch in batches:
+        for row in format_batch(batch):
+            for position in DATETIME_POSITIONS:
+                if row[position] is not None:
+                    row[position] = row[position].strftime('%Y-%m-%d %H:%M:%S')
+            writer.writerow([encode_csv_value(value) for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_jsonl(batches):
+    for batch in batches:
+        yield b''.join(dumps(dict(zip(FIELDS, row))) + b'\n' for row in format_batch(batch))
+
+
+class ChunkSink(object):
+    """
+    File object collecting what the Parquet writer writes, drained after every row group
+    """
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def write_parquet(batches):
+    schema = pyarrow.schema([(field_name, pyarrow.int64() if field_name in ('id', 'workbook_id', 'status') else
+                              pyarrow.timestamp('s') if field_name in DATETIME_FIELDS else pyarrow.string())
+                             for field_name in FIELDS])
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+    for batch in batches:
+        columns = zip(*format_batch(batch))
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(list(column), type=field.type) for column, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'parquet': write_parquet,
+}
+
+
+def export_visitors(export_format, batch_size=1000, **filters):
+    """
+    The export as an iterator of byte strings, one or more per batch;
+    filters are those of visitor_batches
+    """
+    if export_format not in WRITERS:
+        raise ExportError('Unknown export format %s, use one of %s' % (export_format, ', '.join(sorted(WRITERS))))
+    if export_format == 'parquet' and pyarrow is None:
+        raise ExportError('Parquet exports need pyarrow, which is not installed')
+    return WRITERS[export_format](visitor_batches(batch_size=batch_size, **filters))
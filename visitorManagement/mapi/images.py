@@ -0,0 +1,289 @@
+"""
+Visitor photo and signature handling for create-visitor.
+
+Uploads are stored as they came in and the request is acknowledged straight
+away. Decoding, resizing and encoding run in a pool of MAPI_IMAGE_WORKERS
+processes (0 does it inline), which then points Visitor.photo / signature at
+the processed file and sets Visitor.image_status.
+
+Every upload is normalised into the MAPI_IMAGE_RENDITIONS, each bounded to a
+square keeping its aspect ratio and encoded as MAPI_IMAGE_FORMAT (WEBP or
+progressive JPEG) at MAPI_IMAGE_QUALITY. The first rendition is the one the
+Visitor points at, the others sit next to it, see rendition_path.
+
+A job lost on the way (a killed worker, a restarted process) leaves its visitor
+PENDING with the raw upload kept, `python manage.py requeue_pending_images`
+hands those older than MAPI_IMAGE_PENDING_SECONDS to the workers again.
+
+Processed images are content addressed: they are stored once under
+CAS_IMAGE_DIR/<sha256[:2]>/<sha256[2:4]>/<sha256>.<ext> of their bytes, so the
+same photo or signature uploaded every day takes disk space once and its url
+never changes content, clients may cache it forever.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from io import BytesIO
+
+from PIL import Image, features
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.db import connection, transaction
+
+IMAGE_DIRS = {
+    'photo': 'uploads/member_photos',
+    'signature': 'uploads/signature_photos',
+}
+RAW_IMAGE_DIR = 'uploads/raw'
+CAS_IMAGE_DIR = 'uploads/cas'
+IMAGE_EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def media_path(relative_path, media_root=None):
+    return os.path.join(media_root or settings.MEDIA_ROOT, relative_path)
+
+
+def ensure_parent_dir(path):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # created by a concurrent request in the meantime
+            if not os.path.isdir(parent):
+                raise
+
+
+def get_image_options():
+    """
+    Encoding settings, handed to the workers along with every job
+    """
+    image_format = getattr(settings, 'MAPI_IMAGE_FORMAT', 'WEBP').upper()
+    if image_format == 'WEBP' and not features.check('webp'):
+        image_format = 'JPEG'
+    return {
+        'format': image_format,
+        'quality': getattr(settings, 'MAPI_IMAGE_QUALITY', 80),
+        'renditions': tuple(getattr(settings, 'MAPI_IMAGE_RENDITIONS', (('full', 200), ('thumb', 64)))),
+    }
+
+
+def rendition_path(image_path, rendition):
+    """
+    uploads/member_photos/x.webp -> uploads/member_photos/x_thumb.webp for the 'thumb' rendition
+    """
+    root, extension = os.path.splitext(image_path)
+    return '%s_%s%s' % (root, rendition, extension)
+
+
+def blob_path(data, extension):
+    digest = hashlib.sha256(data).hexdigest()
+    return '%s/%s/%s/%s.%s' % (CAS_IMAGE_DIR, digest[:2], digest[2:4], digest, extension)
+
+
+def write_once(path, data):
+    """
+    Writes data to path unless it is already there, through a temporary file and
+    a rename so readers never see a partial file
+    """
+    if os.path.exists(path):
+        return False
+    ensure_parent_dir(path)
+    temporary_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(temporary_path, 'wb') as destination:
+        destination.write(data)
+    os.rename(temporary_path, path)
+    return True
+
+
+def store_raw_upload(upload, field_name, wb_id, time_stamp):
+    """
+    Writes the upload untouched under RAW_IMAGE_DIR, only its header is parsed to
+    reject files that are not images (IOError).
+    Returns a (field_name, raw_path) job for process_visitor_images.
+    """
+    image = Image.open(upload)
+    raw_path = '%s/%s_%s_%s_%s.%s' % (RAW_IMAGE_DIR, time_stamp, wb_id, field_name, uuid.uuid4().hex[:8],
+                                      (image.format or 'img').lower())
+
+    ensure_parent_dir(media_path(raw_path))
+    if hasattr(upload, 'temporary_file_path'):
+        # already spooled to disk by TemporaryFileUploadHandler, moved instead of copied
+        file_move_safe(upload.temporary_file_path(), media_path(raw_path))
+        return field_name, raw_path
+    with open(media_path(raw_path), 'wb') as destination:
+        for chunk in upload.chunks():
+            destination.write(chunk)
+    return field_name, raw_path
+
+
+def remove_raw_uploads(jobs, media_root=None):
+    for field_name, raw_path in jobs:
+        try:
+            os.remove(media_path(raw_path, media_root))
+        except OSError:
+            pass
+
+
+def encode_image(image, options):
+    """
+    Returns the encoded bytes of image in the configured format
+    """
+    if options['format'] == 'JPEG' and image.mode != 'RGB':
+        # JPEG has no alpha, flatten transparent signatures onto white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+        image = background
+    output = BytesIO()
+    if options['format'] == 'JPEG':
+        image.save(output, 'JPEG', quality=options['quality'], optimize=True, progressive=True)
+    else:
+        image.save(output, options['format'], quality=options['quality'])
+    return output.getvalue()
+
+
+def normalize_image(raw_file, options):
+    """
+    Decodes raw_file once and returns [(rendition, encoded bytes)], largest rendition first
+    """
+    image = Image.open(raw_file)
+    largest = max(size for rendition, size in options['renditions'])
+    # JPEGs are decoded straight at the smallest scale (1/2, 1/4, 1/8) still >= the largest rendition
+    image.draft('RGB', (largest, largest))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'P') else 'RGB')
+
+    renditions = []
+    for rendition, size in sorted(options['renditions'], key=lambda item: -item[1]):
+        image = image.copy() if renditions else image
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        renditions.append((rendition, encode_image(image, options)))
+    return renditions
+
+
+def process_image(raw_file, media_root, options):
+    """
+    Stores the renditions of raw_file, named after the hash of the primary rendition,
+    and returns the primary rendition's path relative to media_root
+    """
+    renditions = dict(normalize_image(raw_file, options))
+    primary_rendition = options['renditions'][0][0]
+    image_path = blob_path(renditions[primary_rendition], IMAGE_EXTENSIONS[options['format']])
+    for rendition, data in renditions.items():
+        path = image_path if rendition == primary_rendition else rendition_path(image_path, rendition)
+        write_once(media_path(path, media_root), data)
+    return image_path
+
+
+def process_visitor_images(media_root, visitor_id, jobs, options):
+    """
+    Runs in the worker processes, so it must not touch the database.
+    Returns (visitor_id, {field_name: image_path}, success)
+    """
+    image_paths = {}
+    try:
+        for field_name, raw_path in jobs:
+            image_paths[field_name] = process_image(media_path(raw_path, media_root), media_root, options)
+    except Exception as e:
+        # any decoder error fails the visitor rather than the job, which would leave it pending
+        logging.error('Unable to process images of visitor %s: %s' % (visitor_id, e))
+        return visitor_id, {}, False
+
+    for field_name, raw_path in jobs:
+        os.remove(media_path(raw_path, media_root))
+    return visitor_id, image_paths, True
+
+
+def finish_visitor_images(result):
+    from visitorManagement.mapi.models import Visitor
+    visitor_id, image_paths, success = result
+    image_status = Visitor.IMAGES_READY if success else Visitor.IMAGES_FAILED
+    # only a pending visitor, a requeued job finishing second doesn't undo the first
+    Visitor.object.update_changed(Visitor.object.filter(pk=visitor_id, image_status=Visitor.IMAGES_PENDING),
+                                  image_status=image_status, **image_paths)
+    return image_status
+
+
+def _finish_in_background(result):
+    # pool callbacks run on the pool's result thread, which gets its own connection
+    try:
+        finish_visitor_images(result)
+    except Exception as e:
+        logging.error('Unable to update images of visitor %s: %s' % (result[0], e))
+    finally:
+        connection.close()
+
+
+def get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # a pool inherited through fork (e.g. gunicorn preload) has no live workers
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(settings.MAPI_IMAGE_WORKERS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def submit_visitor_images(visitor_id, jobs):
+    """
+    Hands the raw uploads of a visitor to the worker pool once the visitor row is
+    committed. Returns the image_status the visitor has when this returns.
+    """
+    from visitorManagement.mapi.models import Visitor
+    options = get_image_options()
+    if not getattr(settings, 'MAPI_IMAGE_WORKERS', 0):
+        return finish_visitor_images(process_visitor_images(settings.MEDIA_ROOT, visitor_id, jobs, options))
+
+    transaction.on_commit(lambda: get_pool().apply_async(process_visitor_images,
+                                                         (settings.MEDIA_ROOT, visitor_id, jobs, options),
+                                                         callback=_finish_in_background))
+    return Visitor.IMAGES_PENDING
+
+
+def wait_for_pool():
+    """
+    Lets the pool finish its jobs and their callbacks, for commands exiting after submitting some
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+            _pool.join()
+        _pool = None
+
+
+def requeue_pending_images(older_than=None, now=None):
+    """
+    Submits again the visitors still PENDING whose raw uploads are older than older_than
+    seconds (MAPI_IMAGE_PENDING_SECONDS), their job was lost. A visitor whose raw uploads
+    are gone is marked FAILED. Returns the number of visitors requeued.
+    """
+    from visitorManagement.mapi.models import Visitor
+    if older_than is None:
+        older_than = getattr(settings, 'MAPI_IMAGE_PENDING_SECONDS', 600)
+    now = now or time.time()
+    requeued = 0
+    for visitor in list(Visitor.object.filter(image_status=Visitor.IMAGES_PENDING).only(*IMAGE_DIRS)):
+        jobs = [(field_name, getattr(visitor, field_name).name) for field_name in sorted(IMAGE_DIRS)
+                if (getattr(visitor, field_name).name or '').startswith(RAW_IMAGE_DIR + '/')]
+        try:
+            if not jobs or max(os.path.getmtime(media_path(raw_path)) for field_name, raw_path in jobs) > \
+                    now - older_than:
+                continue
+            for field_name, raw_path in jobs:
+                # the next run waits for this job again
+                os.utime(media_path(raw_path), (now, now))
+        except OSError:
+            finish_visitor_images((visitor.id, {}, False))
+            continue
+        submit_visitor_images(visitor.id, jobs)
+        requeued += 1
+    return requeued
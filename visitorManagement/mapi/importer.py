@@ -0,0 +1,312 @@
+"""
+Bulk import of visitor registers kept before the app, csv or xlsx files with a
+header row, for the import-visitors endpoint and `python manage.py import_visitors`.
+
+The header names the Visitor columns (IMPORT_FIELDS, "Mobile No" reads as
+mobile_no), other columns are ignored; registers carry no photo or signature,
+so those are never required. A row is checked against the mandatory_fields of
+the workbook's type and the column sizes, a row that fails is rejected and
+reported, the others are inserted as CLOSED visits, with or without an out_time:
+a register records visits that are over.
+
+The file is read a row at a time (openpyxl's read-only mode for xlsx) and
+inserted MAPI_IMPORT_BATCH_SIZE rows per transaction through
+VisitorManager.bulk_insert, which also assigns change_seqs and adds the visits
+to the VisitCounters. The VisitorImport row counting the rows done is updated
+in the same transaction, it is the checkpoint: an import that failed or whose
+process died goes on from the first row not committed when the same file is
+imported again into the workbook (same sha1). A finished import is not redone.
+
+xlsx files need openpyxl.
+"""
+import csv
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from visitorManagement.mapi import schema
+from visitorManagement.mapi.models import Visitor, VisitorImport
+from visitorManagement.mapi.search import index_bulk_inserted_visitors
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+IMPORT_FIELDS = ('name', 'mobile_no', 'vehicle_no', 'from_place', 'destination_place', 'in_time', 'out_time')
+DATETIME_FIELDS = ('in_time', 'out_time')
+IMAGE_FIELDS = frozenset(['photo', 'signature'])
+DATETIME_FORMATS = ('%Y%m%d %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d-%m-%Y %H:%M:%S', '%d-%m-%Y %H:%M',
+                    '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M')
+FORMATS = ('csv', 'xlsx')
+MAX_ERRORS = 100  # rejected rows kept in VisitorImport.errors
+
+
+class VisitorImportError(ValueError):
+    pass
+
+
+def import_root():
+    return getattr(settings, 'MAPI_IMPORT_ROOT', os.path.join(settings.BASE_DIR, 'imports'))
+
+
+def file_format(file_name):
+    extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+    if extension not in FORMATS:
+        raise VisitorImportError('Unknown register format %s, use one of %s' % (extension, ', '.join(FORMATS)))
+    if extension == 'xlsx' and openpyxl is None:
+        raise VisitorImportError('xlsx registers need openpyxl, which is not installed')
+    return extension
+
+
+def file_checksum(path):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as register:
+        for block in iter(lambda: register.read(64 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def store_upload(upload):
+    """
+    Copies an uploaded register to import_root(), named by its sha1, returns (path, sha1)
+    """
+    extension = file_format(upload.name)
+    checksum = hashlib.sha1()
+    for block in upload.chunks():
+        checksum.update(block)
+    path = os.path.join(import_root(), '%s.%s' % (checksum.hexdigest(), extension))
+    if not os.path.exists(path):
+        if not os.path.isdir(import_root()):
+            os.makedirs(import_root())
+        with open(path + '.tmp', 'wb') as register:
+            for block in upload.chunks():
+                register.write(block)
+        os.rename(path + '.tmp', path)
+    return path, checksum.hexdigest()
+
+
+def csv_rows(path):
+    with open(path, 'rb') as register:
+        for row in csv.reader(register):
+            yield row
+
+
+def xlsx_rows(path):
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in book.active.iter_rows():
+            yield [cell.value for cell in row]
+    finally:
+        if hasattr(book, 'close'):
+            book.close()
+
+
+def read_rows(path, register_format):
+    return csv_rows(path) if register_format == 'csv' else xlsx_rows(path)
+
+
+def clean_value(value):
+    """
+    A cell as unicode, or a datetime for xlsx dates, None when empty
+    """
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError('Not utf-8 text')
+    elif isinstance(value, float) and value.is_integer():
+        # numbers typed into a spreadsheet, mobile numbers mostly
+        value = unicode(int(value))
+    elif value is not None and not isinstance(value, (unicode, datetime.datetime)):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.strip() or None
+    return value
+
+
+def column_positions(header, needed_fields):
+    """
+    {Visitor field name: position} of the IMPORT_FIELDS in the header row
+    """
+    positions = {}
+    for position, title in enumerate(header):
+        title = clean_value(title)
+        if title:
+            field_name = u'_'.join(title.lstrip(u'\ufeff').lower().split())
+            if field_name in IMPORT_FIELDS and field_name not in positions:
+                positions[field_name] = position
+    missing = sorted(set(needed_fields) - set(positions))
+    if missing:
+        raise VisitorImportError('Missing column %s' % ', '.join(missing))
+    return positions
+
+
+def parse_datetime_value(value, datetime_formats):
+    """
+    value as a datetime, datetime_formats (a list) is reordered to try the format that matched first next time,
+    a register sticks to one format
+    """
+    if not isinstance(value, datetime.datetime):
+        for position, datetime_format in enumerate(datetime_formats):
+            try:
+                value = datetime.datetime.strptime(value, datetime_format)
+            except ValueError:
+                continue
+            if position:
+                datetime_formats.insert(0, datetime_formats.pop(position))
+            break
+        else:
+            raise ValueError('Unknown date format %s' % value)
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def build_visitor(job, row, positions, needed_fields, datetime_formats):
+    """
+    Unsaved Visitor for a data row, raises ValueError with the reason the row is rejected
+    """
+    values = {}
+    for field_name, position in positions.items():
+        value = clean_value(row[position]) if position < len(row) else None
+        if value is not None and field_name in DATETIME_FIELDS:
+            value = parse_datetime_value(value, datetime_formats)
+        elif value is not None:
+            if isinstance(value, datetime.datetime):
+                value = unicode(value)
+            max_length = Visitor._meta.get_field(field_name).max_length
+            if len(value) > max_length:
+                raise ValueError('%s longer than %s characters' % (field_name, max_length))
+        values[field_name] = value
+    for field_name in sorted(needed_fields):
+        if not values.get(field_name):
+            raise ValueError('Missing mandatory field %s' % field_name)
+    return Visitor(member_id=job.member_id, workbook_id=job.workbook_id, status=Visitor.CLOSED, **values)
+
+
+def prepare_import(member, workbook, path, source, checksum):
+    """
+    The VisitorImport of the register: the last import of the same file into
+    workbook, to be resumed (or done already), a new one otherwise
+    """
+    file_format(source)
+    job = VisitorImport.objects.filter(workbook=workbook, checksum=checksum).order_by('-id').first()
+    if job is None:
+        return VisitorImport.objects.create(workbook=workbook, member=member, source=source, path=path,
+                                            checksum=checksum)
+    if job.status != VisitorImport.DONE and job.path != path:
+        job.path = path
+        job.save(update_fields=['path'])
+    return job
+
+
+def claim(job):
+    """
+    Marks the import running unless another run holds it, a run silent for
+    MAPI_IMPORT_STALE_SECONDS is taken to have died
+    """
+    stale = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'MAPI_IMPORT_STALE_SECONDS', 300))
+    return VisitorImport.objects.filter(
+        Q(status__in=(VisitorImport.PENDING, VisitorImport.FAILED)) | Q(status=VisitorImport.RUNNING, updated__lt=stale),
+        id=job.id).update(status=VisitorImport.RUNNING, message='', updated=timezone.now()) == 1
+
+
+def run_import(job, batch_size=None, progress=None):
+    """
+    Imports the register of job from its checkpoint on, calling progress(job) after
+    every committed batch. Returns False, doing nothing, when another run holds the
+    import. job ends DONE, or FAILED with a message.
+    """
+    if not claim(job):
+        return False
+    job.refresh_from_db()
+    batch_size = batch_size or getattr(settings, 'MAPI_IMPORT_BATCH_SIZE', 1000)
+    needed_fields = schema.workbook_type_fields(job.workbook.wb_type).needed_fields - IMAGE_FIELDS
+    errors = json.loads(job.errors)
+    seconds, started = job.seconds, time.time()
+    try:
+        rows = read_rows(job.path, file_format(job.source))
+        header = next(rows, None)
+        if header is None:
+            raise VisitorImportError('Empty register')
+        positions = column_positions(header, needed_fields)
+        datetime_formats = list(DATETIME_FORMATS)
+        # the header is row 1
+        row_number = job.rows_done + 1
+        rows = itertools.islice(rows, job.rows_done, None)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            visitors, rejected = [], 0
+            for row in batch:
+                row_number += 1
+                if not any(clean_value(value) for value in row):
+                    continue
+                try:
+                    visitors.append(build_visitor(job, row, positions, needed_fields, datetime_formats))
+                except ValueError as e:
+                    rejected += 1
+                    if len(errors) < MAX_ERRORS:
+                        errors.append({'row': row_number, 'message': unicode(e)})
+            with transaction.atomic():
+                Visitor.object.bulk_insert(visitors, batch_size=500)
+                index_bulk_inserted_visitors(visitors)
+                job.rows_done += len(batch)
+                job.inserted += len(visitors)
+                job.rejected += rejected
+                job.errors = json.dumps(errors)
+                job.seconds = seconds + time.time() - started
+                job.save(update_fields=['rows_done', 'inserted', 'rejected', 'errors', 'seconds', 'updated'])
+            if progress is not None:
+                progress(job)
+    except Exception as e:
+        if not isinstance(e, (VisitorImportError, EnvironmentError)):
+            logging.exception('Import %s failed', job.id)
+        # the counters of the batch that failed were not committed
+        VisitorImport.objects.filter(id=job.id).update(status=VisitorImport.FAILED, message=unicode(e)[:255],
+                                                       seconds=seconds + time.time() - started)
+        job.refresh_from_db()
+        return True
+    job.status = VisitorImport.DONE
+    job.seconds = seconds + time.time() - started
+    job.save(update_fields=['status', 'seconds', 'updated'])
+    return True
+
+
+def run_import_in_thread(job_id):
+    try:
+        run_import(VisitorImport.objects.get(id=job_id))
+    except Exception:
+        logging.exception('Import %s failed', job_id)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def start_import(job):
+    """
+    Runs the import in a background thread once the current transaction commits, or right
+    away when MAPI_IMPORT_BACKGROUND is off. A thread killed with its process leaves the
+    import RUNNING, posting the file again after MAPI_IMPORT_STALE_SECONDS resumes it.
+    """
+    if not getattr(settings, 'MAPI_IMPORT_BACKGROUND', True):
+        run_import(job)
+        return
+
+    def start():
+        thread = threading.Thread(target=run_import_in_thread, args=(job.id,), name='mapi-import-%s' % job.id)
+        thread.daemon = True
+        thread.start()
+    transaction.on_commit(start)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from visitorManagement.mapi.archive import archive_visitors, archive_cutoff
+
+
+class Command(BaseCommand):
+    help = 'Moves the closed visits older than MAPI_ARCHIVE_AFTER_DAYS from the Visitor table to MAPI_ARCHIVE_ROOT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Visits moved per transaction')
+
+    def handle(self, *args, **options):
+        archived = archive_visitors(batch_size=options['batch_size'])
+        self.stdout.write('Archived %s visits from before %s' % (archived, archive_cutoff()))
@@ -0,0 +1,25 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from visitorManagement.mapi.analytics import backfill, first_visit_day
+
+
+class Command(BaseCommand):
+    help = 'Recounts the analytics VisitCounters of a range of days from the Visitor table and the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help='First day, dd-mm-yyyy, the first visit by default')
+        parser.add_argument('--to', dest='end', help='Last day, dd-mm-yyyy, today by default')
+
+    def handle(self, *args, **options):
+        try:
+            start = datetime.datetime.strptime(options['start'], '%d-%m-%Y').date() if options['start'] \
+                else first_visit_day()
+            end = datetime.datetime.strptime(options['end'], '%d-%m-%Y').date() if options['end'] \
+                else datetime.date.today()
+        except ValueError as e:
+            raise CommandError(e)
+        if start is None:
+            self.stdout.write('No visits to count')
+            return
+        self.stdout.write('Counted %s visits from %s to %s' % (backfill(start, end), start, end))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from visitorManagement.mapi.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Runs a mapi micro benchmark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument('--rows', type=int, default=None, help='Number of rows to benchmark with')
+        parser.add_argument('--database', default=None, help='Database alias for the benchmarks that write')
+        parser.add_argument('--connect-latency', type=float, default=None,
+                            help='Milliseconds added to every database connect, connections benchmark only')
+
+    def handle(self, *args, **options):
+        kwargs = dict((key, value) for key, value in options.items() if key in ('rows', 'database', 'connect_latency') and value)
+        try:
+            BENCHMARKS[options['name']](self.stdout.write, **kwargs)
+        except Exception as e:
+            raise CommandError(e)
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from visitorManagement.mapi.models import Visitor
+
+
+class Command(BaseCommand):
+    help = 'Checks out the open visits whose predicted out_time has passed, for clients that never call check-out'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Closed %s visits' % Visitor.object.close_expired())
@@ -0,0 +1,79 @@
+import os
+
+from django.core.management.base import BaseCommand
+from visitorManagement.mapi.images import IMAGE_DIRS, blob_path, get_image_options, media_path, rendition_path, \
+    write_once
+from visitorManagement.mapi.models import Visitor
+
+
+def link_to_blob(path, blob):
+    """
+    Replaces the file at path by a hard link to the stored blob, the visits archived with
+    that path keep their image. False, leaving the file as it is, where links can't be made.
+    """
+    temporary_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        os.link(blob, temporary_path)
+    except (AttributeError, OSError):
+        return False
+    os.rename(temporary_path, path)
+    return True
+
+
+class Command(BaseCommand):
+    help = 'Moves the visitor photos and signatures under media/uploads into the content addressed store, ' \
+           'pointing the visitors at it and hard linking the original files to it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report what would be moved and saved')
+        parser.add_argument('--keep-originals', action='store_true', default=False,
+                            help='Leave the original files as they are instead of linking them to the store')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        secondary_renditions = [rendition for rendition, size in get_image_options()['renditions'][1:]]
+        stored = set()
+        scanned = duplicates = saved_bytes = 0
+
+        for field_name, directory in sorted(IMAGE_DIRS.items()):
+            if not os.path.isdir(media_path(directory)):
+                continue
+            for file_name in sorted(os.listdir(media_path(directory))):
+                image_path = '%s/%s' % (directory, file_name)
+                root = os.path.splitext(file_name)[0]
+                if any(root.endswith('_' + rendition) for rendition in secondary_renditions):
+                    continue  # moved along with its primary rendition
+
+                with open(media_path(image_path), 'rb') as image_file:
+                    data = image_file.read()
+                target_path = blob_path(data, os.path.splitext(file_name)[1].lstrip('.').lower() or 'img')
+                if os.path.exists(media_path(target_path)) and \
+                        os.path.samefile(media_path(image_path), media_path(target_path)):
+                    continue  # linked by an earlier run
+                scanned += 1
+                if target_path in stored or os.path.exists(media_path(target_path)):
+                    duplicates += 1
+                    saved_bytes += len(data)
+                stored.add(target_path)
+                if dry_run:
+                    continue
+
+                write_once(media_path(target_path), data)
+                moved_files = [(image_path, target_path)]
+                for rendition in secondary_renditions:
+                    source = rendition_path(image_path, rendition)
+                    if os.path.exists(media_path(source)):
+                        with open(media_path(source), 'rb') as rendition_file:
+                            write_once(media_path(rendition_path(target_path, rendition)), rendition_file.read())
+                        moved_files.append((source, rendition_path(target_path, rendition)))
+                # a new change_seq, so synced desks get the new url
+                Visitor.object.update_changed(Visitor.object.filter(**{field_name: image_path}),
+                                              **{field_name: target_path})
+                if not options['keep_originals']:
+                    # not removed, the VisitorArchive files still name the original paths
+                    for moved_file, blob in moved_files:
+                        link_to_blob(media_path(moved_file), media_path(blob))
+
+        self.stdout.write('%s%s images scanned, %s unique, %s duplicates, %s bytes saved' % (
+            'Dry run: ' if dry_run else '', scanned, len(stored), duplicates, saved_bytes))
@@ -0,0 +1,42 @@
+import datetime
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from visitorManagement.mapi.export import export_visitors, WRITERS
+from visitorManagement.mapi.models import Member, WorkBook
+
+
+class Command(BaseCommand):
+    help = 'Writes visitor history, archived months included, as csv, jsonl or parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+        parser.add_argument('--member', help='Member id or email')
+        parser.add_argument('--workbook', type=int, help='Workbook id')
+        parser.add_argument('--from', dest='start', help='First day of in_time, dd-mm-yyyy')
+        parser.add_argument('--to', dest='end', help='Last day of in_time, dd-mm-yyyy')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Visits read per query')
+        parser.add_argument('--output', help='File to write, stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            filters = {
+                'start': datetime.datetime.strptime(options['start'], '%d-%m-%Y').date() if options['start'] else None,
+                'end': datetime.datetime.strptime(options['end'], '%d-%m-%Y').date() if options['end'] else None,
+            }
+            if options['member']:
+                lookup = {'email': options['member']} if '@' in options['member'] else {'id': int(options['member'])}
+                filters['member'] = Member.objects.get(**lookup)
+            if options['workbook']:
+                filters['workbook'] = WorkBook.objects.get(id=options['workbook'])
+            chunks = export_visitors(options['format'], batch_size=options['batch_size'], **filters)
+        except (ValueError, Member.DoesNotExist, WorkBook.DoesNotExist) as e:
+            raise CommandError(e)
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,45 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from visitorManagement.mapi.importer import prepare_import, run_import, file_checksum, VisitorImportError
+from visitorManagement.mapi.models import WorkBook, VisitorImport
+
+
+class Command(BaseCommand):
+    help = ('Imports a csv or xlsx visitor register into a workbook. Importing the same file again '
+            'resumes an import that failed, a finished one is not redone.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Register file, .csv or .xlsx with a header row')
+        parser.add_argument('--workbook', type=int, required=True, help='Workbook id')
+        parser.add_argument('--batch-size', type=int, help='Rows per transaction, MAPI_IMPORT_BATCH_SIZE by default')
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(options['path'])
+        try:
+            workbook = WorkBook.objects.get(id=options['workbook'])
+            job = prepare_import(workbook.member, workbook, path, os.path.basename(path), file_checksum(path))
+        except (VisitorImportError, EnvironmentError, WorkBook.DoesNotExist) as e:
+            raise CommandError(e)
+
+        if job.status == VisitorImport.DONE:
+            self.stdout.write('%s was imported already, import %s' % (job.source, job.id))
+            return
+        if job.rows_done:
+            self.stdout.write('Resuming import %s after row %s' % (job.id, job.rows_done + 1))
+
+        def progress(job):
+            self.stdout.write('%s rows, %s inserted, %s rejected, %s rows/s' % (
+                job.rows_done, job.inserted, job.rejected, job.rows_per_second))
+
+        if not run_import(job, batch_size=options['batch_size'], progress=progress):
+            raise CommandError('Import %s is running already' % job.id)
+        if job.status == VisitorImport.FAILED:
+            raise CommandError('Import %s failed after %s rows: %s' % (job.id, job.rows_done, job.message))
+        self.stdout.write('Imported %s visits from %s rows in %.1fs, %s rows/s' % (
+            job.inserted, job.rows_done, job.seconds, job.rows_per_second))
+        if job.rejected:
+            self.stdout.write('Rejected %s rows:' % job.rejected)
+            for error in json.loads(job.errors):
+                self.stdout.write('  row %(row)s: %(message)s' % error)
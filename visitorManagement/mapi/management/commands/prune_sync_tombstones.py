@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from visitorManagement.mapi.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Deletes the sync tombstones older than MAPI_SYNC_TOMBSTONE_DAYS, older sync tokens get a full resync'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Pruned %s tombstones' % prune_tombstones())
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from visitorManagement.mapi.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the SearchView index of the configured MAPI_SEARCH_BACKEND from the Visitor table'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.rebuild()
+        self.stdout.write('Rebuilt %s' % backend.__class__.__name__)
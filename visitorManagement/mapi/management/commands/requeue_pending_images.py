@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from visitorManagement.mapi.images import requeue_pending_images, wait_for_pool
+
+
+class Command(BaseCommand):
+    help = 'Processes again the visitor images left pending longer than MAPI_IMAGE_PENDING_SECONDS by a lost job'
+
+    def handle(self, *args, **options):
+        requeued = requeue_pending_images()
+        wait_for_pool()
+        self.stdout.write('Requeued images of %s visitors' % requeued)
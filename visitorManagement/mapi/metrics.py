@@ -0,0 +1,204 @@
+"""
+Per endpoint request metrics for the mapi views, served in the Prometheus text
+format at /mapi/metrics.
+
+MapiMetricsMiddleware times every request routed to a BaseMapiView and counts
+the queries of MAPI_METRICS_DB_SAMPLE_RATE of them, BaseMapiView.dispatch and render_to_response add the time spent in
+the view and in json serialisation. Endpoints are labelled <view class>.<method>,
+so the label set stays bounded whatever paths clients request.
+
+Metrics live in the memory of the serving process, each worker of a multi
+process server exposes its own, scrape them per worker or aggregate upstream.
+"""
+import bisect
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+RESPONSE_BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_local = threading.local()
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, self.label_pairs(label_values), value
+
+    def label_pairs(self, label_values, extra=()):
+        return tuple(zip(self.labels, label_values)) + tuple(extra)
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels, buckets):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, label_values, value):
+        entry = self.values.get(label_values)
+        if entry is None:
+            # per bucket counts (last one is +Inf), sum
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (self.name + '_bucket', self.label_pairs(label_values, [('le', format_value(bound))]),
+                       cumulative)
+            yield self.name + '_sum', self.label_pairs(label_values), total
+            yield self.name + '_count', self.label_pairs(label_values), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        with self.lock:
+            for metric in self.metrics:
+                metric.values.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+                for name, label_pairs, value in metric.samples():
+                    labels = ','.join('%s="%s"' % (label, escape_label(label_value))
+                                      for label, label_value in label_pairs)
+                    lines.append('%s{%s} %s' % (name, labels, format_value(value)) if labels else
+                                 '%s %s' % (name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+requests_total = registry.add(Counter(
+    'mapi_requests_total', 'Requests per endpoint and HTTP status', ('endpoint', 'code')))
+request_duration = registry.add(Histogram(
+    'mapi_request_duration_seconds', 'Time from the first to the last middleware', ('endpoint',),
+    LATENCY_BUCKETS))
+view_duration = registry.add(Histogram(
+    'mapi_view_duration_seconds', 'Time spent in the view, authentication excluded', ('endpoint',),
+    LATENCY_BUCKETS))
+serialization_duration = registry.add(Histogram(
+    'mapi_serialization_duration_seconds', 'Time spent serialising the response payload', ('endpoint',),
+    LATENCY_BUCKETS))
+db_queries = registry.add(Histogram(
+    'mapi_db_queries', 'Database queries per sampled request', ('endpoint',), QUERY_COUNT_BUCKETS))
+db_duration = registry.add(Counter(
+    'mapi_db_duration_seconds_total', 'Time spent in database queries of sampled requests', ('endpoint',)))
+response_bytes = registry.add(Histogram(
+    'mapi_response_bytes', 'Response body size, streamed responses excluded', ('endpoint',),
+    RESPONSE_BYTES_BUCKETS))
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.endpoint = None
+        self.view_time = None
+        self.serialization_time = 0.0
+        self.debug_cursors = {}
+
+
+def current():
+    """
+    RequestStats of the request this thread is serving, None outside of MapiMetricsMiddleware
+    """
+    return getattr(_local, 'stats', None)
+
+
+def add_serialization_time(seconds):
+    stats = current()
+    if stats is not None:
+        stats.serialization_time += seconds
+
+
+def add_view_time(seconds):
+    stats = current()
+    if stats is not None:
+        stats.view_time = seconds
+
+
+def count_queries():
+    # the debug cursor keeps every query of the request, only a sample of the requests pays for it
+    rate = getattr(settings, 'MAPI_METRICS_DB_SAMPLE_RATE', 0.01)
+    return rate >= 1 or random.random() < rate
+
+
+def start_request():
+    stats = _local.stats = RequestStats()
+    if count_queries():
+        # Django 1.9 has no execute hook, queries are timed by the debug cursor and
+        # queries_log is emptied at every request_started
+        for connection in connections.all():
+            stats.debug_cursors[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+    return stats
+
+
+def finish_request(response):
+    stats = current()
+    _local.stats = None
+    if stats is None:
+        return
+    query_count, query_time = 0, 0.0
+    for alias, force_debug_cursor in stats.debug_cursors.items():
+        connection = connections[alias]
+        connection.force_debug_cursor = force_debug_cursor
+        query_count += len(connection.queries_log)
+        query_time += sum(float(query['time']) for query in connection.queries_log)
+    if stats.endpoint is None:
+        return
+
+    labels = (stats.endpoint,)
+    with registry.lock:
+        requests_total.inc((stats.endpoint, str(response.status_code)))
+        request_duration.observe(labels, time.time() - stats.start)
+        if stats.view_time is not None:
+            view_duration.observe(labels, stats.view_time)
+        serialization_duration.observe(labels, stats.serialization_time)
+        if stats.debug_cursors:
+            db_queries.observe(labels, query_count)
+            db_duration.inc(labels, query_time)
+        if not response.streaming:
+            response_bytes.observe(labels, len(response.content))
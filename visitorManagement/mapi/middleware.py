@@ -0,0 +1,68 @@
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+from visitorManagement.mapi import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+re_accepts_brotli = re.compile(r'\bbr\b')
+
+
+class MapiMetricsMiddleware(object):
+    """
+    Records the metrics.py request metrics, list it first in MIDDLEWARE_CLASSES so the
+    latency covers the other middleware too
+    """
+    def process_request(self, request):
+        metrics.start_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        from visitorManagement.mapi.views import BaseMapiView
+        view_class = getattr(view_func, 'view_class', None)
+        stats = metrics.current()
+        if stats is not None and view_class is not None and issubclass(view_class, BaseMapiView):
+            stats.endpoint = '%s.%s' % (view_class.__name__, request.method.lower())
+
+    def process_response(self, request, response):
+        metrics.finish_request(response)
+        return response
+
+
+class MapiCompressionMiddleware(object):
+    """
+    Compresses mapi responses of at least MAPI_COMPRESS_MIN_BYTES with brotli, when the
+    brotli module is installed and the client accepts it, or gzip. Streamed responses are
+    left alone, they are flushed as they are generated.
+    """
+    def process_response(self, request, response):
+        if (response.streaming or response.has_header('Content-Encoding') or
+                not request.path_info.startswith('/mapi/') or
+                len(response.content) < getattr(settings, 'MAPI_COMPRESS_MIN_BYTES', 1024)):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is not None and re_accepts_brotli.search(accept_encoding):
+            encoding, content = 'br', brotli.compress(response.content,
+                                                      quality=getattr(settings, 'MAPI_BROTLI_QUALITY', 5))
+        elif re_accepts_gzip.search(accept_encoding):
+            encoding, content = 'gzip', compress_string(response.content)
+        else:
+            return response
+        if len(content) >= len(response.content):
+            return response
+
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+            # the body differs per encoding, a strong ETag would not
+            response['ETag'] = 'W/' + response['ETag']
+        return response
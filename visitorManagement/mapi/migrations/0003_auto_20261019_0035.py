@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 00:35
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0002_auto_20161031_1119'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='visitor',
+            index_together=set([('workbook', 'in_time', 'out_time'), ('member', 'mobile_no'), ('member', 'vehicle_no')]),
+        ),
+    ]
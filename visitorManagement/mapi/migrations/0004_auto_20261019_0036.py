@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 00:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_name_key(apps, schema_editor):
+    Visitor = apps.get_model('mapi', 'Visitor')
+    for name in Visitor.object.order_by().values_list('name', flat=True).distinct().iterator():
+        Visitor.object.filter(name=name).update(name_key=u' '.join(name.split()).lower() if name else u'')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0003_auto_20261019_0035'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitor',
+            name='name_key',
+            field=models.CharField(default=b'', editable=False, max_length=100),
+        ),
+        migrations.AlterIndexTogether(
+            name='visitor',
+            index_together=set([('member', 'name_key'), ('workbook', 'in_time', 'out_time'), ('member', 'mobile_no'), ('member', 'vehicle_no')]),
+        ),
+        migrations.RunPython(fill_name_key, migrations.RunPython.noop),
+    ]
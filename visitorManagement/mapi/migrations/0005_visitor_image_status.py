@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 00:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0004_auto_20261019_0036'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitor',
+            name='image_status',
+            field=models.SmallIntegerField(choices=[(1, b'Ready'), (2, b'Pending'), (3, b'Failed')], default=1, editable=False),
+        ),
+    ]
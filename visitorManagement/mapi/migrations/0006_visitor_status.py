@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 00:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def close_past_visits(apps, schema_editor):
+    # before check-out existed a visit was active only within its in_time / out_time window
+    Visitor = apps.get_model('mapi', 'Visitor')
+    Visitor.object.filter(models.Q(out_time__isnull=True) | models.Q(out_time__lt=timezone.now())).update(status=2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0005_visitor_image_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitor',
+            name='status',
+            field=models.SmallIntegerField(choices=[(1, b'Open'), (2, b'Closed')], default=1, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='visitor',
+            index_together=set([('status', 'out_time'), ('workbook', 'in_time', 'out_time'), ('workbook', 'status', 'in_time'), ('member', 'mobile_no'), ('member', 'name_key'), ('member', 'vehicle_no')]),
+        ),
+        migrations.RunPython(close_past_visits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 01:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0008_visitor_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visitor_id', models.IntegerField()),
+                ('change_seq', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='visitor',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workbook',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='visitor',
+            index_together=set([('status', 'out_time'), ('workbook', 'in_time', 'out_time'), ('workbook', 'status', 'in_time'), ('workbook', 'change_seq'), ('member', 'mobile_no'), ('member', 'name_key'), ('member', 'vehicle_no')]),
+        ),
+        migrations.AddField(
+            model_name='visitortombstone',
+            name='workbook',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='mapi.WorkBook'),
+        ),
+        migrations.AlterIndexTogether(
+            name='visitortombstone',
+            index_together=set([('workbook', 'change_seq')]),
+        ),
+    ]
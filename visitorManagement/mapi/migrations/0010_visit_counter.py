@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 01:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0009_visitor_change_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('hour', models.SmallIntegerField()),
+                ('visits', models.PositiveIntegerField(default=0)),
+                ('workbook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mapi.WorkBook')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='visitcounter',
+            unique_together=set([('workbook', 'day', 'hour')]),
+        ),
+    ]
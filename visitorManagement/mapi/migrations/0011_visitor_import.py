@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 01:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0010_visit_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('path', models.CharField(max_length=500)),
+                ('checksum', models.CharField(max_length=40)),
+                ('status', models.SmallIntegerField(choices=[(1, b'Pending'), (2, b'Running'), (3, b'Done'), (4, b'Failed')], default=1)),
+                ('rows_done', models.PositiveIntegerField(default=0)),
+                ('inserted', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('errors', models.TextField(default=b'[]')),
+                ('message', models.CharField(blank=True, default=b'', max_length=255)),
+                ('seconds', models.FloatField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mapi.Member')),
+                ('workbook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mapi.WorkBook')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='visitorimport',
+            index_together=set([('workbook', 'checksum')]),
+        ),
+    ]
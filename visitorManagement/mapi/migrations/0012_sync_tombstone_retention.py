@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-19 01:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapi', '0011_visitor_import'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitortombstone',
+            name='deleted',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='workbook',
+            name='min_sync_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
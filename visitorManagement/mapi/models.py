@@ -1,14 +1,20 @@
-from django.db import models
+from django.db import models, router, transaction, DatabaseError, IntegrityError
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
+from django.dispatch import Signal
 from visitorManagement.mapi.utils import save_image_to_s3
 # from boto.s3.connection import S3Connection
 # from boto.s3.key import Key
 import datetime
+from collections import Counter
 from django.utils import timezone
 import logging
 
 
+# sent once a transaction that changed visitors of the workbook is committed, change_seq is the last it took
+workbook_changed = Signal(providing_args=['workbook_id', 'change_seq'])
+
+
 class Member(models.Model):
     email = models.EmailField(_('Email Address'), unique=True)
     password = models.CharField(max_length=128)
@@ -17,10 +23,19 @@ class Member(models.Model):
     mobile_no = models.CharField(_("Mobile Number"), max_length=13)
     address = models.TextField(max_length=250)
     package = models.CharField(max_length=20)
+    token_generation = models.PositiveIntegerField(default=0, editable=False)  # bumped to revoke all tokens
 
     def __unicode__(self):
         return '%s' % self.email
 
+    def save(self, *args, **kwargs):
+        if self.pk:
+            stored = Member.objects.filter(pk=self.pk).values('password', 'is_active').first()
+            if stored and (stored['password'] != self.password or stored['is_active'] != self.is_active):
+                # auth tokens don't carry the password, changing it or deactivating revokes them this way
+                self.token_generation += 1
+        super(Member, self).save(*args, **kwargs)
+
 
 class WorkBookType(models.Model):
     type = models.CharField(max_length=50, unique=True)
@@ -47,10 +62,22 @@ class WorkBook(models.Model):
     wb_name = models.CharField(max_length=50)
     wb_type = models.ForeignKey(WorkBookType, editable=False)
     member = models.ForeignKey(Member, editable=False)
+    change_seq = models.BigIntegerField(default=0, editable=False)  # last Visitor.change_seq handed out
+    # sync tokens below it are answered with a full resync, the tombstones up to it are pruned
+    min_sync_seq = models.BigIntegerField(default=0, editable=False)
 
     def __unicode__(self):
         return '%s' % self.wb_name
 
+    def save(self, *args, **kwargs):
+        stored = not self._state.adding and kwargs.get('using', self._state.db) == self._state.db
+        if stored and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            # change_seq and min_sync_seq are only moved by VisitorManager.allocate_change_seqs and
+            # sync.prune_tombstones, never written back stale
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in ('change_seq', 'min_sync_seq')]
+        super(WorkBook, self).save(*args, **kwargs)
+
 '''
     def save(self, force_insert=False, force_update=False, using=None):
         super(WorkBook, self).save(force_insert, force_update, using)
@@ -67,14 +94,135 @@ class WorkBook(models.Model):
 
 class VisitorManager(models.Manager):
     def get_all_active_visitor(self, workbook, name=None, exclude_time=False):
-        current_datetime = timezone.now()
+        return self.get_active_visitor_queryset(workbook, name=name, exclude_time=exclude_time).values()
+
+    def get_active_visitor_queryset(self, workbook, name=None, exclude_time=False):
         if name or exclude_time:
             if name:
-                return self.filter(workbook=workbook, name=name).values()
+                return self.filter(workbook=workbook, name=name)
             if exclude_time:
-                return self.filter(workbook=workbook).values()
+                return self.filter(workbook=workbook)
+
+        # visitors on premises are the open visits, checked in and not checked out yet, an index range
+        # on (workbook, status). out_time is only shown: a visit without one or past it is still open.
+        return self.filter(workbook=workbook, status=self.model.OPEN)
+
+    def check_out(self, visitor_id, member, out_time=None):
+        """
+        Closes an open visit, returns False when member has no open visit with that id.
+        A conditional update, so two check-outs racing each other close it once.
+        """
+        return bool(self.update_changed(self.filter(id=visitor_id, member=member, status=self.model.OPEN),
+                                        status=self.model.CLOSED, out_time=out_time or timezone.now()))
+
+    def close_expired(self, now=None):
+        """
+        Closes open visits whose out_time, as predicted at check-in, has passed. For desks that
+        never call check-out, the visitor listing doesn't depend on it being run.
+        """
+        return self.update_changed(self.filter(status=self.model.OPEN, out_time__lt=now or timezone.now()),
+                                   status=self.model.CLOSED)
+
+    def allocate_change_seqs(self, workbook_id, count=1, using=None):
+        """
+        Reserves count change sequence numbers of the workbook and returns the first.
+        The update locks the workbook row until the caller's transaction ends, so
+        changes of a workbook become visible in change_seq order.
+        """
+        using = using or router.db_for_write(WorkBook)
+        workbooks = WorkBook.objects.using(using).filter(id=workbook_id)
+        workbooks.update(change_seq=models.F('change_seq') + count)
+        change_seq = workbooks.values_list('change_seq', flat=True).get()
+        transaction.on_commit(lambda: workbook_changed.send(sender=Visitor, workbook_id=workbook_id,
+                                                            change_seq=change_seq), using=using)
+        return change_seq - count + 1
+
+    def update_changed(self, queryset, **values):
+        """
+        queryset.update(**values) that also gives the updated rows a new change_seq, for the sync endpoint
+        """
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            updated = 0
+            workbook_ids = sorted(set(queryset.using(using).order_by().values_list('workbook_id', flat=True)))
+            for workbook_id in workbook_ids:
+                updated += queryset.using(using).filter(workbook_id=workbook_id).update(
+                    change_seq=self.allocate_change_seqs(workbook_id, using=using), **values)
+            return updated
+
+    def keyset_page(self, queryset, after=None):
+        """
+        Orders queryset on (in_time, id) and skips everything up to and including
+        the `after` cursor, a (in_time, id) tuple as returned by decode_cursor.
+        in_time is nullable and NULLs sort first, so a NULL cursor still has
+        every non NULL row ahead of it.
+        """
+        queryset = queryset.order_by('in_time', 'id')
+        if after is None:
+            return queryset
+
+        in_time, visitor_id = after
+        if in_time is None:
+            return queryset.filter(models.Q(in_time__isnull=True, id__gt=visitor_id) |
+                                   models.Q(in_time__isnull=False))
+        return queryset.filter(models.Q(in_time__gt=in_time) | models.Q(in_time=in_time, id__gt=visitor_id))
 
-        return self.filter(workbook=workbook, in_time__lte=current_datetime, out_time__gte=current_datetime).values()
+    def autocomplete(self, member, prefix, limit=5):
+        """
+        Distinct (name, workbook_id) of member's visitors whose name starts with prefix,
+        as an index range scan on (member, name_key) with the limit done in the query.
+        Runs of spaces match one, a trailing space ends the word: "ravi " doesn't match Ravindra.
+        """
+        ends_word = prefix[-1:].isspace()
+        prefix = self.model.normalize_name(prefix)
+        if prefix and ends_word:
+            prefix += u' '
+        queryset = self.filter(member=member)
+        if prefix:
+            # successor of the prefix is the exclusive upper bound of the range
+            queryset = queryset.filter(name_key__gte=prefix,
+                                       name_key__lt=prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+        return queryset.order_by('name_key').values_list('name', 'workbook_id').distinct()[:limit]
+
+    def bulk_insert(self, visitors, batch_size=100):
+        """
+        bulk_create that also sets the derived fields and the ids of visitors, which Django 1.9
+        doesn't hand back. Each visitor is given its change_seq before the insert, unique in its
+        workbook, the ids are read back by (workbook, change_seq) on that index.
+        """
+        if not visitors:
+            return visitors
+        for visitor in visitors:
+            visitor.set_derived_fields()
+
+        workbook_visitors = {}
+        for visitor in visitors:
+            workbook_visitors.setdefault(visitor.workbook_id, []).append(visitor)
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            first_seqs = {}
+            for workbook_id in sorted(workbook_visitors):
+                # also locks the workbook row, no other save takes these change_seqs
+                first_seqs[workbook_id] = self.allocate_change_seqs(workbook_id, len(workbook_visitors[workbook_id]),
+                                                                    using=using)
+                for offset, visitor in enumerate(workbook_visitors[workbook_id]):
+                    visitor.change_seq = first_seqs[workbook_id] + offset
+            self.using(using).bulk_create(visitors, batch_size=batch_size)
+            VisitCounter.objects.add_visits(visitors, using=using)
+
+            for workbook_id, first_seq in first_seqs.items():
+                inserted = workbook_visitors[workbook_id]
+                visitor_ids = dict(self.using(using).filter(workbook_id=workbook_id,
+                                                            change_seq__range=(first_seq,
+                                                                               first_seq + len(inserted) - 1))
+                                   .values_list('change_seq', 'id'))
+                if len(visitor_ids) != len(inserted):
+                    raise DatabaseError('Unable to read back the ids of the bulk inserted visitors')
+                for visitor in inserted:
+                    visitor.id = visitor_ids[visitor.change_seq]
+                    visitor._state.adding = False
+                    visitor._state.db = using
+        return visitors
 
     def get_all_field_names(self):
         names = list()
@@ -85,7 +233,7 @@ class VisitorManager(models.Manager):
             if field.model != self.model and field.model._meta.concrete_model == self.concrete_model:
                 continue
 
-            if field.name in ['workbook', 'id', 'member']:
+            if field.name in ['workbook', 'id', 'member', 'name_key', 'image_status', 'status', 'change_seq']:
                 continue
             if hasattr(field, 'attname'):
                 names.append(field.attname)
@@ -93,7 +241,27 @@ class VisitorManager(models.Manager):
 
 
 class Visitor(models.Model):
+
+    IMAGES_READY = 1
+    IMAGES_PENDING = 2
+    IMAGES_FAILED = 3
+
+    IMAGE_STATUS = (
+        (IMAGES_READY, 'Ready'),
+        (IMAGES_PENDING, 'Pending'),
+        (IMAGES_FAILED, 'Failed'),
+    )
+
+    OPEN = 1
+    CLOSED = 2
+
+    STATUS = (
+        (OPEN, 'Open'),
+        (CLOSED, 'Closed'),
+    )
+
     name = models.CharField(max_length=100, db_index=True)
+    name_key = models.CharField(max_length=100, editable=False, default='')  # normalize_name(name), for search-tc
     mobile_no = models.CharField(_("Mobile Number"), max_length=13, blank=True, null=True)
     vehicle_no = models.CharField(_("Vehicle Number"), max_length=20, blank=True, null=True)
     from_place = models.CharField(max_length=50, blank=True, null=True)
@@ -104,9 +272,37 @@ class Visitor(models.Model):
     signature = models.ImageField(upload_to='uploads/signature_photos', blank=True, null=True) # todo change to media/uploads
     workbook = models.ForeignKey(WorkBook, null=False, blank=False) #editable=False
     member = models.ForeignKey(Member, null=True) # editable=False
+    image_status = models.SmallIntegerField(choices=IMAGE_STATUS, default=IMAGES_READY, editable=False)
+    status = models.SmallIntegerField(choices=STATUS, default=OPEN, editable=False)  # CLOSED once checked out
+    change_seq = models.BigIntegerField(default=0, editable=False)  # position in the workbook's change log
 
     object = VisitorManager()
 
+    class Meta:
+        # match the get_all_active_visitor and SearchView lookups
+        index_together = (
+            ('workbook', 'in_time', 'out_time'),
+            ('member', 'mobile_no'),
+            ('member', 'vehicle_no'),
+            ('member', 'name_key'),
+            ('workbook', 'status', 'in_time'),
+            ('status', 'out_time'),
+            ('workbook', 'change_seq'),
+        )
+
+    @staticmethod
+    def normalize_name(name):
+        return u' '.join(name.split()).lower() if name else u''
+
+    def set_derived_fields(self):
+        """
+        Columns computed from the others, for save() and bulk_insert
+        """
+        self.name_key = Visitor.normalize_name(self.name)
+        if self._state.adding and self.out_time and self.out_time < timezone.now():
+            # a visit logged after the fact is already over
+            self.status = Visitor.CLOSED
+
     @property
     def is_live(self):
         current_datetime = timezone.now()
@@ -114,7 +310,16 @@ class Visitor(models.Model):
         return self.in_time < current_datetime < self.out_time
 
     def save(self, force_insert=False, force_update=False, using=None):
-        super(Visitor, self).save(force_insert, force_update, using)
+        self.set_derived_fields()
+        using = using or router.db_for_write(Visitor, instance=self)
+        adding = self._state.adding
+        with transaction.atomic(using=using):
+            # holds the workbook row until commit: saves of a workbook commit in change_seq order, so a sync
+            # token never passes a change still to commit. The hour's VisitCounter row serializes them as well.
+            self.change_seq = Visitor.object.allocate_change_seqs(self.workbook_id, using=using)
+            super(Visitor, self).save(force_insert, force_update, using)
+            if adding:
+                VisitCounter.objects.add_visits([self], using=using)
         # photo_file = self.photo.file
         # photo_file.seek(0)
 
@@ -130,6 +335,128 @@ class Visitor(models.Model):
             save_image_to_s3(key, signature_file)
         '''
 
+class VisitCounterManager(models.Manager):
+    def add_visits(self, visitors, using=None):
+        """
+        Counts visitors in the (workbook, day, hour) of their in_time, one update per bucket.
+        Visitors without an in_time have no bucket and are not counted.
+        """
+        buckets = Counter(VisitCounter.bucket(visitor.workbook_id, visitor.in_time)
+                          for visitor in visitors if visitor.in_time is not None)
+        using = using or router.db_for_write(VisitCounter)
+        for (workbook_id, day, hour), visits in sorted(buckets.items()):
+            counters = self.using(using).filter(workbook_id=workbook_id, day=day, hour=hour)
+            if counters.update(visits=models.F('visits') + visits):
+                continue
+            try:
+                with transaction.atomic(using=using):
+                    self.using(using).create(workbook_id=workbook_id, day=day, hour=hour, visits=visits)
+            except IntegrityError:
+                # the first visit of the hour was counted concurrently
+                counters.update(visits=models.F('visits') + visits)
+
+
+class VisitCounter(models.Model):
+    """
+    Visits per workbook and hour of their in_time, for the analytics endpoint, see mapi/analytics.py
+    """
+    workbook = models.ForeignKey(WorkBook)
+    day = models.DateField()
+    hour = models.SmallIntegerField()
+    visits = models.PositiveIntegerField(default=0)
+
+    objects = VisitCounterManager()
+
+    class Meta:
+        unique_together = (
+            ('workbook', 'day', 'hour'),
+        )
+
+    @staticmethod
+    def bucket(workbook_id, in_time):
+        if settings.USE_TZ and timezone.is_aware(in_time):
+            in_time = timezone.localtime(in_time)
+        return workbook_id, in_time.date(), in_time.hour
+
+
+class VisitorTombstone(models.Model):
+    """
+    A deleted Visitor, kept so sync clients drop it too
+    """
+    # no constraint, the workbook may be deleted along with its visitors
+    workbook = models.ForeignKey(WorkBook, db_constraint=False, on_delete=models.DO_NOTHING)
+    visitor_id = models.IntegerField()
+    change_seq = models.BigIntegerField()
+    deleted = models.DateTimeField(default=timezone.now, db_index=True)  # pruned after MAPI_SYNC_TOMBSTONE_DAYS
+
+    class Meta:
+        index_together = (
+            ('workbook', 'change_seq'),
+        )
+
+
+class VisitorImport(models.Model):
+    """
+    An import_visitors run of a register file into a workbook, rows_done is its checkpoint, see mapi/importer.py
+    """
+    PENDING = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATUS = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    workbook = models.ForeignKey(WorkBook)
+    member = models.ForeignKey(Member)
+    source = models.CharField(max_length=255)  # file name as uploaded
+    path = models.CharField(max_length=500)  # where the file is read from
+    checksum = models.CharField(max_length=40)  # sha1 of the file, the same file resumes this import
+    status = models.SmallIntegerField(choices=STATUS, default=PENDING)
+    rows_done = models.PositiveIntegerField(default=0)  # data rows committed, inserted or rejected
+    inserted = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    errors = models.TextField(default='[]')  # json list of the first rejected rows, {"row": .., "message": ..}, the header is row 1
+    message = models.CharField(max_length=255, blank=True, default='')
+    seconds = models.FloatField(default=0)  # spent importing, over all runs
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        index_together = (
+            ('workbook', 'checksum'),
+        )
+
+    def __unicode__(self):
+        return '%s' % self.source
+
+    @property
+    def rows_per_second(self):
+        return int(self.rows_done / self.seconds) if self.seconds else 0
+
+
+class VisitorArchive(models.Model):
+    """
+    Catalog of the archive files of mapi/archive.py, one per member, month and archive batch
+    """
+    member = models.ForeignKey(Member, null=True)
+    month = models.DateField()  # first day of the month the archived visits came in
+    path = models.CharField(max_length=255)  # relative to MAPI_ARCHIVE_ROOT
+    rows = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (
+            ('member', 'month'),
+        )
+
+    def __unicode__(self):
+        return '%s' % self.path
+
 '''
 class WorkBookTypeOptions():
     def add_to_query(self, query, aliases):
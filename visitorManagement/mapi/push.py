@@ -0,0 +1,207 @@
+"""
+Change notifications for the visitor-events (Server-Sent Events) and sync?wait=
+(long-poll) endpoints.
+
+Every committed Visitor change sends workbook_changed with the workbook's new
+change_seq, the hub of the process passes it on to the desks waiting on that
+workbook. A woken desk reads what changed through sync.workbook_changes, the
+rows and token the sync endpoint sends, so no check-out or deletion made while
+it was reconnecting is missed. The desks woken by the same change share one
+read of it (shared_changes), a check-in costs the same queries however many
+desks watch the workbook.
+
+A waiting desk costs no query and, its database connection closed meanwhile,
+no connection: it blocks on a per workbook Condition without a timeout (Python
+2's timed waits poll) and a single ticker thread wakes the waiters every
+MAPI_PUSH_TICK seconds to check their deadlines. The hub only hears of the
+changes its own process commits, so with several worker processes a waiting
+desk also reads its workbook's change_seq, a primary key lookup, every
+MAPI_PUSH_RECHECK_SECONDS; None skips that on a single process server.
+
+Each open stream holds a server thread for up to MAPI_PUSH_STREAM_SECONDS,
+Django 1.9 has no ASGI support: serve the push endpoints from gevent workers
+(gunicorn -k gevent), or threaded ones with threads to spare. A process serves
+at most MAPI_PUSH_MAX_STREAMS streams (stream_slots), above it visitor-events
+answers 503 and desks long-poll sync?wait= instead, a thread held for one
+wait at most.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.dispatch import receiver
+
+from visitorManagement.mapi.models import WorkBook, workbook_changed
+from visitorManagement.mapi.utils import ExpiringLRUCache
+
+
+class Hub(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = {}  # workbook id -> [Condition, number of waiters]
+        self.change_seqs = {}  # workbook id -> last change_seq published
+        self.ticker = None
+
+    def publish(self, workbook_id, change_seq):
+        with self.lock:
+            if change_seq > self.change_seqs.get(workbook_id, 0):
+                self.change_seqs[workbook_id] = change_seq
+            entry = self.waiting.get(workbook_id)
+            if entry is not None:
+                entry[0].notify_all()
+
+    def wait(self, workbook_id, after, timeout):
+        """
+        Blocks until a change_seq above `after` is published for the workbook, returns it,
+        or None once timeout seconds (rounded up to the tick) have passed
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            entry = self.waiting.get(workbook_id)
+            if entry is None:
+                entry = self.waiting[workbook_id] = [threading.Condition(self.lock), 0]
+            entry[1] += 1
+            self.start_ticker()
+            try:
+                while self.change_seqs.get(workbook_id, 0) <= after and time.time() < deadline:
+                    entry[0].wait()
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.waiting[workbook_id]
+            change_seq = self.change_seqs.get(workbook_id, 0)
+            return change_seq if change_seq > after else None
+
+    def start_ticker(self):
+        if self.ticker is None:
+            self.ticker = threading.Thread(target=self.tick, name='mapi-push-ticker')
+            self.ticker.daemon = True
+            self.ticker.start()
+
+    def tick(self):
+        while True:
+            time.sleep(getattr(settings, 'MAPI_PUSH_TICK', 5))
+            with self.lock:
+                if not self.waiting:
+                    self.ticker = None
+                    return
+                for condition, waiters in self.waiting.values():
+                    condition.notify_all()
+
+    def waiters(self):
+        with self.lock:
+            return sum(waiters for condition, waiters in self.waiting.values())
+
+
+hub = Hub()
+
+
+class StreamSlots(object):
+    """
+    Counts the event streams open in the process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+
+    def acquire(self):
+        limit = getattr(settings, 'MAPI_PUSH_MAX_STREAMS', 16)
+        with self.lock:
+            if limit is not None and self.open >= limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+
+stream_slots = StreamSlots()
+
+
+class SlotStream(object):
+    """
+    Streaming content that gives its stream slot back when the response is closed,
+    whether or not it was iterated
+    """
+    def __init__(self, content):
+        self.content = content
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        try:
+            if hasattr(self.content, 'close'):
+                self.content.close()
+        finally:
+            if not self.released:
+                self.released = True
+                stream_slots.release()
+
+
+@receiver(workbook_changed)
+def publish_change(sender, workbook_id, change_seq, **kwargs):
+    hub.publish(workbook_id, change_seq)
+
+
+recent_changes = ExpiringLRUCache(max_size=1024, ttl=60)
+_fetch_locks = {}
+_fetch_locks_lock = threading.Lock()
+
+
+def shared_changes(workbook, since, get_changes):
+    """
+    get_changes(workbook, since), run once for all the desks of the workbook asking
+    from the same token up to the same workbook.change_seq
+    """
+    key = (workbook.id, since, workbook.change_seq)
+    changes = recent_changes.get(key)
+    if changes is None:
+        with _fetch_locks_lock:
+            lock = _fetch_locks.setdefault(key, threading.Lock())
+        with lock:
+            changes = recent_changes.get(key)
+            if changes is None:
+                changes = get_changes(workbook, since)
+                recent_changes.set(key, changes)
+        with _fetch_locks_lock:
+            _fetch_locks.pop(key, None)
+    return changes
+
+
+def current_change_seq(workbook_id):
+    return WorkBook.objects.filter(id=workbook_id).values_list('change_seq', flat=True).get()
+
+
+def release_connections():
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def wait_for_change(workbook_id, after, timeout):
+    """
+    Waits up to timeout seconds for the workbook to change after the change_seq `after`,
+    returns its change_seq then, None if it did not change. A change published in this
+    process is returned without a query.
+    """
+    recheck = getattr(settings, 'MAPI_PUSH_RECHECK_SECONDS', 15)
+    deadline = time.time() + timeout
+    release_connections()
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        change_seq = hub.wait(workbook_id, after, min(remaining, recheck or remaining))
+        if change_seq is not None:
+            return change_seq
+        if recheck is not None:
+            # changed by another process
+            change_seq = current_change_seq(workbook_id)
+            release_connections()
+            if change_seq > after:
+                return change_seq
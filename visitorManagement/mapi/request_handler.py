@@ -1,14 +1,108 @@
 from django.http import HttpResponse, HttpResponseForbidden, HttpRequest, HttpResponseNotAllowed
-from django.http import HttpResponse
-from visitorManagement.mapi.utils import base64_safe_decode
+from visitorManagement.mapi.utils import base64_safe_decode, ExpiringLRUCache
 from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 import hmac
 import json
 from visitorManagement.mapi.models import Member
+from visitorManagement.mapi.routers import set_current_member
 import functools
 from django.http import Http404
 from visitorManagement.mapi.utils import MapiErrorCodes
 import os, time
+import threading
+import base64
+import hashlib
+from django.core.cache import cache
+from django.db.models import F
+
+# Member id -> Member, token checks on a hit need no database read. v1 tokens are checked against the
+# cached member's token_generation and is_active. A member saved or logged out everywhere is dropped here
+# at once, and from the other workers' caches through the log of RevokedTokens within its refresh.
+verified_token_cache = ExpiringLRUCache(max_size=getattr(settings, 'MAPI_TOKEN_CACHE_SIZE', 1024),
+                                        ttl=getattr(settings, 'MAPI_TOKEN_CACHE_TTL', 600))
+
+TOKEN_VERSION = '1'
+
+
+class RevokedTokens(object):
+    """
+    Nonces of the tokens revoked by a logout, until their expiry. Looked up in memory,
+    every revocation is also appended to a log in CACHES which each process reads at most
+    every `refresh` seconds, so with a shared cache (memcached, redis) a logout reaches
+    every worker within that time. The log also carries the ids of the members changed
+    (password, deactivation, logout everywhere), which are dropped from `members`.
+    """
+    SEQUENCE_KEY = 'mapi:revoked-tokens:sequence'
+    ENTRY_KEY = 'mapi:revoked-tokens:%s'
+
+    def __init__(self, members, refresh=5):
+        self.members = members
+        self.refresh = refresh
+        self.expiries = {}
+        self.seen = 0
+        self.synced_at = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, nonce):
+        now = self.sync_if_due()
+        expiry = self.expiries.get(nonce)
+        return expiry is not None and expiry > now
+
+    def add(self, nonce, expiry):
+        now = time.time()
+        if expiry <= now:
+            return
+        self.append(('token', nonce, expiry), int(expiry - now) + 1)
+        with self.lock:
+            self.expiries[nonce] = expiry
+
+    def add_member(self, member_id):
+        """
+        Tells every process to drop its cached copy of the member, this one included
+        """
+        self.members.delete(member_id)
+        # older copies expire from the caches by themselves after the ttl
+        self.append(('member', member_id), self.members.ttl + self.refresh)
+
+    def append(self, entry, timeout):
+        cache.add(self.SEQUENCE_KEY, 0, None)
+        sequence = cache.incr(self.SEQUENCE_KEY)
+        cache.set(self.ENTRY_KEY % sequence, entry, timeout)
+
+    def sync_if_due(self):
+        now = time.time()
+        if now - self.synced_at >= self.refresh:
+            self.sync(now)
+        return now
+
+    def sync(self, now):
+        sequence = cache.get(self.SEQUENCE_KEY) or 0
+        with self.lock:
+            if sequence < self.seen:
+                # the log was evicted and started over, member changes may be lost with it
+                self.seen = 0
+                self.members.clear()
+            keys = [self.ENTRY_KEY % i for i in range(self.seen + 1, sequence + 1)]
+            for entry in (cache.get_many(keys) if keys else {}).values():
+                if entry[0] == 'member':
+                    self.members.delete(entry[1])
+                else:
+                    nonce, expiry = entry[-2:]
+                    self.expiries[nonce] = expiry
+            self.expiries = dict((nonce, expiry) for nonce, expiry in self.expiries.items() if expiry > now)
+            self.seen = max(self.seen, sequence)
+            self.synced_at = now
+
+    def clear(self):
+        with self.lock:
+            self.expiries = {}
+            self.synced_at = 0
+
+
+revoked_tokens = RevokedTokens(verified_token_cache, refresh=getattr(settings, 'MAPI_TOKEN_REVOCATION_REFRESH', 5))
 
 
 def validate_request(request, optional=False):
@@ -44,9 +138,55 @@ def validate_request(request, optional=False):
 
 def verify_token(token):
     """
-    Takes a token and returns a Member object
+    Takes a token and returns a Member object.
+
+    v1 tokens are "1.<member id>.<token generation>.<expiry>.<nonce>.<signature>", signed
+    with HMAC-SHA256 of SECRET_KEY. Checking one takes no database read while its member is
+    in verified_token_cache. A token is rejected once it expired, once it was revoked by a
+    logout, or once the member's token_generation moved on (password change, deactivation,
+    logout everywhere).
+    Legacy '0' tokens are accepted until MAPI_LEGACY_TOKENS_UNTIL.
     """
-    member = None
+    if not token:
+        return None
+    if not token.startswith(TOKEN_VERSION + '.'):
+        return _verify_legacy_token(token)
+
+    fields = token.split('.')
+    if len(fields) != 6:
+        return None
+    version, member_id, generation, expiry, nonce, signature = fields
+    if not hmac.compare_digest(str(signature), sign_token('.'.join(fields[:5]))):
+        return None
+    try:
+        member_id, generation, expiry = int(member_id), int(generation), int(expiry)
+    except ValueError:
+        return None
+    if expiry < time.time() or nonce in revoked_tokens:
+        return None
+
+    member = get_member(member_id)
+    if member is None or not member.is_active or member.token_generation != generation:
+        return None
+    return member
+
+
+def get_member(member_id):
+    revoked_tokens.sync_if_due()
+    member = verified_token_cache.get(member_id)
+    if member is None:
+        try:
+            member = Member.objects.get(pk=member_id)
+        except Member.DoesNotExist:
+            return None
+        verified_token_cache.set(member_id, member)
+    return member
+
+
+def _verify_legacy_token(token):
+    legacy_until = getattr(settings, 'MAPI_LEGACY_TOKENS_UNTIL', None)
+    if legacy_until is not None and legacy_until < time.time():
+        return None
     try:
         decoded_token = token.decode('base64')
     except:
@@ -57,30 +197,56 @@ def verify_token(token):
         signature = decoded_token[1:17]
         data = decoded_token[17:]
         h = hmac.new(settings.SECRET_KEY, data)
-        computed_digest = h.digest()
-        if len(signature) != len(computed_digest):
+        if not hmac.compare_digest(signature, h.digest()):
             return None
-        else:
-            success = True
-            for a, b in zip(signature, computed_digest):
-                if a != b:
-                    success = False
-            if not success:
-                return None
         json_data = json.loads(data)
-        # token_time = json_data['time']
-        # expiry_time = token_time + (30 * 24 * 3600)  # One month
-        # if expiry_time > time.time():
-        #    return None
 
-        try:
-            member = Member.objects.get(pk=json_data['mid'])
-        except Member.DoesNotExist:
-            return member
+        member = get_member(json_data['mid'])
+        # token is revoked once member is deactivated or password is changed
+        if member is None or not member.is_active or member.password != json_data.get('password'):
+            return None
 
         return member
 
 
+def sign_token(payload):
+    digest = hmac.new(settings.SECRET_KEY, payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip('=')
+
+
+def revoke_token(token):
+    """
+    Revokes a single v1 token, see RevokedTokens
+    """
+    fields = token.split('.') if token else ()
+    if len(fields) != 6 or fields[0] != TOKEN_VERSION or not fields[3].isdigit():
+        return False
+    revoked_tokens.add(fields[4], int(fields[3]))
+    return True
+
+
+def revoke_member_tokens(member):
+    """
+    Revokes every v1 token of member, logout everywhere. Other processes stop
+    accepting them within MAPI_TOKEN_REVOCATION_REFRESH seconds.
+    """
+    Member.objects.filter(pk=member.pk).update(token_generation=F('token_generation') + 1)
+    invalidate_member_tokens(Member, member)
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def invalidate_member_tokens(sender, instance, **kwargs):
+    member_id = instance.pk
+    verified_token_cache.delete(member_id)
+    # once committed, or another worker could cache the old row again
+    transaction.on_commit(lambda: revoked_tokens.add_member(member_id))
+
+
+def get_token_cache_stats():
+    return verified_token_cache.stats()
+
+
 def mapi_authenticate(optional=False):
     """
     :param optional: boolean, indicates if login is optional or not.
@@ -101,6 +267,7 @@ def mapi_authenticate(optional=False):
             errors = validate_request(request, optional)
             if errors:
                 return errors
+            set_current_member(getattr(request, 'user', None))
             try:
                 response = fn(request, *args, **kwargs)
             except Exception as e:
@@ -119,7 +286,15 @@ def mapi_authenticate(optional=False):
     return decorator_maker
 
 
-def make_token(member):
+def make_token(member, lifetime=None):
+    if lifetime is None:
+        lifetime = getattr(settings, 'MAPI_TOKEN_LIFETIME', 30 * 24 * 3600)
+    payload = '.'.join([TOKEN_VERSION, str(member.pk), str(member.token_generation),
+                        str(int(time.time() + lifetime)), os.urandom(8).encode('hex')])
+    return '%s.%s' % (payload, sign_token(payload))
+
+
+def make_legacy_token(member):
     s = json.dumps({
         'chaff': os.urandom(10).encode('base64'),
         'time': time.time(),
@@ -130,4 +305,4 @@ def make_token(member):
     h = hmac.new(settings.SECRET_KEY, s)
     token = ('0' + h.digest() + s).encode('base64')
     token = token.replace('\n', '')
-    return token
\ No newline at end of file
+    return token
@@ -0,0 +1,94 @@
+"""
+Serialized response cache for the rarely changing get-workbook and
+get-workbook-type endpoints, kept in the Django cache (CACHES, local memory
+by default) along with an ETag so unchanged clients get a 304.
+
+get-workbook is cached per member and dropped when one of the member's
+WorkBooks is saved. Both endpoints embed WorkBookType data, so a WorkBookType
+save bumps a version that is part of every key.
+
+Those invalidations only reach the processes sharing the cache: with a
+per-process cache (LocMemCache, the default) entries are kept for
+MAPI_RESPONSE_CACHE_LOCAL_TIMEOUT seconds, other workers see a change
+after at most that. Configure a shared cache (memcached, redis) for the
+MAPI_RESPONSE_CACHE_TIMEOUT ones. The ETag is a hash of the content, a
+rebuilt but unchanged response still gets a 304. Only successful responses
+(HTTP 200 and status 0) are cached, an error is sent as built.
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponseNotModified
+
+from visitorManagement.mapi.models import WorkBook, WorkBookType
+from visitorManagement.mapi.utils import JSONResponse
+
+WORKBOOK_TYPES_VERSION_KEY = 'mapi:workbook-types:version'
+LOCAL_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache')
+
+
+def cache_timeout():
+    if settings.CACHES['default']['BACKEND'] in LOCAL_CACHE_BACKENDS:
+        return getattr(settings, 'MAPI_RESPONSE_CACHE_LOCAL_TIMEOUT', 10)
+    return getattr(settings, 'MAPI_RESPONSE_CACHE_TIMEOUT', 24 * 3600)
+
+
+def workbook_types_version():
+    version = cache.get(WORKBOOK_TYPES_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.add(WORKBOOK_TYPES_VERSION_KEY, version, None)
+    return version
+
+
+def workbook_cache_key(member_id):
+    return 'mapi:get-workbook:%s:%s' % (member_id, workbook_types_version())
+
+
+def workbook_type_cache_key():
+    return 'mapi:get-workbook-type:%s' % workbook_types_version()
+
+
+def cached_response(request, key, build_response):
+    """
+    Returns the cached content for key, building it with build_response() on a miss,
+    or a 304 when the client's If-None-Match still matches
+    """
+    entry = cache.get(key)
+    if entry is None:
+        response = build_response()
+        if response.status_code != 200 or json.loads(response.content).get('status') != 0:
+            # a transient error would be served for the whole timeout
+            return response
+        entry = ('"%s"' % hashlib.md5(response.content).hexdigest(), response.content)
+        cache.set(key, entry, cache_timeout())
+
+    etag, content = entry
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = JSONResponse(content)
+    response['ETag'] = etag
+    return response
+
+
+@receiver(post_save, sender=WorkBook)
+@receiver(post_delete, sender=WorkBook)
+def invalidate_workbooks(sender, instance, **kwargs):
+    cache.delete(workbook_cache_key(instance.member_id))
+
+
+@receiver(post_save, sender=WorkBookType)
+@receiver(post_delete, sender=WorkBookType)
+def invalidate_workbook_types(sender, instance, **kwargs):
+    try:
+        cache.incr(WORKBOOK_TYPES_VERSION_KEY)
+    except ValueError:
+        # version was evicted, start from one no older key can have
+        cache.set(WORKBOOK_TYPES_VERSION_KEY, int(time.time() * 1000), None)
@@ -0,0 +1,82 @@
+"""
+Sends the reads of the read-only mapi views (search, search-tc, get-visitors,
+get-workbook) to the MAPI_REPLICA_DATABASES, everything else to `default`.
+
+A member who just wrote reads from `default` for MAPI_REPLICA_STICKY_SECONDS, longer
+than the replication lag, so they see their own check-ins. Writes are noticed in
+db_for_write and remembered in CACHES, which has to be shared (memcached, redis) for
+the stickiness to hold across workers.
+"""
+import functools
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+STICKY_KEY = 'mapi:replica-sticky:%s'
+
+_local = threading.local()
+
+
+def set_current_member(member):
+    _local.member_id = member.pk if member is not None else None
+    _local.wrote = False
+    _local.sticky = None
+
+
+@receiver(request_finished)
+def clear_current_member(**kwargs):
+    _local.__dict__.clear()
+
+
+class read_only(object):
+    """
+    Context manager / decorator letting the reads inside it go to a replica
+    """
+    def __enter__(self):
+        _local.read_only = getattr(_local, 'read_only', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _local.read_only = getattr(_local, 'read_only', 1) - 1
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def is_sticky():
+    member_id = getattr(_local, 'member_id', None)
+    if member_id is None:
+        return False
+    if getattr(_local, 'wrote', False):
+        return True
+    if getattr(_local, 'sticky', None) is None:
+        _local.sticky = cache.get(STICKY_KEY % member_id) is not None
+    return _local.sticky
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'MAPI_REPLICA_DATABASES', ())
+        if not replicas or not getattr(_local, 'read_only', 0) or is_sticky():
+            return 'default'
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        member_id = getattr(_local, 'member_id', None)
+        # assigning a foreign key asks with the related object as instance, that is no write
+        is_write = isinstance(hints.get('instance'), model) or 'instance' not in hints
+        if is_write and member_id is not None and not getattr(_local, 'wrote', False):
+            _local.wrote = True
+            cache.set(STICKY_KEY % member_id, 1, getattr(settings, 'MAPI_REPLICA_STICKY_SECONDS', 10))
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as default
+        return True
@@ -0,0 +1,63 @@
+"""
+Visitor field metadata, worked out once instead of on every request.
+
+The Visitor field list is read from Visitor._meta when the app is ready.
+Each WorkBookType's mandatory_fields string is parsed on first use into a
+frozen WorkBookTypeFields, dropped again when the WorkBookType is saved.
+"""
+from collections import namedtuple
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from visitorManagement.mapi.models import Visitor, WorkBookType
+from visitorManagement.mapi.utils import compile_visitor_formatter
+
+# field_list: mandatory_fields as the client sent them, needed_fields: the Visitor fields among them,
+# format_row: compile_visitor_formatter of needed_fields
+WorkBookTypeFields = namedtuple('WorkBookTypeFields', 'mandatory_fields field_list needed_fields format_row')
+
+_visitor_field_names = None
+_search_formatter = None
+_workbook_type_fields = {}
+
+
+def load():
+    global _visitor_field_names, _search_formatter
+    _visitor_field_names = tuple(Visitor.object.get_all_field_names())
+    _search_formatter = None
+    _workbook_type_fields.clear()
+
+
+def visitor_field_names():
+    if _visitor_field_names is None:
+        load()
+    return _visitor_field_names
+
+
+def search_formatter():
+    """
+    Formatter for all the Visitor fields, as used by SearchView
+    """
+    global _search_formatter
+    if _search_formatter is None:
+        _search_formatter = compile_visitor_formatter(list(visitor_field_names()))
+    return _search_formatter
+
+
+def workbook_type_fields(workbook_type):
+    entry = _workbook_type_fields.get(workbook_type.pk)
+    # comparing the raw string also catches a save made by another process
+    if entry is None or entry.mandatory_fields != workbook_type.mandatory_fields:
+        field_list = tuple(workbook_type.mandatory_fields.split(',')) if workbook_type.mandatory_fields else ()
+        needed_fields = set(visitor_field_names()).intersection(field_list)
+        entry = WorkBookTypeFields(workbook_type.mandatory_fields, field_list, frozenset(needed_fields),
+                                   compile_visitor_formatter(needed_fields))
+        _workbook_type_fields[workbook_type.pk] = entry
+    return entry
+
+
+@receiver(post_save, sender=WorkBookType)
+@receiver(post_delete, sender=WorkBookType)
+def invalidate_workbook_type_fields(sender, instance, **kwargs):
+    _workbook_type_fields.pop(instance.pk, None)
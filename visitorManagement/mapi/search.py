@@ -0,0 +1,327 @@
+"""
+Search backends used by SearchView for the name, mobile_no and vehicle_no terms.
+
+The backend is picked with the MAPI_SEARCH_BACKEND setting (dotted path):
+
+    OrmSearchBackend        LIKE '%name%' / equality straight on the Visitor table
+    TrigramSearchBackend    in-process trigram index per member, built lazily
+    SqliteFtsSearchBackend  SQLite FTS5 shadow table (trigram tokenizer) at MAPI_SEARCH_INDEX_PATH
+
+The index backends match visitor ids and narrow the queryset to them, keeping
+the MAPI_SEARCH_MAX_RESULTS most recent: the ids are bound as query
+parameters, SQLite takes at most 999 of them.
+
+TrigramSearchBackend only hears of the writes of its own process and
+SqliteFtsSearchBackend keeps its index in a file of the local host: use them on
+a single process, single host server. OrmSearchBackend is the default.
+
+Indexes are kept in sync through the Visitor post_save / post_delete signals
+once the write commits. An index update that fails is logged and dropped, the
+visit is stored already; `python manage.py rebuild_search_index` fills the
+index from scratch.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from visitorManagement.mapi.models import Visitor
+from visitorManagement.mapi.utils import ExpiringLRUCache
+
+SEARCH_FIELDS = ('name', 'mobile_no', 'vehicle_no')
+
+
+def normalize_term(field_name, value):
+    if not value:
+        return u''
+    if field_name == 'name':
+        return Visitor.normalize_name(value)
+    # mobile and vehicle numbers are matched on their digits and letters only
+    return re.sub(r'[\W_]+', u'', value.lower(), flags=re.UNICODE)
+
+
+def trigrams(value, padded=True):
+    if padded:
+        value = u' %s ' % value
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+def similarity(term, value):
+    """
+    Share of the term's trigrams found in value
+    """
+    term_trigrams = trigrams(term)
+    return len(term_trigrams & trigrams(value)) / float(len(term_trigrams))
+
+
+def fuzzy_threshold():
+    return getattr(settings, 'MAPI_SEARCH_FUZZY_THRESHOLD', 0.5)
+
+
+def filter_ids(queryset, visitor_ids):
+    """
+    queryset narrowed to the MAPI_SEARCH_MAX_RESULTS highest, most recent, of visitor_ids
+    """
+    max_results = getattr(settings, 'MAPI_SEARCH_MAX_RESULTS', 500)
+    return queryset.filter(id__in=sorted(visitor_ids, reverse=True)[:max_results])
+
+
+class BaseSearchBackend(object):
+    """
+    Narrows a member's Visitor queryset down to the visitors matching terms,
+    a dict of field name -> search text for the SEARCH_FIELDS
+    """
+    def filter(self, queryset, member, terms, fuzzy=False):
+        raise NotImplementedError
+
+    def index_visitor(self, visitor):
+        pass
+
+    def index_visitors(self, visitors):
+        for visitor in visitors:
+            self.index_visitor(visitor)
+
+    def remove_visitor(self, visitor_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class OrmSearchBackend(BaseSearchBackend):
+    def filter(self, queryset, member, terms, fuzzy=False):
+        if terms.get('name'):
+            queryset = queryset.filter(name__contains=terms['name'])
+        for field_name in ('mobile_no', 'vehicle_no'):
+            if terms.get(field_name):
+                queryset = queryset.filter(**{field_name: terms[field_name]})
+        return queryset
+
+
+class TrigramSearchBackend(BaseSearchBackend):
+    """
+    Keeps trigram -> visitor ids postings per field for the most recently searched members
+    """
+    def __init__(self):
+        self.members = ExpiringLRUCache(max_size=getattr(settings, 'MAPI_SEARCH_TRIGRAM_MEMBERS', 64),
+                                        ttl=getattr(settings, 'MAPI_SEARCH_TRIGRAM_TTL', 3600))
+        self.lock = threading.Lock()
+
+    def filter(self, queryset, member, terms, fuzzy=False):
+        index = self.members.get(member.pk)
+        if index is None:
+            index = MemberTrigramIndex(Visitor.object.filter(member=member).values_list('id', *SEARCH_FIELDS))
+            self.members.set(member.pk, index)
+        with self.lock:
+            visitor_ids = index.search(terms, fuzzy)
+        return filter_ids(queryset, visitor_ids)
+
+    def index_visitor(self, visitor):
+        index = self.members.get(visitor.member_id)
+        if index is not None:
+            with self.lock:
+                index.add(visitor.id, *[getattr(visitor, field_name) for field_name in SEARCH_FIELDS])
+
+    def remove_visitor(self, visitor_id):
+        with self.lock:
+            for index in self.members.values():
+                index.remove(visitor_id)
+
+    def rebuild(self):
+        self.members.clear()
+
+
+class MemberTrigramIndex(object):
+    def __init__(self, rows=()):
+        self.values = {}
+        self.postings = dict((field_name, {}) for field_name in SEARCH_FIELDS)
+        for row in rows:
+            self.add(*row)
+
+    def add(self, visitor_id, *values):
+        self.remove(visitor_id)
+        normalized = tuple(normalize_term(field_name, value) for field_name, value in zip(SEARCH_FIELDS, values))
+        self.values[visitor_id] = normalized
+        for field_name, value in zip(SEARCH_FIELDS, normalized):
+            for trigram in trigrams(value) if value else ():
+                self.postings[field_name].setdefault(trigram, set()).add(visitor_id)
+
+    def remove(self, visitor_id):
+        normalized = self.values.pop(visitor_id, None)
+        if normalized is None:
+            return
+        for field_name, value in zip(SEARCH_FIELDS, normalized):
+            for trigram in trigrams(value) if value else ():
+                self.postings[field_name].get(trigram, set()).discard(visitor_id)
+
+    def search(self, terms, fuzzy=False):
+        visitor_ids = None
+        for position, field_name in enumerate(SEARCH_FIELDS):
+            term = normalize_term(field_name, terms.get(field_name))
+            if not term:
+                continue
+            if fuzzy:
+                term_trigrams = trigrams(term)
+                counts = Counter()
+                for trigram in term_trigrams:
+                    counts.update(self.postings[field_name].get(trigram, ()))
+                needed = fuzzy_threshold() * len(term_trigrams)
+                matches = set(visitor_id for visitor_id, count in counts.items() if count >= needed)
+            else:
+                candidates = None
+                for trigram in trigrams(term, padded=False):
+                    posting = self.postings[field_name].get(trigram, set())
+                    candidates = posting.copy() if candidates is None else candidates & posting
+                if candidates is None:
+                    candidates = self.values
+                matches = set(visitor_id for visitor_id in candidates if term in self.values[visitor_id][position])
+            visitor_ids = matches if visitor_ids is None else visitor_ids & matches
+        return visitor_ids if visitor_ids is not None else set(self.values)
+
+
+class SqliteFtsSearchBackend(BaseSearchBackend):
+    """
+    FTS5 table with the trigram tokenizer (SQLite >= 3.34) in its own database file, so
+    it works next to any main database. Until the index has been built once with
+    rebuild_search_index searches are answered by OrmSearchBackend.
+    """
+    FUZZY_CANDIDATES = 500
+
+    def __init__(self):
+        self.path = getattr(settings, 'MAPI_SEARCH_INDEX_PATH',
+                            os.path.join(settings.BASE_DIR, 'search_index.sqlite3'))
+        self.local = threading.local()
+        self.fallback = OrmSearchBackend()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS visitor_fts
+                    USING fts5(name, mobile_no, vehicle_no, tokenize='trigram');
+                CREATE TABLE IF NOT EXISTS visitor_owner (id INTEGER PRIMARY KEY, member_id INTEGER);
+                CREATE INDEX IF NOT EXISTS visitor_owner_member ON visitor_owner (member_id);
+                CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+            self.local.connection = connection
+        return connection
+
+    def is_built(self):
+        return self.connection.execute("SELECT 1 FROM search_meta WHERE key = 'built'").fetchone() is not None
+
+    def filter(self, queryset, member, terms, fuzzy=False):
+        if not self.is_built():
+            logging.warning('Search index at %s is not built, run rebuild_search_index' % self.path)
+            return self.fallback.filter(queryset, member, terms, fuzzy)
+
+        visitor_ids = None
+        for position, field_name in enumerate(SEARCH_FIELDS):
+            term = normalize_term(field_name, terms.get(field_name))
+            if not term:
+                continue
+            if len(term) < 3:
+                # shorter than a trigram, the FTS index can't help here
+                queryset = self.fallback.filter(queryset, member, {field_name: terms[field_name]})
+                continue
+            matches = self.match(member, field_name, position, term, fuzzy)
+            visitor_ids = matches if visitor_ids is None else visitor_ids & matches
+        if visitor_ids is None:
+            return queryset
+        return filter_ids(queryset, visitor_ids)
+
+    def match(self, member, field_name, position, term, fuzzy):
+        if fuzzy:
+            query = ' OR '.join('"%s"' % trigram.replace('"', '""') for trigram in trigrams(term, padded=False))
+        else:
+            query = '"%s"' % term.replace('"', '""')
+        rows = self.connection.execute(
+            'SELECT f.rowid, f.%s FROM visitor_fts f CROSS JOIN visitor_owner o ON o.id = f.rowid '
+            'WHERE visitor_fts MATCH ? AND o.member_id = ? ORDER BY f.rank LIMIT ?' % field_name,
+            ('%s : (%s)' % (field_name, query), member.pk, self.FUZZY_CANDIDATES if fuzzy else -1))
+        if not fuzzy:
+            return set(row[0] for row in rows)
+        needed = fuzzy_threshold()
+        return set(row[0] for row in rows if similarity(term, row[1]) >= needed)
+
+    def index_visitor(self, visitor):
+        self.index_visitors([visitor])
+
+    def index_visitors(self, visitors):
+        with self.connection as connection:
+            for visitor in visitors:
+                self._write(connection, visitor.id, visitor.member_id,
+                            [getattr(visitor, field_name) for field_name in SEARCH_FIELDS])
+
+    def _write(self, connection, visitor_id, member_id, values):
+        connection.execute('DELETE FROM visitor_fts WHERE rowid = ?', (visitor_id,))
+        connection.execute('INSERT INTO visitor_fts (rowid, name, mobile_no, vehicle_no) VALUES (?, ?, ?, ?)',
+                           [visitor_id] + [normalize_term(field_name, value)
+                                           for field_name, value in zip(SEARCH_FIELDS, values)])
+        connection.execute('INSERT OR REPLACE INTO visitor_owner (id, member_id) VALUES (?, ?)',
+                           (visitor_id, member_id))
+
+    def remove_visitor(self, visitor_id):
+        with self.connection as connection:
+            connection.execute('DELETE FROM visitor_fts WHERE rowid = ?', (visitor_id,))
+            connection.execute('DELETE FROM visitor_owner WHERE id = ?', (visitor_id,))
+
+    def rebuild(self):
+        with self.connection as connection:
+            connection.execute('DELETE FROM visitor_fts')
+            connection.execute('DELETE FROM visitor_owner')
+            connection.execute("DELETE FROM search_meta WHERE key = 'built'")
+            rows = Visitor.object.order_by().values_list('id', 'member_id', *SEARCH_FIELDS).iterator()
+            for row in rows:
+                self._write(connection, row[0], row[1], row[2:])
+            connection.execute("INSERT INTO search_meta (key, value) VALUES ('built', '1')")
+
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        backend_path = getattr(settings, 'MAPI_SEARCH_BACKEND', 'visitorManagement.mapi.search.OrmSearchBackend')
+        _backend = import_string(backend_path)()
+    return _backend
+
+
+def update_index(method_name, *args):
+    """
+    Calls the backend method, logging instead of raising: it runs in on_commit,
+    after the visitor was committed, an error would fail a request that stored it
+    """
+    try:
+        getattr(get_search_backend(), method_name)(*args)
+    except Exception:
+        logging.exception('Search index %s failed, run rebuild_search_index', method_name)
+
+
+@receiver(post_save, sender=Visitor)
+def index_saved_visitor(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: update_index('index_visitor', instance))
+
+
+def index_bulk_inserted_visitors(visitors):
+    """
+    bulk_create sends no post_save, bulk inserts index their visitors through this
+    """
+    transaction.on_commit(lambda: update_index('index_visitors', visitors))
+
+
+@receiver(post_delete, sender=Visitor)
+def remove_deleted_visitor(sender, instance, **kwargs):
+    visitor_id = instance.id
+    transaction.on_commit(lambda: update_index('remove_visitor', visitor_id))
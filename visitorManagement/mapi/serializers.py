@@ -0,0 +1,41 @@
+"""
+JSON encoding of the mapi responses.
+
+The stdlib encoder with compact separators: the responses parse to the same
+JSON as the json.dumps ones did, without the spaces after ',' and ':', so
+their bytes differ. Datetimes that reach the encoder are written as ISO 8601.
+Visitor in_time / out_time keep their 'hh:mm AM' format, format_visitor_data
+renders them through clock_time.
+"""
+import datetime
+import json
+from decimal import Decimal
+
+# 'hh:mm AM' of every minute of the day, as strftime('%I:%M %p') writes it
+CLOCK_TIMES = tuple(datetime.time(minute // 60, minute % 60).strftime('%I:%M %p') for minute in range(24 * 60))
+
+
+def clock_time(value):
+    return CLOCK_TIMES[value.hour * 60 + value.minute] if value is not None else value
+
+
+def default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+_compact_encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+
+
+def json_dumps(obj):
+    return _compact_encoder.encode(obj)
+
+
+def dumps(obj):
+    """
+    Serialised obj as a byte string
+    """
+    return json_dumps(obj)
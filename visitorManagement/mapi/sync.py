@@ -0,0 +1,110 @@
+"""
+Change feed of a workbook's visitors for the sync endpoint.
+
+Every write to a Visitor takes the next number of its workbook's change_seq
+(VisitorManager.allocate_change_seqs), deletes leave a VisitorTombstone with
+one. A client keeps the workbook's change_seq it was last sent as its token and
+asks for what has a higher number, an index range on (workbook, change_seq);
+a poll with nothing new stops at the WorkBook row.
+
+`python manage.py prune_sync_tombstones` (daily) drops the tombstones older
+than MAPI_SYNC_TOMBSTONE_DAYS and raises the workbook's min_sync_seq past them.
+A client whose token is below it may have missed a deletion, it is sent the
+full set again with reset set and drops what it had. Visits moved to the
+archive leave no tombstone: only closed visits are archived, and clients that
+mirror the open visits dropped them when they closed.
+"""
+import datetime
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from visitorManagement.mapi.models import Visitor, VisitorTombstone, WorkBook
+
+# rows: Visitor values() to upsert, deleted: ids to drop, token: change_seq to ask from next,
+# more: another page is waiting, reset: rows are the full set, drop everything else
+Changes = namedtuple('Changes', 'rows deleted token more reset')
+
+_local = threading.local()
+
+
+def workbook_changes(workbook, since=None, limit=500, open_only=True):
+    """
+    Visitors of workbook changed after the change_seq since, None for all of them.
+    With open_only the client mirrors the open visits, closed ones are sent as deleted.
+    A since below workbook.min_sync_seq gets all of them, as a reset.
+    """
+    reset = since is not None and since < workbook.min_sync_seq
+    if reset:
+        since = None
+    visitors = Visitor.object.filter(workbook=workbook).order_by('change_seq', 'id')
+    if since is not None:
+        visitors = visitors.filter(change_seq__gt=since)
+    elif open_only:
+        visitors = visitors.filter(status=Visitor.OPEN)
+    visitors = visitors.values()
+
+    rows = list(visitors[:limit])
+    more = len(rows) == limit
+    if more:
+        # updates share a change_seq across their rows, a page never ends inside one, nor below
+        # min_sync_seq as the next page's token would be answered with a reset
+        last = rows[-1]
+        token = max(last['change_seq'], workbook.min_sync_seq)
+        rows.extend(visitors.filter(Q(change_seq=last['change_seq'], id__gt=last['id']) |
+                                    Q(change_seq__gt=last['change_seq'], change_seq__lte=token)))
+        more = visitors.filter(change_seq__gt=token).exists()
+    if not more:
+        token = workbook.change_seq
+
+    deleted = []
+    if since is not None:
+        deleted.extend(VisitorTombstone.objects.filter(workbook=workbook, change_seq__gt=since, change_seq__lte=token)
+                       .order_by('change_seq').values_list('visitor_id', flat=True))
+    if open_only:
+        deleted.extend(row['id'] for row in rows if row['status'] != Visitor.OPEN)
+        rows = [row for row in rows if row['status'] == Visitor.OPEN]
+    return Changes(rows, deleted, max(token, since or 0), more, reset)
+
+
+def prune_tombstones(now=None):
+    """
+    Deletes the tombstones older than MAPI_SYNC_TOMBSTONE_DAYS, raising the min_sync_seq
+    of their workbooks past them. Returns the number of tombstones deleted.
+    """
+    cutoff = (now or timezone.now()) - datetime.timedelta(days=getattr(settings, 'MAPI_SYNC_TOMBSTONE_DAYS', 30))
+    pruned = 0
+    for workbook_id, change_seq in (VisitorTombstone.objects.filter(deleted__lt=cutoff).order_by()
+                                    .values_list('workbook_id').annotate(Max('change_seq'))):
+        with transaction.atomic():
+            WorkBook.objects.filter(id=workbook_id, min_sync_seq__lt=change_seq).update(min_sync_seq=change_seq)
+            pruned += VisitorTombstone.objects.filter(workbook_id=workbook_id, change_seq__lte=change_seq).delete()[0]
+    return pruned
+
+
+class skip_closed_tombstones(object):
+    """
+    Context manager deleting closed visits without tombstones nor change_seqs, for archive_visitors
+    """
+    def __enter__(self):
+        _local.skip_closed = getattr(_local, 'skip_closed', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _local.skip_closed -= 1
+
+
+@receiver(post_delete, sender=Visitor)
+def record_tombstone(sender, instance, **kwargs):
+    if getattr(_local, 'skip_closed', 0) and instance.status == Visitor.CLOSED:
+        return
+    using = kwargs.get('using') or instance._state.db
+    with transaction.atomic(using=using):
+        change_seq = Visitor.object.allocate_change_seqs(instance.workbook_id, using=using)
+        VisitorTombstone.objects.using(using).create(workbook_id=instance.workbook_id, visitor_id=instance.id,
+                                                     change_seq=change_seq)
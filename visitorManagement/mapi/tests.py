@@ -5,6 +5,9 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from io import BytesIO
+from unittest import skipUnless
+from django.conf import settings
 from django.test import TestCase
 
 
@@ -14,3 +17,1214 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ConnectionHealthCheckTest(TestCase):
+    def test_idle_broken_connection_is_replaced(self):
+        from visitorManagement.mapi import db
+
+        class FakeConnection(object):
+            def __init__(self, last_used, usable):
+                self.connection = object()
+                self.mapi_last_used = last_used
+                self.usable = usable
+                self.pinged = False
+
+            def is_usable(self):
+                self.pinged = True
+                return self.usable
+
+            def close(self):
+                self.connection = None
+
+        class FakeConnections(object):
+            def all(self):
+                return fake_connections
+
+        fake_connections = [FakeConnection(0, False), FakeConnection(0, True), FakeConnection(10 ** 10, False)]
+        original, db.connections = db.connections, FakeConnections()
+        try:
+            db.check_idle_connections()
+        finally:
+            db.connections = original
+        self.assertEqual([(connection.pinged, connection.connection is None) for connection in fake_connections],
+                         [(True, True), (True, False), (False, False)])
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        from visitorManagement.mapi.models import Member
+        from visitorManagement.mapi.request_handler import verified_token_cache, revoked_tokens
+        verified_token_cache.clear()
+        revoked_tokens.clear()
+        self.member = Member.objects.create(email='gate@example.com', password='secret', name='Gate',
+                                            mobile_no='9999999999', address='Gate 1', package='basic')
+
+    def test_verified_token_is_cached(self):
+        from visitorManagement.mapi.request_handler import make_token, verify_token, get_token_cache_stats
+        token = make_token(self.member)
+        self.assertEqual(verify_token(token), self.member)
+        with self.assertNumQueries(0):
+            self.assertEqual(verify_token(token), self.member)
+        self.assertEqual(get_token_cache_stats()['hits'], 1)
+
+    def test_other_process_member_change_reaches_cache(self):
+        from django.db.models import F
+        from visitorManagement.mapi.models import Member
+        from visitorManagement.mapi.request_handler import make_token, verify_token, revoked_tokens
+        token = make_token(self.member)
+        self.assertEqual(verify_token(token), self.member)
+        # a logout everywhere handled by another worker, which logs the member in CACHES once committed
+        Member.objects.filter(pk=self.member.pk).update(token_generation=F('token_generation') + 1)
+        revoked_tokens.append(('member', self.member.pk), 60)
+        self.assertEqual(verify_token(token), self.member)
+        revoked_tokens.synced_at = 0  # MAPI_TOKEN_REVOCATION_REFRESH passed
+        self.assertIsNone(verify_token(token))
+
+    def test_explicit_lifetime_is_kept(self):
+        import time
+        from visitorManagement.mapi.request_handler import make_token, verify_token
+        token = make_token(self.member, lifetime=0)
+        self.assertLessEqual(int(token.split('.')[3]), time.time())
+        self.assertIsNone(verify_token(token))
+
+    def test_password_change_invalidates_token(self):
+        from visitorManagement.mapi.request_handler import make_token, verify_token
+        token = make_token(self.member)
+        self.assertEqual(verify_token(token), self.member)
+        self.member.password = 'changed'
+        self.member.save()
+        self.assertIsNone(verify_token(token))
+
+    def test_deactivated_member_is_rejected(self):
+        from visitorManagement.mapi.request_handler import make_token, verify_token
+        token = make_token(self.member)
+        self.assertEqual(verify_token(token), self.member)
+        self.member.is_active = False
+        self.member.save()
+        self.assertIsNone(verify_token(token))
+
+    def test_expired_and_tampered_tokens_are_rejected(self):
+        from visitorManagement.mapi.request_handler import make_token, verify_token
+        self.assertIsNone(verify_token(make_token(self.member, lifetime=-1)))
+        fields = make_token(self.member).split('.')
+        fields[1] = '2'
+        self.assertIsNone(verify_token('.'.join(fields)))
+
+    def test_legacy_tokens_until_cutoff(self):
+        import time
+        from visitorManagement.mapi.request_handler import make_legacy_token, verify_token
+        token = make_legacy_token(self.member)
+        with self.settings(MAPI_LEGACY_TOKENS_UNTIL=time.time() + 60):
+            self.assertEqual(verify_token(token), self.member)
+        with self.settings(MAPI_LEGACY_TOKENS_UNTIL=time.time() - 60):
+            self.assertIsNone(verify_token(token))
+
+
+class MapiTestCase(TestCase):
+    """
+    Logged in member with a single workbook
+    """
+    mandatory_fields = 'name,mobile_no,in_time,out_time'
+
+    def setUp(self):
+        from visitorManagement.mapi.models import Member, WorkBookType, WorkBook
+        from visitorManagement.mapi.request_handler import make_token, verified_token_cache, revoked_tokens
+        verified_token_cache.clear()
+        revoked_tokens.clear()
+        self.member = Member.objects.create(email='desk@example.com', password='secret', name='Desk',
+                                            mobile_no='9999999999', address='Gate 1', package='basic')
+        self.workbook_type = WorkBookType.objects.create(type='Default', mandatory_fields=self.mandatory_fields)
+        self.workbook = WorkBook.objects.create(wb_name='Main gate', wb_type=self.workbook_type, member=self.member)
+        self.client.cookies['AUTH_TOKEN'] = make_token(self.member)
+
+    def api_get(self, endpoint, params=None):
+        import json
+        return json.loads(self.client.get('/mapi/v1.0.0/%s/' % endpoint, params or {}, secure=True).content)
+
+    def api_post(self, endpoint, data):
+        import json
+        return json.loads(self.client.post('/mapi/v1.0.0/%s/' % endpoint, data, secure=True).content)
+
+    def create_visitors(self, count, **kwargs):
+        import datetime
+        from visitorManagement.mapi.models import Visitor
+        now = datetime.datetime.now()
+        return [Visitor.object.create(member=self.member, workbook=self.workbook, name='Visitor %s' % i,
+                                      mobile_no='98%08d' % i,
+                                      in_time=kwargs.get('in_time', now - datetime.timedelta(minutes=i)),
+                                      out_time=kwargs.get('out_time', now + datetime.timedelta(hours=1)))
+                for i in range(count)]
+
+
+class VisitorPaginationTest(MapiTestCase):
+    def test_keyset_pages_cover_all_visitors(self):
+        self.create_visitors(5)
+        names, after = [], ''
+        while True:
+            response = self.api_get('get-visitors', {'wb_id': self.workbook.id, 'limit': 2, 'after': after})
+            self.assertEqual(response['status'], 0)
+            names.extend(visitor['name'] for visitor in response['response']['visitors'])
+            after = response['response']['next']
+            if not after:
+                break
+        self.assertEqual(names, ['Visitor %s' % i for i in reversed(range(5))])
+
+    def test_invalid_cursor(self):
+        response = self.api_get('get-visitors', {'wb_id': self.workbook.id, 'after': 'garbage'})
+        self.assertEqual(response['status'], 108)
+
+    def test_stream_matches_full_response(self):
+        import json
+        self.create_visitors(3)
+        full = self.api_get('get-visitors', {'wb_id': self.workbook.id})
+        streamed = self.client.get('/mapi/v1.0.0/get-visitors/', {'wb_id': self.workbook.id, 'stream': 1},
+                                   secure=True)
+        streamed = json.loads(''.join(streamed.streaming_content))
+        self.assertEqual(sorted(streamed['response']), sorted(full['response']))
+
+
+class VisitorFormatterTest(TestCase):
+    def test_output_matches_row_by_row_version(self):
+        import itertools
+        from visitorManagement.mapi.benchmarks import legacy_format_visitor_data, make_visitor_rows
+        from visitorManagement.mapi.models import Visitor
+        from visitorManagement.mapi.utils import format_visitor_data
+        visitors = make_visitor_rows(4)
+        field_names = Visitor.object.get_all_field_names()
+        for size in (1, 3, 5, len(field_names)):
+            for fields in itertools.combinations(field_names, size):
+                for needed_fields in (set(fields), list(fields)):
+                    rows = format_visitor_data(visitors, needed_fields)
+                    self.assertEqual(rows, legacy_format_visitor_data(visitors, needed_fields))
+                    self.assertEqual([list(row) for row in rows], [sorted(fields)] * len(visitors))
+
+    def test_keys_in_field_name_order(self):
+        from visitorManagement.mapi.benchmarks import make_visitor_rows
+        from visitorManagement.mapi.serializers import dumps
+        from visitorManagement.mapi.utils import format_visitor_data
+        row, = format_visitor_data(make_visitor_rows(1), set(['vehicle_no', 'name', 'mobile_no']))
+        self.assertEqual(dumps(row), '{"mobile_no":"9800000000","name":"Visitor 0","vehicle_no":"KA01AB0000"}')
+
+    def test_empty_field_set(self):
+        from visitorManagement.mapi.benchmarks import make_visitor_rows
+        from visitorManagement.mapi.utils import format_visitor_data
+        self.assertEqual(format_visitor_data(make_visitor_rows(2), set()), [])
+
+
+class QueryPlanTest(MapiTestCase):
+    """
+    Fails when one of the hot visitor queries stops using an index
+    """
+    def explain(self, queryset):
+        from django.db import connection
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, queryset, *columns):
+        from django.db import connection
+        plan = self.explain(queryset)
+        if connection.vendor == 'sqlite':
+            visitor_steps = [step for step in plan if 'mapi_visitor' in step]
+            self.assertTrue(visitor_steps, plan)
+            for step in visitor_steps:
+                self.assertTrue(step.startswith('SEARCH') and 'INDEX' in step, plan)
+                for column in columns:
+                    self.assertIn(column, step)
+        else:
+            for step in plan:
+                self.assertNotEqual(step['type'], 'ALL', plan)
+                self.assertTrue(step['key'], plan)
+
+    def test_active_visitors(self):
+        from visitorManagement.mapi.models import Visitor
+        self.assertUsesIndex(Visitor.object.get_all_active_visitor(self.workbook), 'workbook_id', 'status')
+
+    def test_search_by_mobile_and_vehicle(self):
+        from visitorManagement.mapi.models import Visitor
+        self.assertUsesIndex(Visitor.object.filter(member=self.member, mobile_no='9800000000'),
+                             'member_id', 'mobile_no')
+        self.assertUsesIndex(Visitor.object.filter(member=self.member, vehicle_no='KA01AB0001',
+                                                   name__contains='Visitor'),
+                             'member_id', 'vehicle_no')
+
+    def test_autocomplete(self):
+        from visitorManagement.mapi.models import Visitor
+        self.assertUsesIndex(Visitor.object.autocomplete(self.member, 'ra'), 'member_id', 'name_key')
+
+
+class LogoutTest(MapiTestCase):
+    def test_logout_revokes_only_this_token(self):
+        from visitorManagement.mapi.request_handler import make_token, verify_token
+        other_device = make_token(self.member)
+        self.assertEqual(self.api_post('logout', {})['status'], 0)
+        self.assertEqual(self.client.get('/mapi/v1.0.0/get-workbook/', secure=True).status_code, 401)
+        self.assertEqual(verify_token(other_device), self.member)
+
+    def test_logout_everywhere(self):
+        from visitorManagement.mapi.request_handler import make_token, verify_token
+        other_device = make_token(self.member)
+        self.assertEqual(self.api_post('logout', {'everywhere': 1})['status'], 0)
+        self.assertIsNone(verify_token(other_device))
+
+
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from visitorManagement.mapi.routers import clear_current_member
+        cache.clear()
+        self.addCleanup(clear_current_member)
+
+    def test_reads_in_read_only_views_go_to_replica_until_member_writes(self):
+        from visitorManagement.mapi.models import Member, Visitor
+        from visitorManagement.mapi.routers import ReplicaRouter, read_only, set_current_member, \
+            clear_current_member
+        router = ReplicaRouter()
+        with self.settings(MAPI_REPLICA_DATABASES=('replica',)):
+            set_current_member(Member(pk=1))
+            self.assertEqual(router.db_for_read(Visitor), 'default')
+            with read_only():
+                self.assertEqual(router.db_for_read(Visitor), 'replica')
+                self.assertEqual(router.db_for_write(Visitor, instance=Member(pk=1)), 'default')  # a foreign key
+                self.assertEqual(router.db_for_read(Visitor), 'replica')
+                self.assertEqual(router.db_for_write(Visitor), 'default')
+                self.assertEqual(router.db_for_read(Visitor), 'default')
+
+            # the next request of the member still reads its writes, other members don't care
+            clear_current_member()
+            set_current_member(Member(pk=1))
+            with read_only():
+                self.assertEqual(router.db_for_read(Visitor), 'default')
+            set_current_member(Member(pk=2))
+            with read_only():
+                self.assertEqual(router.db_for_read(Visitor), 'replica')
+
+
+@skipUnless('replica' in settings.DATABASES, "needs a 'replica' alias in DATABASES, e.g. a second SQLite file")
+class ReplicaDatabaseTest(MapiTestCase):
+    multi_db = True
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        super(ReplicaDatabaseTest, self).setUp()
+
+    def test_listing_reads_replica_and_own_writes_read_default(self):
+        import datetime
+        import json
+        from visitorManagement.mapi.models import Visitor
+        for instance in (self.member, self.workbook_type, self.workbook):
+            instance.save(using='replica')
+        Visitor.object.db_manager('replica').create(member=self.member, workbook=self.workbook, name='On replica',
+                                                    in_time=datetime.datetime(2026, 10, 18, 9, 0),
+                                                    out_time=datetime.datetime(2099, 10, 18, 9, 0))
+
+        with self.settings(MAPI_REPLICA_DATABASES=('replica',)):
+            visitors = self.api_get('get-visitors', {'wb_id': self.workbook.id})['response']
+            self.assertEqual([visitor['name'] for visitor in visitors], ['On replica'])
+
+            self.api_post('create-visitor', {'params': json.dumps({'wb_id': self.workbook.id, 'name': 'Written',
+                                                                   'mobile_no': '1', 'in_time': '20261018 10:00:00',
+                                                                   'out_time': '20991018 10:00:00'})})
+            visitors = self.api_get('get-visitors', {'wb_id': self.workbook.id})['response']
+            self.assertEqual([visitor['name'] for visitor in visitors], ['Written'])
+
+
+class CheckOutTest(MapiTestCase):
+    def test_check_out_closes_visit_once(self):
+        from visitorManagement.mapi.models import Visitor
+        first, second = self.create_visitors(2)
+        response = self.api_post('check-out', {'visitor_id': first.id, 'out_time': '20261018 18:30:00'})
+        self.assertEqual(response['status'], 0)
+        visitor = Visitor.object.get(id=first.id)
+        self.assertEqual((visitor.status, visitor.out_time.hour), (Visitor.CLOSED, 18))
+
+        self.assertEqual(self.api_post('check-out', {'visitor_id': first.id})['status'], 108)
+        self.assertEqual(self.api_post('check-out', {'visitor_id': 999})['status'], 102)
+        active = self.api_get('get-visitors', {'wb_id': self.workbook.id})['response']
+        self.assertEqual([row['name'] for row in active], [second.name])
+
+    def test_past_and_expired_visits_are_closed(self):
+        import datetime
+        from visitorManagement.mapi.models import Visitor
+        past, = self.create_visitors(1, out_time=datetime.datetime.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(past.status, Visitor.CLOSED)
+        current, = self.create_visitors(1)
+        self.assertEqual(Visitor.object.close_expired(now=current.out_time + datetime.timedelta(seconds=1)), 1)
+        self.assertFalse(Visitor.object.get_all_active_visitor(self.workbook).exists())
+
+    def test_open_visits_are_active_whatever_their_out_time(self):
+        import datetime
+        from visitorManagement.mapi.models import Visitor
+        now = datetime.datetime.now()
+        current, = self.create_visitors(1)
+        without_out_time, = self.create_visitors(1, out_time=None)
+        overstayed, = self.create_visitors(1, out_time=now + datetime.timedelta(seconds=1))
+        Visitor.object.filter(id=overstayed.id).update(out_time=now - datetime.timedelta(minutes=1))
+        checked_out, = self.create_visitors(1)
+        self.assertTrue(Visitor.object.check_out(checked_out.id, self.member))
+        self.assertEqual(sorted(row['id'] for row in Visitor.object.get_all_active_visitor(self.workbook)),
+                         [current.id, without_out_time.id, overstayed.id])
+
+
+class SyncTest(MapiTestCase):
+    def test_bulk_insert_reads_back_ids_by_change_seq(self):
+        from visitorManagement.mapi.models import Visitor, WorkBook
+        other = WorkBook.objects.create(wb_name='Back gate', wb_type=self.workbook_type, member=self.member)
+        self.create_visitors(1)  # a visit saved before, ids and change_seqs don't line up
+        visitors = [Visitor(member=self.member, workbook=(self.workbook, other)[i % 2], name='Bulk %s' % i)
+                    for i in range(6)]
+        Visitor.object.bulk_insert(visitors)
+        self.assertEqual([Visitor.object.get(id=visitor.id).name for visitor in visitors],
+                         [visitor.name for visitor in visitors])
+
+    def test_sync_sends_changes_and_deletions_since_token(self):
+        from visitorManagement.mapi.models import Visitor
+        first, second, third = self.create_visitors(3)
+        initial = self.api_get('sync', {'wb_id': self.workbook.id})['response']
+        self.assertEqual(initial['fields'], ['id', 'in_time', 'mobile_no', 'name', 'out_time'])
+        self.assertEqual([row[0] for row in initial['rows']], [first.id, second.id, third.id])
+        self.assertEqual(initial['token'], '3')
+
+        Visitor.object.check_out(first.id, self.member)
+        deleted_id = second.id
+        second.delete()
+        fourth, = self.create_visitors(1)
+        changes = self.api_get('sync', {'wb_id': self.workbook.id, 'token': initial['token']})['response']
+        self.assertEqual([row[0] for row in changes['rows']], [fourth.id])
+        self.assertEqual(sorted(changes['deleted']), sorted([first.id, deleted_id]))
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            unchanged = self.api_get('sync', {'wb_id': self.workbook.id, 'token': changes['token']})['response']
+        self.assertEqual((unchanged['rows'], unchanged['deleted']), ([], []))
+        self.assertEqual([query['sql'] for query in queries if 'mapi_visitor' in query['sql']], [])
+
+    def test_pages_do_not_split_a_change(self):
+        import datetime
+        from visitorManagement.mapi.models import Visitor
+        from visitorManagement.mapi.sync import workbook_changes
+        visitors = self.create_visitors(3)
+        self.assertEqual(Visitor.object.close_expired(now=datetime.datetime.now() + datetime.timedelta(days=1)), 3)
+        self.workbook.refresh_from_db()
+        changes = workbook_changes(self.workbook, since=3, limit=1)
+        self.assertEqual((sorted(changes.deleted), changes.token, changes.more),
+                         (sorted(visitor.id for visitor in visitors), 4, False))
+        self.workbook.wb_name = 'Renamed'
+        self.workbook.save()
+        self.workbook.refresh_from_db()
+        self.assertEqual(self.workbook.change_seq, 4)
+
+    def test_pruned_tombstones_force_a_reset(self):
+        import datetime
+        from visitorManagement.mapi.models import VisitorTombstone
+        from visitorManagement.mapi.sync import prune_tombstones, workbook_changes
+        first, second, third, fourth = self.create_visitors(4)
+        second.delete()
+        VisitorTombstone.objects.update(deleted=datetime.datetime.now() - datetime.timedelta(days=31))
+        self.create_visitors(1)[0].delete()
+        self.assertEqual(prune_tombstones(), 1)
+        self.workbook.refresh_from_db()
+        self.assertEqual((self.workbook.min_sync_seq, self.workbook.change_seq), (5, 7))
+
+        changes = self.api_get('sync', {'wb_id': self.workbook.id, 'token': '3'})['response']
+        self.assertTrue(changes['reset'])
+        self.assertEqual([row[0] for row in changes['rows']], [first.id, third.id, fourth.id])
+        self.assertEqual((changes['deleted'], changes['token']), ([], '7'))
+        self.assertFalse(self.api_get('sync', {'wb_id': self.workbook.id, 'token': '5'})['response']['reset'])
+        # a page never hands out a token below min_sync_seq
+        page = workbook_changes(self.workbook, since=None, limit=1)
+        self.assertEqual(([row['id'] for row in page.rows], page.token, page.more),
+                         ([first.id, third.id, fourth.id], 7, False))
+
+    def test_archived_visits_leave_no_tombstone(self):
+        import datetime
+        import shutil
+        import tempfile
+        from visitorManagement.mapi.archive import archive_visitors
+        from visitorManagement.mapi.models import VisitorTombstone
+        old = datetime.datetime(2026, 1, 5, 9, 0)
+        self.create_visitors(2, in_time=old, out_time=old)
+        self.workbook.refresh_from_db()
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        with self.settings(MAPI_ARCHIVE_ROOT=archive_root):
+            self.assertEqual(archive_visitors(now=datetime.datetime(2026, 10, 18)), 2)
+        change_seq = self.workbook.change_seq
+        self.workbook.refresh_from_db()
+        self.assertEqual((VisitorTombstone.objects.count(), self.workbook.change_seq), (0, change_seq))
+
+
+def close_response(response):
+    """
+    response.close() as the WSGI server calls it, without closing the test's connections
+    """
+    from django.core.signals import request_finished
+    from django.db import close_old_connections
+    request_finished.disconnect(close_old_connections)
+    try:
+        response.close()
+    finally:
+        request_finished.connect(close_old_connections)
+
+
+class PushTest(MapiTestCase):
+    def test_hub_wakes_waiters_of_the_workbook(self):
+        import threading
+        from django.test import override_settings
+        from visitorManagement.mapi.push import Hub
+        hub = Hub()
+        with override_settings(MAPI_PUSH_TICK=0.01):
+            threading.Timer(0.05, hub.publish, (self.workbook.id, 7)).start()
+            self.assertEqual(hub.wait(self.workbook.id, 5, timeout=5), 7)
+            self.assertIsNone(hub.wait(self.workbook.id, 7, timeout=0.05))
+            self.assertIsNone(hub.wait(self.workbook.id + 1, 0, timeout=0.05))
+        self.assertEqual(hub.waiters(), 0)
+
+    def test_event_stream_sends_changes_since_last_event_id(self):
+        import json
+        from django.test import override_settings
+        first, second = self.create_visitors(2)
+        with override_settings(MAPI_PUSH_STREAM_SECONDS=0):
+            response = self.client.get('/mapi/v1.0.0/visitor-events/', {'wb_id': self.workbook.id},
+                                       HTTP_LAST_EVENT_ID='1', secure=True)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            retry, event = ''.join(response.streaming_content).strip().split('\n\n')
+            close_response(response)
+        self.assertEqual(event.split('\n')[:2], ['id: 2', 'event: visitors'])
+        self.assertEqual([row[0] for row in json.loads(event.split('\n')[2][len('data: '):])['rows']], [second.id])
+
+    def test_event_streams_above_the_cap_get_503(self):
+        from django.test import override_settings
+        from visitorManagement.mapi.push import stream_slots
+        self.create_visitors(1)
+        with override_settings(MAPI_PUSH_STREAM_SECONDS=0, MAPI_PUSH_MAX_STREAMS=1):
+            first = self.client.get('/mapi/v1.0.0/visitor-events/', {'wb_id': self.workbook.id}, secure=True)
+            second = self.client.get('/mapi/v1.0.0/visitor-events/', {'wb_id': self.workbook.id}, secure=True)
+            self.assertEqual((first.status_code, second.status_code), (200, 503))
+            self.assertEqual(stream_slots.open, 1)
+            close_response(first)  # never iterated, still gives its slot back
+            self.assertEqual(stream_slots.open, 0)
+            third = self.client.get('/mapi/v1.0.0/visitor-events/', {'wb_id': self.workbook.id}, secure=True)
+            self.assertEqual(third.status_code, 200)
+            close_response(third)
+
+    def test_long_poll_returns_empty_after_wait(self):
+        from django.test import override_settings
+        self.create_visitors(1)
+        with override_settings(MAPI_PUSH_TICK=0.01, MAPI_PUSH_RECHECK_SECONDS=None):
+            response = self.api_get('sync', {'wb_id': self.workbook.id, 'token': '1', 'wait': '0.05'})['response']
+        self.assertEqual((response['token'], response['rows']), ('1', []))
+
+
+class AnalyticsTest(MapiTestCase):
+    def test_counters_follow_inserts_and_answer_ranges(self):
+        import datetime
+        from visitorManagement.mapi.models import Visitor, VisitCounter
+        monday = datetime.datetime(2026, 10, 12, 9, 15)
+        self.create_visitors(1, in_time=monday, out_time=monday)
+        self.create_visitors(2, in_time=monday + datetime.timedelta(minutes=30), out_time=monday)
+        Visitor.object.bulk_insert([Visitor(member=self.member, workbook=self.workbook, name='Late',
+                                            in_time=monday + datetime.timedelta(days=7, hours=9))])
+        self.assertEqual(list(VisitCounter.objects.order_by('day', 'hour').values_list('day', 'hour', 'visits')),
+                         [(monday.date(), 9, 3), (datetime.date(2026, 10, 19), 18, 1)])
+
+        with self.assertNumQueries(3):  # token member, workbooks, counters
+            response = self.api_get('analytics', {'from': '11-10-2026', 'to': '19-10-2026', 'group': 'week'})
+        self.assertEqual(response['response']['workbooks'],
+                         [{'wb_id': str(self.workbook.id), 'wb_name': 'Main gate', 'total': 4,
+                           'series': [['05-10-2026', 0], ['12-10-2026', 3], ['19-10-2026', 1]]}])
+        by_hour = self.api_get('analytics', {'from': '12-10-2026', 'to': '12-10-2026', 'group': 'hour',
+                                             'wb_id': self.workbook.id})['response']['workbooks'][0]['series']
+        self.assertEqual([hour for hour, visits in by_hour if visits], [9])
+        self.assertEqual(self.api_get('analytics', {'from': '12-10-2026', 'to': '11-10-2026'})['status'], 108)
+
+    def test_backfill_recounts_hot_and_archived_visits(self):
+        import datetime
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        from visitorManagement.mapi.analytics import backfill, visit_counts
+        from visitorManagement.mapi.archive import archive_visitors
+        from visitorManagement.mapi.models import VisitCounter
+        day = datetime.datetime(2026, 6, 3, 11, 0)
+        self.create_visitors(2, in_time=day, out_time=day)
+        self.create_visitors(1, in_time=datetime.datetime(2026, 10, 1, 8, 0), out_time=day)
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        with override_settings(MAPI_ARCHIVE_ROOT=archive_root, MAPI_ARCHIVE_AFTER_DAYS=30):
+            archive_visitors(now=datetime.datetime(2026, 10, 18))
+            VisitCounter.objects.all().delete()
+            self.assertEqual(backfill(datetime.date(2026, 6, 1), datetime.date(2026, 10, 31)), 3)
+        counts = visit_counts([self.workbook.id], datetime.date(2026, 6, 3), datetime.date(2026, 6, 3))
+        self.assertEqual(counts, {self.workbook.id: [(datetime.date(2026, 6, 3), 2)]})
+
+
+class ExportTest(MapiTestCase):
+    def test_export_reads_archive_and_table_in_batches(self):
+        import datetime
+        import json
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        from visitorManagement.mapi.archive import archive_visitors
+        from visitorManagement.mapi.export import export_visitors
+        from visitorManagement.mapi.models import Visitor
+        old = datetime.datetime(2026, 5, 4, 10, 0)
+        self.create_visitors(3, in_time=old, out_time=old)
+        Visitor.object.create(member=self.member, workbook=self.workbook, name=u'Zo\xeb', photo='uploads/z.webp',
+                              in_time=datetime.datetime(2026, 10, 1, 9, 0))
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        with override_settings(MAPI_ARCHIVE_ROOT=archive_root, MAPI_ARCHIVE_AFTER_DAYS=30):
+            archive_visitors(now=datetime.datetime(2026, 10, 18))
+            chunks = list(export_visitors('jsonl', batch_size=2, member=self.member))
+            self.assertEqual(len(chunks), 3)
+            rows = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+            self.assertEqual([row['name'] for row in rows], ['Visitor 0', 'Visitor 1', 'Visitor 2', u'Zo\xeb'])
+            self.assertTrue(rows[-1]['photo'].endswith('/uploads/z.webp'))
+
+            response = self.client.get('/mapi/v1.0.0/export/', {'from': '01-10-2026', 'to': '31-10-2026'},
+                                       secure=True)
+            self.assertEqual(response['Content-Type'], 'text/csv')
+            lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'workbook_id', 'name'])
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Zo\xc3\xab,', lines[1])
+        self.assertIn(',2026-10-01 09:00:00,', lines[1])
+
+    def test_unknown_format_is_rejected(self):
+        response = self.api_get('export', {'format': 'xlsx'})
+        self.assertEqual(response['status'], 108)
+
+
+class ImportTest(MapiTestCase):
+    REGISTER = ('\xef\xbb\xbfName,Mobile No,Vehicle No,In Time,Out Time,Remarks\r\n'
+                'Asha,9800000001,KA01,2019-03-04 09:00:00,2019-03-04 10:30:00,ok\r\n'
+                'Ravi,9800000002,,04-03-2019 11:00,04-03-2019 11:45,\r\n'
+                ',9800000003,,2019-03-04 12:00:00,2019-03-04 12:30:00,no name\r\n'
+                '\r\n'
+                'Zo\xc3\xab,9800000004,,20190305 09:00:00,20190305 09:20:00,\r\n'
+                'Meena,9800000005,,yesterday,2019-03-05 10:00:00,\r\n'
+                'Kiran,9800000006,,2019-03-05 11:00:00,2019-03-05 11:10:00,\r\n')
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        super(ImportTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = self.settings(MAPI_IMPORT_ROOT=self.root, MAPI_IMPORT_BACKGROUND=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_register(self, name='register.csv'):
+        import os
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as register:
+            register.write(self.REGISTER)
+        return path
+
+    def test_command_imports_valid_rows_and_resumes(self):
+        import datetime
+        import json
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from visitorManagement.mapi import importer
+        from visitorManagement.mapi.models import Visitor, VisitorImport, VisitCounter
+        path = self.write_register()
+
+        class Crash(IOError):
+            pass
+
+        def crash(job):
+            raise Crash()
+        job = importer.prepare_import(self.member, self.workbook, path, 'register.csv', importer.file_checksum(path))
+        self.assertTrue(importer.run_import(job, batch_size=3, progress=crash))
+        # the first batch is committed, its checkpoint with it
+        self.assertEqual((job.status, job.rows_done, job.inserted, job.rejected), (VisitorImport.FAILED, 3, 2, 1))
+
+        output = StringIO()
+        call_command('import_visitors', path, '--workbook=%s' % self.workbook.id, '--batch-size=3', stdout=output)
+        self.assertIn('Resuming import %s after row 4' % job.id, output.getvalue())
+        self.assertIn('Imported 4 visits from 7 rows', output.getvalue())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.inserted, job.rejected), (VisitorImport.DONE, 4, 2))
+        self.assertEqual(json.loads(job.errors), [{'row': 4, 'message': 'Missing mandatory field name'},
+                                                  {'row': 7, 'message': 'Unknown date format yesterday'}])
+
+        visitors = list(Visitor.object.filter(workbook=self.workbook).order_by('id'))
+        self.assertEqual([visitor.name for visitor in visitors], ['Asha', 'Ravi', u'Zo\xeb', 'Kiran'])
+        self.assertEqual(visitors[1].in_time, datetime.datetime(2019, 3, 4, 11, 0))
+        self.assertEqual(set(visitor.status for visitor in visitors), set([Visitor.CLOSED]))
+        self.assertEqual(len(set(visitor.change_seq for visitor in visitors)), 4)
+        self.assertEqual(VisitCounter.objects.get(workbook=self.workbook, day=datetime.date(2019, 3, 5),
+                                                  hour=9).visits, 1)
+
+        output = StringIO()
+        call_command('import_visitors', path, '--workbook=%s' % self.workbook.id, stdout=output)
+        self.assertIn('imported already', output.getvalue())
+        self.assertEqual(Visitor.object.filter(workbook=self.workbook).count(), 4)
+
+    def test_rows_are_imported_closed(self):
+        from visitorManagement.mapi import importer
+        from visitorManagement.mapi.models import Visitor, VisitorImport
+        job = VisitorImport(member=self.member, workbook=self.workbook)
+        visitor = importer.build_visitor(job, ['Asha', '2019-03-04 09:00:00'], {'name': 0, 'in_time': 1}, set(),
+                                         list(importer.DATETIME_FORMATS))
+        self.assertEqual((visitor.out_time, visitor.status), (None, Visitor.CLOSED))
+
+    def test_missing_mandatory_column_fails_the_import(self):
+        from visitorManagement.mapi import importer
+        from visitorManagement.mapi.models import VisitorImport
+        self.REGISTER = 'Name,In Time,Out Time\r\nAsha,2019-03-04 09:00:00,2019-03-04 10:30:00\r\n'
+        path = self.write_register()
+        job = importer.prepare_import(self.member, self.workbook, path, 'register.csv', importer.file_checksum(path))
+        importer.run_import(job)
+        self.assertEqual((job.status, job.message, job.rows_done), (VisitorImport.FAILED, 'Missing column mobile_no', 0))
+
+    def test_upload_endpoint(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from visitorManagement.mapi.models import Visitor
+        register = SimpleUploadedFile('gate-2019.csv', self.REGISTER, content_type='text/csv')
+        response = self.api_post('import-visitors', {'wb_id': self.workbook.id, 'file': register})
+        self.assertEqual(response['status'], 0)
+        job = response['response']
+        self.assertEqual((job['status'], job['inserted'], job['rejected']), ('done', 4, 2))
+
+        progress = self.api_get('import-visitors', {'job_id': job['job_id']})['response']
+        self.assertEqual(progress['rows_done'], 7)
+        register.seek(0)
+        again = self.api_post('import-visitors', {'wb_id': self.workbook.id, 'file': register})['response']
+        self.assertEqual(again['job_id'], job['job_id'])
+        self.assertEqual(Visitor.object.filter(workbook=self.workbook).count(), 4)
+
+        register = SimpleUploadedFile('gate.txt', self.REGISTER)
+        response = self.api_post('import-visitors', {'wb_id': self.workbook.id, 'file': register})
+        self.assertEqual(response['status'], 108)
+
+
+class SearchTermTest(MapiTestCase):
+    def test_autocomplete_is_case_and_space_insensitive(self):
+        from visitorManagement.mapi.models import Visitor
+        for name in ['Ravi Kumar', 'Ravi Kumar', 'ravi  Shankar', 'Ramesh', 'Ravindra']:
+            Visitor.object.create(member=self.member, workbook=self.workbook, name=name)
+        with self.assertNumQueries(1):
+            names = list(Visitor.object.autocomplete(self.member, 'RAVI ', limit=5))
+        # the trailing space ends the word, Ravindra isn't a match
+        self.assertEqual(names, [('Ravi Kumar', self.workbook.id), ('ravi  Shankar', self.workbook.id)])
+        names = list(Visitor.object.autocomplete(self.member, 'ravi', limit=5))
+        self.assertEqual([name for name, workbook_id in names], ['Ravi Kumar', 'ravi  Shankar', 'Ravindra'])
+
+    def test_search_tc_endpoint(self):
+        self.create_visitors(7)
+        response = self.api_get('search-tc', {'name': 'visitor'})
+        self.assertEqual(len(response['response']), 5)
+        self.assertEqual(response['response'][0], {'wb_id': str(self.workbook.id), 'name': 'Visitor 0'})
+
+
+class SearchBackendTest(MapiTestCase):
+    def setUp(self):
+        super(SearchBackendTest, self).setUp()
+        from visitorManagement.mapi.models import Visitor
+        self.ravi = Visitor.object.create(member=self.member, workbook=self.workbook, name='Ravi Kumar',
+                                          mobile_no='98450 12345', vehicle_no='KA-01-AB-1234')
+        self.anita = Visitor.object.create(member=self.member, workbook=self.workbook, name='Anita Sharma',
+                                           mobile_no='9900011111', vehicle_no='MH 12 XY 9876')
+
+    def search(self, backend, fuzzy=False, **terms):
+        from visitorManagement.mapi.models import Visitor
+        return list(backend.filter(Visitor.object.filter(member=self.member), self.member, terms, fuzzy=fuzzy))
+
+    def check_backend(self, backend):
+        self.assertEqual(self.search(backend, name='kumar'), [self.ravi])
+        self.assertEqual(self.search(backend, vehicle_no='ka01ab'), [self.ravi])
+        self.assertEqual(self.search(backend, mobile_no='9900011'), [self.anita])
+        self.assertEqual(self.search(backend, name='sharma', mobile_no='984'), [])
+        self.assertEqual(self.search(backend, name='Anitha Sarma', fuzzy=True), [self.anita])
+        self.assertEqual(self.search(backend, vehicle_no='MH12XY9867', fuzzy=True), [self.anita])
+
+    def test_trigram_backend(self):
+        from visitorManagement.mapi.search import TrigramSearchBackend
+        self.check_backend(TrigramSearchBackend())
+
+    def test_sqlite_fts_backend(self):
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        from visitorManagement.mapi.search import SqliteFtsSearchBackend
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        with override_settings(MAPI_SEARCH_INDEX_PATH=index_dir + '/index.sqlite3'):
+            backend = SqliteFtsSearchBackend()
+        self.assertEqual(self.search(backend, name='Kumar'), [self.ravi])  # not built, answered by the ORM
+        backend.rebuild()
+        self.check_backend(backend)
+        backend.remove_visitor(self.ravi.id)
+        self.assertEqual(self.search(backend, name='kumar'), [])
+
+    def test_index_backends_keep_most_recent_matches(self):
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        from visitorManagement.mapi.models import Visitor
+        from visitorManagement.mapi.search import SqliteFtsSearchBackend, TrigramSearchBackend
+        Visitor.object.bulk_insert([Visitor(member=self.member, workbook=self.workbook, name='Ravi %s' % i)
+                                    for i in range(1200)])
+        newest = list(Visitor.object.filter(name__startswith='Ravi').order_by('-id').values_list('id', flat=True))
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        with override_settings(MAPI_SEARCH_INDEX_PATH=index_dir + '/index.sqlite3'):
+            fts_backend = SqliteFtsSearchBackend()
+        fts_backend.rebuild()
+        for backend in (TrigramSearchBackend(), fts_backend):
+            # more matches than SQLite's 999 query parameters
+            found = sorted((visitor.id for visitor in self.search(backend, name='ravi')), reverse=True)
+            self.assertEqual(found, newest[:500])
+            with self.settings(MAPI_SEARCH_MAX_RESULTS=2):
+                self.assertEqual([visitor.id for visitor in self.search(backend, name='ravi')],
+                                 sorted(newest[:2]))
+
+    def test_index_failure_is_logged_not_raised(self):
+        import logging
+        from django.test import override_settings
+        from visitorManagement.mapi import search
+        records = []
+        handler = logging.Handler(level=logging.ERROR)
+        handler.emit = records.append
+        logging.getLogger().addHandler(handler)
+        self.addCleanup(logging.getLogger().removeHandler, handler)
+        self.addCleanup(setattr, search, '_backend', search._backend)
+        with override_settings(MAPI_SEARCH_BACKEND='visitorManagement.mapi.search.SqliteFtsSearchBackend',
+                               MAPI_SEARCH_INDEX_PATH='/nonexistent/dir/index.sqlite3'):
+            search._backend = None
+            search.update_index('index_visitor', self.ravi)
+        self.assertIn('rebuild_search_index', records[0].getMessage())
+
+
+class ArchiveTest(MapiTestCase):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        settings_override = override_settings(MAPI_ARCHIVE_ROOT=archive_root, MAPI_ARCHIVE_AFTER_DAYS=30)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_old_closed_visits_move_to_the_archive(self):
+        import datetime
+        from visitorManagement.mapi.archive import archive_visitors
+        from visitorManagement.mapi.models import Visitor, VisitorArchive
+        now = datetime.datetime(2026, 10, 18, 12, 0)
+        old = datetime.datetime(2026, 7, 10, 9, 30)
+        self.create_visitors(3, in_time=old, out_time=old + datetime.timedelta(hours=1))
+        self.create_visitors(1, in_time=datetime.datetime(2026, 9, 5, 9, 30),
+                             out_time=datetime.datetime(2026, 9, 5, 10, 0))  # month of the horizon stays
+        still_open = Visitor.object.create(member=self.member, workbook=self.workbook, name='Never left',
+                                           in_time=old, out_time=datetime.datetime(2099, 1, 1))
+
+        self.assertEqual(archive_visitors(now=now, batch_size=2), 3)
+        self.assertEqual(Visitor.object.filter(in_time=old).get(), still_open)
+        self.assertEqual(sum(VisitorArchive.objects.filter(month=datetime.date(2026, 7, 1))
+                             .values_list('rows', flat=True)), 3)
+        self.assertEqual(archive_visitors(now=now), 0)
+
+        recent_only = self.api_get('search', {'name': 'visitor'})['response']
+        self.assertEqual(len(recent_only), 1)
+        with_archive = self.api_get('search', {'name': 'Visitor 2', 'in_time': '01-07-2026 00:00:00'})['response']
+        self.assertEqual(with_archive, [{'name': 'Visitor 2', 'mobile_no': '9800000002', 'in_time': '09:30 AM',
+                                         'out_time': '10:30 AM', 'vehicle_no': None, 'from_place': None,
+                                         'destination_place': None, 'photo': '', 'signature': ''}])
+        before_archive = self.api_get('search', {'name': 'visitor', 'in_time': '01-07-2026 00:00:00',
+                                                 'out_time': '30-06-2026 00:00:00'})
+        self.assertEqual(before_archive['status'], 102)
+
+
+def write_statements(queries):
+    """
+    'INSERT mapi_visitor' for every write in the captured queries
+    """
+    import re
+    return [re.sub(r'^(\w+)(?: INTO| FROM)? "(\w+)".*', r'\1 \2', query['sql'], flags=re.DOTALL)
+            for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+
+
+def make_upload(name='photo.jpg', size=(640, 480), image_format='JPEG', mode='RGB'):
+    from PIL import Image
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    data = BytesIO()
+    Image.new(mode, size, (200, 120, 40)).save(data, image_format)
+    return SimpleUploadedFile(name, data.getvalue())
+
+
+class VisitorImageTest(MapiTestCase):
+    mandatory_fields = 'name,photo'
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        super(VisitorImageTest, self).setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, MAPI_IMAGE_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_visitor(self, photo):
+        import json
+        return self.api_post('create-visitor', {'params': json.dumps({'wb_id': self.workbook.id, 'name': 'Ravi'}),
+                                                'photo': photo})
+
+    def test_create_visitor_with_photo(self):
+        import os
+        from django.conf import settings
+        from visitorManagement.mapi.images import rendition_path
+        from visitorManagement.mapi.models import Visitor
+        response = self.create_visitor(make_upload())
+        self.assertEqual(response['response']['image_status'], 'ready')
+        visitor = Visitor.object.get(id=response['response']['visitor_id'])
+        self.assertTrue(visitor.photo.name.startswith('uploads/cas/'))
+        self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, visitor.photo.name)))
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'uploads/raw')), [])
+
+        status = self.api_get('visitor-image-status', {'visitor_id': visitor.id})['response']
+        self.assertEqual(status['image_status'], 'ready')
+        self.assertTrue(status['photo'].endswith(visitor.photo.name))
+        self.assertTrue(status['photo_thumb'].endswith(rendition_path(visitor.photo.name, 'thumb')))
+
+    def test_renditions_keep_aspect_ratio(self):
+        from PIL import Image
+        from visitorManagement.mapi.images import normalize_image
+        for image_format in ('WEBP', 'JPEG'):
+            renditions = normalize_image(make_upload(size=(1600, 1200)),
+                                         {'format': image_format, 'quality': 80,
+                                          'renditions': (('full', 200), ('thumb', 64))})
+            sizes = [(rendition, Image.open(BytesIO(data)).size) for rendition, data in renditions]
+            self.assertEqual(sizes, [('full', (200, 150)), ('thumb', (64, 48))])
+
+    def test_transparent_signature_as_jpeg(self):
+        from PIL import Image
+        from visitorManagement.mapi.images import normalize_image
+        signature = make_upload('signature.png', size=(300, 100), image_format='PNG', mode='RGBA')
+        rendition, data = normalize_image(signature, {'format': 'JPEG', 'quality': 80,
+                                                      'renditions': (('full', 200),)})[0]
+        self.assertEqual(Image.open(BytesIO(data)).format, 'JPEG')
+
+    def test_invalid_image_is_rejected(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        response = self.create_visitor(SimpleUploadedFile('photo.jpg', 'not an image'))
+        self.assertEqual(response['status'], 102)
+
+    def test_worker_pool_processes_raw_upload(self):
+        import os
+        from django.conf import settings
+        from visitorManagement.mapi.images import get_pool, get_image_options, process_visitor_images, \
+            store_raw_upload
+        with self.settings(MAPI_IMAGE_WORKERS=1):
+            job = store_raw_upload(make_upload(), 'photo', self.workbook.id, 1)
+            result = get_pool().apply_async(process_visitor_images,
+                                            (settings.MEDIA_ROOT, 7, [job], get_image_options())).get(30)
+        self.assertTrue(result[2])
+        self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, result[1]['photo'])))
+
+    def test_unexpected_worker_error_fails_visitor(self):
+        from django.conf import settings
+        from visitorManagement.mapi.images import get_image_options, process_visitor_images, store_raw_upload
+        job = store_raw_upload(make_upload(), 'photo', self.workbook.id, 1)
+        options = dict(get_image_options(), format='BMP')  # no extension for it, a KeyError
+        self.assertEqual(process_visitor_images(settings.MEDIA_ROOT, 7, [job], options), (7, {}, False))
+
+    def test_requeue_pending_images(self):
+        import os
+        import time
+        from django.conf import settings
+        from visitorManagement.mapi.images import requeue_pending_images, store_raw_upload
+        from visitorManagement.mapi.models import Visitor
+        visitors = []
+        for name in ('lost', 'recent', 'gone'):
+            field_name, raw_path = store_raw_upload(make_upload(), 'photo', self.workbook.id, 1)
+            visitor = Visitor(workbook=self.workbook, member=self.member, name=name, photo=raw_path)
+            visitor.image_status = Visitor.IMAGES_PENDING
+            visitor.save()
+            visitors.append(visitor)
+        old = time.time() - 3600
+        for visitor in (visitors[0], visitors[2]):
+            os.utime(os.path.join(settings.MEDIA_ROOT, visitor.photo.name), (old, old))
+        os.remove(os.path.join(settings.MEDIA_ROOT, visitors[2].photo.name))
+
+        self.assertEqual(requeue_pending_images(older_than=600), 1)
+        statuses = dict(Visitor.object.values_list('name', 'image_status'))
+        self.assertEqual(statuses, {'lost': Visitor.IMAGES_READY, 'recent': Visitor.IMAGES_PENDING,
+                                    'gone': Visitor.IMAGES_FAILED})
+        self.assertTrue(Visitor.object.get(name='lost').photo.name.startswith('uploads/cas/'))
+
+    def test_identical_uploads_share_one_file(self):
+        from visitorManagement.mapi.models import Visitor
+        first = self.create_visitor(make_upload())['response']['visitor_id']
+        second = self.create_visitor(make_upload())['response']['visitor_id']
+        self.assertEqual(Visitor.object.get(id=first).photo.name, Visitor.object.get(id=second).photo.name)
+
+    def test_failed_create_leaves_no_row_or_file(self):
+        import os
+        from django.conf import settings
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from visitorManagement.mapi import views
+        from visitorManagement.mapi.models import Visitor
+
+        def fail(visitor_id, jobs):
+            raise IOError('disk full')
+
+        original, views.submit_visitor_images = views.submit_visitor_images, fail
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.create_visitor(make_upload())
+        finally:
+            views.submit_visitor_images = original
+        # every write of the create path, rolled back: the workbook's change_seq, the visitor row
+        self.assertEqual(write_statements(queries), ['UPDATE mapi_workbook', 'INSERT mapi_visitor'])
+        self.assertEqual(response['status'], 101)
+        self.assertFalse(Visitor.object.exists())
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'uploads/raw')), [])
+
+    def test_create_path_writes(self):
+        import json
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            response = self.api_post('create-visitor', {
+                'params': json.dumps({'wb_id': self.workbook.id, 'name': 'Ravi', 'in_time': '20261018 10:00:00'}),
+                'photo': make_upload()})
+        self.assertEqual(response['status'], 0)
+        # change_seq, visitor row and the hour's counter (created by its first visit) in one transaction,
+        # then the processed images with a new change_seq
+        self.assertEqual(write_statements(queries), ['UPDATE mapi_workbook', 'INSERT mapi_visitor',
+                                                     'UPDATE mapi_visitcounter', 'INSERT mapi_visitcounter',
+                                                     'UPDATE mapi_workbook', 'UPDATE mapi_visitor'])
+
+    def test_bulk_create_visitors(self):
+        import json
+        import os
+        from django.conf import settings
+        from visitorManagement.mapi.models import Visitor
+        entries = [{'name': 'Ravi'}, {'name': 'Asha'}, {'name': 'Mohan', 'in_time': 'yesterday'},
+                   {'name': ' Ravi  Kumar'}]
+        response = self.api_post('create-visitors-bulk', {
+            'params': json.dumps({'wb_id': self.workbook.id, 'visitors': entries}),
+            'photo_0': make_upload(), 'photo_2': make_upload(), 'photo_3': make_upload(size=(50, 50))})
+        results = response['response']
+        self.assertEqual([result['status'] for result in results], [0, 102, 102, 0])
+        self.assertEqual(results[1]['message'], 'Missing field photo in request')
+
+        visitors = [Visitor.object.get(id=results[index]['visitor_id']) for index in (0, 3)]
+        self.assertEqual([visitor.name_key for visitor in visitors], ['ravi', 'ravi kumar'])
+        self.assertEqual([results[index]['image_status'] for index in (0, 3)], ['ready', 'ready'])
+        self.assertNotEqual(visitors[0].photo.name, visitors[1].photo.name)
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'uploads/raw')), [])
+
+    def test_dedupe_media_command(self):
+        import os
+        from django.conf import settings
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from visitorManagement.mapi.models import Visitor
+        photo_dir = os.path.join(settings.MEDIA_ROOT, 'uploads/member_photos')
+        os.makedirs(photo_dir)
+        for file_name in ('1_1.png', '2_1.png'):
+            with open(os.path.join(photo_dir, file_name), 'wb') as photo:
+                photo.write(make_upload(image_format='PNG').read())
+        visitors = [Visitor.object.create(member=self.member, workbook=self.workbook, name='Ravi',
+                                          photo='uploads/member_photos/%s' % file_name)
+                    for file_name in ('1_1.png', '2_1.png')]
+        output = StringIO()
+        call_command('dedupe_media', stdout=output)
+        self.assertIn('2 images scanned, 1 unique, 1 duplicates', output.getvalue())
+        paths = set(Visitor.object.get(id=visitor.id).photo.name for visitor in visitors)
+        self.assertEqual(len(paths), 1)
+        # synced desks are sent the new url
+        self.assertTrue(all(Visitor.object.get(id=visitor.id).change_seq > visitor.change_seq for visitor in visitors))
+        blob = os.path.join(settings.MEDIA_ROOT, paths.pop())
+        # archived visits still name the original files, now links to the one blob
+        for file_name in ('1_1.png', '2_1.png'):
+            self.assertTrue(os.path.samefile(os.path.join(photo_dir, file_name), blob))
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+
+        output = StringIO()
+        call_command('dedupe_media', stdout=output)
+        self.assertIn('0 images scanned', output.getvalue())
+
+
+class WorkBookResponseCacheTest(MapiTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        super(WorkBookResponseCacheTest, self).setUp()
+
+    def get(self, endpoint, **headers):
+        return self.client.get('/mapi/v1.0.0/%s/' % endpoint, secure=True, **headers)
+
+    def test_cached_with_etag(self):
+        for endpoint in ('get-workbook', 'get-workbook-type'):
+            first = self.get(endpoint)
+            with self.assertNumQueries(0):
+                second = self.get(endpoint)
+            self.assertEqual(first.content, second.content)
+            self.assertEqual(first['ETag'], second['ETag'])
+            not_modified = self.get(endpoint, HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(not_modified.status_code, 304)
+
+    def test_invalidated_on_save(self):
+        import json
+        from visitorManagement.mapi.models import WorkBook, WorkBookType
+        etag = self.get('get-workbook')['ETag']
+        WorkBook.objects.create(wb_name='Servants', wb_type=self.workbook_type, member=self.member)
+        response = self.get('get-workbook', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['response']), 2)
+
+        self.workbook_type.mandatory_fields = 'name'
+        self.workbook_type.save()
+        workbooks = json.loads(self.get('get-workbook').content)['response']
+        self.assertEqual(workbooks[0]['mandatory_fields'], ['name'])
+
+        WorkBookType.objects.create(type='Vehicles')
+        self.assertEqual(len(json.loads(self.get('get-workbook-type').content)['response']['wb_types']), 2)
+
+    def test_errors_are_not_cached(self):
+        from django.test import RequestFactory
+        from visitorManagement.mapi.response_cache import cached_response
+        from visitorManagement.mapi.utils import MapiErrorCodes
+        from visitorManagement.mapi.views import BaseMapiView
+        request = RequestFactory().get('/')
+        unavailable = BaseMapiView.render_to_response({})
+        unavailable.status_code = 503
+        # popped from the end
+        responses = [BaseMapiView.render_to_response({'wb_types': []}), unavailable,
+                     BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR, 'Try again')]
+        served = [cached_response(request, 'mapi:test', responses.pop) for attempt in range(4)]
+        # built and sent as they are until the first success, which is cached from then on
+        self.assertEqual([response.status_code for response in served], [200, 503, 200, 200])
+        self.assertEqual(['ETag' in response for response in served], [False, False, True, True])
+        self.assertEqual(responses, [])
+
+    def test_short_lived_in_a_per_process_cache(self):
+        from visitorManagement.mapi.response_cache import cache_timeout
+        # other workers don't hear of the invalidations
+        self.assertEqual(cache_timeout(), 10)
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+                                               'LOCATION': '127.0.0.1:11211'}}):
+            self.assertEqual(cache_timeout(), 24 * 3600)
+
+
+class WorkBookTypeFieldsTest(MapiTestCase):
+    def test_parsed_once_per_workbook_type(self):
+        from visitorManagement.mapi import schema
+        fields = schema.workbook_type_fields(self.workbook_type)
+        self.assertEqual(fields.field_list, ('name', 'mobile_no', 'in_time', 'out_time'))
+        self.assertEqual(fields.needed_fields, frozenset(['name', 'mobile_no', 'in_time', 'out_time']))
+        self.assertIs(schema.workbook_type_fields(self.workbook_type), fields)
+
+        self.workbook_type.mandatory_fields = 'name,vehicle_no,unknown'
+        self.workbook_type.save()
+        fields = schema.workbook_type_fields(self.workbook_type)
+        self.assertEqual(fields.needed_fields, frozenset(['name', 'vehicle_no']))
+
+    def test_get_visitors_uses_cached_fields(self):
+        from visitorManagement.mapi.models import Visitor
+        self.create_visitors(2)
+        self.api_get('get-visitors', {'wb_id': self.workbook.id})
+        original = Visitor.object.get_all_field_names
+        Visitor.object.get_all_field_names = None
+        try:
+            response = self.api_get('get-visitors', {'wb_id': self.workbook.id})
+        finally:
+            Visitor.object.get_all_field_names = original
+        self.assertEqual(sorted(response['response'][0]), ['in_time', 'mobile_no', 'name', 'out_time'])
+
+
+class MetricsTest(MapiTestCase):
+    def setUp(self):
+        from visitorManagement.mapi import metrics
+        super(MetricsTest, self).setUp()
+        metrics.registry.reset()
+
+    def test_request_metrics_exposed(self):
+        self.create_visitors(3)
+        with self.settings(MAPI_METRICS_DB_SAMPLE_RATE=1):
+            self.api_get('get-visitors', {'wb_id': self.workbook.id})
+        with self.settings(MAPI_METRICS_TOKEN='scrape'):
+            self.assertEqual(self.client.get('/mapi/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/mapi/metrics', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.splitlines()
+        self.assertIn('# TYPE mapi_request_duration_seconds histogram', lines)
+        self.assertIn('mapi_requests_total{endpoint="VisitorView.get",code="200"} 1', lines)
+        queries = [line for line in lines if line.startswith('mapi_db_queries_count{endpoint="VisitorView.get"}')]
+        self.assertEqual(queries, ['mapi_db_queries_count{endpoint="VisitorView.get"} 1'])
+        self.assertTrue(any(line.startswith('mapi_response_bytes_sum{endpoint="VisitorView.get"}')
+                            for line in lines))
+
+        # behind a proxy every request comes from 127.0.0.1, that is no credential
+        self.assertEqual(self.client.get('/mapi/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+    def test_metrics_for_staff(self):
+        from django.contrib.auth.models import User
+        from visitorManagement.mapi.views import BaseMapiView, MetricsView
+        self.assertFalse(hasattr(MetricsView, 'get_validated_json'))
+        self.assertTrue(hasattr(BaseMapiView, 'get_validated_json'))
+        self.client.force_login(User.objects.create_user('ops', password='secret', is_staff=True))
+        self.assertEqual(self.client.get('/mapi/metrics').status_code, 200)
+
+    def test_logged_response_is_bounded(self):
+        import logging
+        from visitorManagement.mapi.utils import log_response
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record.getMessage())
+        logger = logging.getLogger()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            with self.settings(MAPI_RESPONSE_LOG_SAMPLE_RATE=0, MAPI_RESPONSE_LOG_MAX_BYTES=10):
+                log_response('x' * 100)
+                log_response('y' * 100, status=102)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        self.assertEqual(records, ['yyyyyyyyyy... (100 bytes)'])
+
+
+class SerializerTest(MapiTestCase):
+    def test_compact_encoding_and_clock_times(self):
+        import datetime
+        from visitorManagement.mapi.serializers import clock_time, json_dumps
+        self.assertEqual(json_dumps({'a': [1, datetime.date(2026, 10, 18)]}), '{"a":[1,"2026-10-18"]}')
+        for hour, minute in ((0, 0), (9, 5), (12, 30), (23, 59)):
+            value = datetime.datetime(2026, 10, 18, hour, minute)
+            self.assertEqual(clock_time(value), value.strftime('%I:%M %p'))
+
+    def test_large_responses_are_compressed(self):
+        import gzip
+        import json
+        from django.core.cache import cache
+        cache.clear()
+        self.create_visitors(30)
+        response = self.client.get('/mapi/v1.0.0/get-visitors/', {'wb_id': self.workbook.id}, secure=True,
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.GzipFile(fileobj=BytesIO(response.content)).read())['response']), 30)
+
+        small = self.client.get('/mapi/v1.0.0/get-workbook/', secure=True, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(small.has_header('Content-Encoding'))
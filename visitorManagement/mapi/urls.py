@@ -1,6 +1,8 @@
 from django.conf.urls import url
 from visitorManagement.mapi.views import LoginView, VisitorView, WorkBookView, WorkBookTypeView, \
-    SearchView, SearchTermView, CreateWorkBookTypeView
+    SearchView, SearchTermView, CreateWorkBookTypeView, VisitorImageStatusView, BulkVisitorView, \
+    CheckOutView, MetricsView, LogoutView, SyncView, VisitorEventsView, AnalyticsView, ExportView, \
+    ImportVisitorsView
 
 '''
 urlpatterns = patterns('',
@@ -20,6 +22,7 @@ urlpatterns = patterns('',
 urlpatterns = [
     # Version 1.0.0 of the mobile API
     url(r'^v1.0.0/login/?$', LoginView.as_view()),
+    url(r'^v1.0.0/logout/?$', LogoutView.as_view()),
     url(r'^v1.0.0/get-workbook/?$', WorkBookView.as_view()),
     url(r'^v1.0.0/create-workbook-type/?$', CreateWorkBookTypeView.as_view()),
     url(r'^v1.0.0/get-workbook-type/?$', WorkBookTypeView.as_view()),
@@ -28,9 +31,19 @@ urlpatterns = [
     # (r'^v1.0.0/register/?$', RegistrationView.as_view()),
 
     url(r'^v1.0.0/create-visitor/?$', VisitorView.as_view()),
+    url(r'^v1.0.0/create-visitors-bulk/?$', BulkVisitorView.as_view()),
+    url(r'^v1.0.0/import-visitors/?$', ImportVisitorsView.as_view()),
     url(r'^v1.0.0/get-visitors/?$', VisitorView.as_view()),
+    url(r'^v1.0.0/check-out/?$', CheckOutView.as_view()),
+    url(r'^v1.0.0/sync/?$', SyncView.as_view()),
+    url(r'^v1.0.0/visitor-events/?$', VisitorEventsView.as_view()),
+    url(r'^v1.0.0/visitor-image-status/?$', VisitorImageStatusView.as_view()),
 
     url(r'^v1.0.0/search-tc/?$', SearchTermView.as_view()),
 
     url(r'^v1.0.0/search/?$', SearchView.as_view()),
+    url(r'^v1.0.0/analytics/?$', AnalyticsView.as_view()),
+    url(r'^v1.0.0/export/?$', ExportView.as_view()),
+
+    url(r'^metrics/?$', MetricsView.as_view()),
 ]
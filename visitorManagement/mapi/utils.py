@@ -1,12 +1,17 @@
 from django.http import HttpResponse, HttpResponseForbidden, HttpRequest, \
     HttpResponseNotAllowed
-import simplejson
 import json
 import base64
 import hmac
 import functools
 import logging
+import random
+import threading
+import time
+from collections import OrderedDict
 from django.conf import settings
+from django.db import models
+from visitorManagement.mapi.serializers import dumps, clock_time
 
 
 class MapiErrorCodeDescriptor(object):
@@ -42,7 +47,7 @@ class JSONResponse(HttpResponse):
 
         if not isinstance(content, str):
 
-            content = simplejson.dumps(content)
+            content = dumps(content)
 
         super(JSONResponse, self).__init__(
             content=content,
@@ -52,6 +57,80 @@ class JSONResponse(HttpResponse):
         )
 
 
+def log_response(content, status=0):
+    """
+    Logs the serialised response of every error and a MAPI_RESPONSE_LOG_SAMPLE_RATE share
+    of the successful ones, cut at MAPI_RESPONSE_LOG_MAX_BYTES
+    """
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    if status == 0 and random.random() >= getattr(settings, 'MAPI_RESPONSE_LOG_SAMPLE_RATE', 0.01):
+        return
+    max_bytes = getattr(settings, 'MAPI_RESPONSE_LOG_MAX_BYTES', 1024)
+    if len(content) > max_bytes:
+        content = '%s... (%s bytes)' % (content[:max_bytes], len(content))
+    logging.info(content)
+
+
+class ExpiringLRUCache(object):
+    """
+    Bounded, thread safe LRU cache whose entries expire ``ttl`` seconds after
+    they were set. Hit and miss counters are kept so callers can report how
+    effective the cache is.
+    """
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return default
+            # re-insert to mark the key as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate):
+        """
+        Drops every entry whose value matches predicate(value)
+        """
+        with self._lock:
+            for key in [k for k, entry in self._data.items() if predicate(entry[1])]:
+                del self._data[key]
+
+    def values(self):
+        now = time.time()
+        with self._lock:
+            return [entry[1] for entry in self._data.values() if entry[0] >= now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
 def base64_safe_decode(data):
     """
     EBS sometimes sends BASE64 encoded responses with incorrect padding.
@@ -102,9 +181,9 @@ def render_error_response(mapi_error_code, message=None, response=None):
 
 
 def get_visitor_all_fields():
-    from visitorManagement.mapi.models import Visitor
+    from visitorManagement.mapi.schema import visitor_field_names
     # visitor_fields = Visitor._meta.get_all_field_names() // below 1.8 django version
-    visitor_fields = Visitor.object.get_all_field_names()
+    visitor_fields = list(visitor_field_names())
 
     # remove foreign key fields
     # visitor_fields.remove('workbook')
@@ -133,24 +212,100 @@ def get_base_image_url(protocol='http'):
     return base_url
 
 
-def format_visitor_data(visitors, needed_fields):
-    from copy import deepcopy
+CURSOR_DATE_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(in_time, visitor_id):
+    """
+    Opaque keyset cursor for the (in_time, id) ordering of visitors
+    """
+    in_time_string = in_time.strftime(CURSOR_DATE_TIME_FORMAT) if in_time else '-'
+    return base64.urlsafe_b64encode('%s:%s' % (in_time_string, visitor_id))
+
+
+def decode_cursor(cursor):
+    """
+    Reverse of encode_cursor, raises ValueError on a malformed cursor
+    """
     import datetime
-    rect_dict = []
-    for visitor in visitors:
-        d = dict()
-        temp_needed_fields = deepcopy(needed_fields)
-        while temp_needed_fields:
-            field_name = temp_needed_fields.pop()
-            field_value = visitor[field_name]
-            if isinstance(field_value, datetime.datetime):
-                # field_value = field_value.replace(tzinfo=timezone.get_default_timezone())
-                field_value = field_value.strftime('%I:%M %p')  # ("%I.%M %p")
-
-            if field_name in ['photo', 'signature'] and field_value:
-                field_value = '%s%s' % (get_base_image_url(), field_value)
-
-            d.update({str(field_name): field_value})
-        if d:
-            rect_dict.append(d)
-    return rect_dict
+    try:
+        in_time_string, visitor_id = base64.urlsafe_b64decode(str(cursor)).split(':')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor %s' % cursor)
+    in_time = None
+    if in_time_string != '-':
+        in_time = datetime.datetime.strptime(in_time_string, CURSOR_DATE_TIME_FORMAT)
+    return in_time, int(visitor_id)
+
+
+class FieldOrderRow(dict):
+    """
+    dict listing its keys in field_order, which json encodes them in. Built like a
+    plain dict, an OrderedDict (pure Python on 2.7) would cost several times the formatting.
+    Only holds the keys of field_order.
+    """
+    __slots__ = ()
+    field_order = ()
+
+    def __iter__(self):
+        return iter(self.field_order)
+
+    def keys(self):
+        return list(self.field_order)
+
+    def items(self):
+        return [(key, self[key]) for key in self.field_order]
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.field_order)
+
+
+def compile_visitor_formatter(needed_fields):
+    """
+    Compiles the workbook field set once into a tuple of (key, field_name, converter)
+    and returns a function formatting a single Visitor values() row with it, as a
+    FieldOrderRow keyed in field name order so the json is the same on every run.
+    Image url prefix and datetime handling are resolved here instead of per row.
+    """
+    from visitorManagement.mapi.models import Visitor
+
+    datetime_fields = set(field.attname for field in Visitor._meta.concrete_fields
+                          if isinstance(field, models.DateTimeField))
+    image_url = get_base_image_url()
+
+    def format_image(value):
+        return '%s%s' % (image_url, value) if value else value
+
+    converters = []
+    for field_name in sorted(needed_fields):
+        converter = None
+        if field_name in datetime_fields:
+            converter = clock_time  # strftime('%I:%M %p') as a table lookup
+        elif field_name in ['photo', 'signature']:
+            converter = format_image
+        converters.append((str(field_name), field_name, converter))
+    converters = tuple(converters)
+
+    row_class = type('VisitorRow', (FieldOrderRow,),
+                     {'__slots__': (), 'field_order': tuple(key for key, field_name, converter in converters)})
+
+    def format_row(visitor):
+        return row_class(zip(row_class.field_order,
+                             [converter(visitor[field_name]) if converter else visitor[field_name]
+                              for key, field_name, converter in converters]))
+
+    format_row.converters = converters
+    return format_row
+
+
+def format_visitor_data(visitors, needed_fields):
+    return format_visitor_rows(visitors, compile_visitor_formatter(needed_fields))
+
+
+def format_visitor_rows(visitors, format_row):
+    """
+    format_visitor_data with an already compiled formatter
+    """
+    if not format_row.converters:
+        return []
+    return [format_row(visitor) for visitor in visitors]
@@ -1,19 +1,34 @@
-from django.http import HttpResponse, HttpResponseForbidden, HttpRequest, HttpResponseNotAllowed
+from django.http import HttpResponse, HttpResponseForbidden, HttpRequest, HttpResponseNotAllowed, \
+    StreamingHttpResponse
 import simplejson
 import json
 from django.views.generic import View, TemplateView
 from visitorManagement.mapi.utils import MapiErrorCodes, JSONResponse, mapi_mandatory_parameters, \
-    get_visitor_all_fields, get_base_image_url, format_visitor_data
+    get_visitor_all_fields, get_base_image_url, format_visitor_rows, encode_cursor, decode_cursor, log_response
 from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import transaction
 import logging
-from visitorManagement.mapi.models import Member, Visitor, WorkBookType, WorkBook
+from visitorManagement.mapi.models import Member, Visitor, WorkBookType, WorkBook, VisitorImport
+from visitorManagement.mapi import analytics, metrics, schema
+from visitorManagement.mapi.routers import read_only
+from visitorManagement.mapi.archive import search_archive
+from visitorManagement.mapi.sync import workbook_changes
+from visitorManagement.mapi.push import wait_for_change, shared_changes, stream_slots, SlotStream
+from visitorManagement.mapi.export import export_visitors, CONTENT_TYPES as EXPORT_CONTENT_TYPES
+from visitorManagement.mapi.importer import store_upload, prepare_import, start_import, VisitorImportError
+from visitorManagement.mapi.serializers import dumps
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from visitorManagement.mapi.request_handler import make_token, mapi_authenticate
+from visitorManagement.mapi.request_handler import make_token, mapi_authenticate, revoke_token, revoke_member_tokens
+from visitorManagement.mapi.search import get_search_backend, index_bulk_inserted_visitors, SEARCH_FIELDS
+from visitorManagement.mapi.response_cache import cached_response, workbook_cache_key, workbook_type_cache_key
+from visitorManagement.mapi.images import store_raw_upload, submit_visitor_images, rendition_path, \
+    remove_raw_uploads
 from django.shortcuts import get_list_or_404, get_object_or_404
-from PIL import Image
-import json
 import datetime
+import time
 from copy import deepcopy
 from django.utils import timezone
 DATE_TIME_FORMAT = '%Y%m%d %H:%M:%S'
@@ -32,8 +47,7 @@ class BaseMapiView(View):
                     'message': message,
                     'response': response if response else None
                     }
-        logging.info(ret_dict)
-        return JSONResponse(json.dumps(ret_dict))
+        return cls.serialize_response(ret_dict)
 
     @classmethod
     def render_error_response(cls, mapi_error_code, message=None, response=None):
@@ -41,8 +55,15 @@ class BaseMapiView(View):
                     'message': message,
                     'response': response if response else None
                     }
-        logging.info(ret_dict)
-        return JSONResponse(json.dumps(ret_dict))
+        return cls.serialize_response(ret_dict)
+
+    @classmethod
+    def serialize_response(cls, ret_dict):
+        start = time.time()
+        content = dumps(ret_dict)
+        metrics.add_serialization_time(time.time() - start)
+        log_response(content, ret_dict['status'])
+        return JSONResponse(content)
 
     def dispatch(self, request, *args, **kwargs):
         if not settings.DEBUG and not request.is_secure():
@@ -51,7 +72,12 @@ class BaseMapiView(View):
 
         self.protocol = request.is_secure() and 'https' or 'http'
         self.member = request.user
-        return super(BaseMapiView, self).dispatch(request, *args, **kwargs)
+        start = time.time()
+        try:
+            return super(BaseMapiView, self).dispatch(request, *args, **kwargs)
+        finally:
+            metrics.add_view_time(time.time() - start)
+
 
     def get_validated_json(self, request_data, key):
         try:
@@ -60,6 +86,26 @@ class BaseMapiView(View):
             return self.render_error_response(MapiErrorCodes.INVALID_FIELD, "{} is not a valid JSON object".format(key))
 
 
+class MetricsView(View):
+    """
+    Prometheus text exposition of metrics.registry, for staff logged in to the admin
+    and for scrapers sending "Authorization: Bearer <MAPI_METRICS_TOKEN>"
+    """
+    def get(self, request):
+        if not self.is_allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @staticmethod
+    def is_allowed(request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_active and user.is_staff:
+            return True
+        token = getattr(settings, 'MAPI_METRICS_TOKEN', None)
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(token) and constant_time_compare(authorization, 'Bearer %s' % token)
+
+
 class LoginView(BaseMapiView):
     def post(self, request):
 
@@ -88,6 +134,20 @@ class LoginView(BaseMapiView):
         return super(LoginView, self).dispatch(request, *args, **kwargs)
 
 
+class LogoutView(BaseMapiView):
+    def post(self, request):
+        if request.POST.get('everywhere'):
+            revoke_member_tokens(request.user)
+        else:
+            revoke_token(request.COOKIES.get('AUTH_TOKEN'))
+        return BaseMapiView.render_to_response()
+
+    @csrf_exempt
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(LogoutView, self).dispatch(request, *args, **kwargs)
+
+
 class RegistrationView(BaseMapiView):
     def post(self, request):
         email = request.POST['email']
@@ -132,15 +192,18 @@ class VisitorView(BaseMapiView):
     '''
 
     DATE_TIME_FORMAT = '%Y%m%d %H:%M:%S'
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    STREAM_CHUNK_SIZE = 500
 
+    @method_decorator(read_only())
     @method_decorator(mapi_mandatory_parameters('wb_id'))
     def get(self, request):
         member = request.user
         workbook = get_object_or_404(WorkBook, id=request.GET['wb_id'])
         workbook_type = workbook.wb_type
         #workbook_type = get_object_or_404(WorkBookType, id=request.GET['wb_id'])
-        workbook_field_options = workbook_type.mandatory_fields
-        workbook_field_options_list = workbook_field_options.split(',')
+        workbook_fields = schema.workbook_type_fields(workbook_type)
         workbook = get_object_or_404(WorkBook, member=member, wb_type=workbook_type)
         if not workbook:
             return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
@@ -148,24 +211,98 @@ class VisitorView(BaseMapiView):
 
         name = request.GET.get('name')  # this is optional field, used via search
         exclude_time = False
-        if 'in_time' not in workbook_field_options_list or 'out_time' not in workbook_field_options_list:
+        if 'in_time' not in workbook_fields.field_list or 'out_time' not in workbook_fields.field_list:
             exclude_time = True
 
+        format_row = workbook_fields.format_row
+
+        if request.GET.get('stream'):
+            visitors = Visitor.object.get_active_visitor_queryset(workbook, name=name, exclude_time=exclude_time)
+            return self.stream_visitors(visitors, format_row)
+
+        if request.GET.get('limit') or request.GET.get('after'):
+            visitors = Visitor.object.get_active_visitor_queryset(workbook, name=name, exclude_time=exclude_time)
+            return self.render_visitor_page(request, visitors, format_row)
+
         visitors = Visitor.object.get_all_active_visitor(workbook, name=name, exclude_time=exclude_time)
 
         if not visitors:
             return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
                                                       'No visitors for given workbook')
 
-        visitor_field = Visitor.object.get_all_field_names()  # get_visitor_all_fields()
-        needed_fields = set(visitor_field).intersection(workbook_field_options_list)
-        response = format_visitor_data(visitors, needed_fields)
+        response = format_visitor_rows(visitors, format_row)
         if response:
             return BaseMapiView.render_to_response(response)
         else:
             return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
                                                       'No visitors for given workbook')
 
+    def render_visitor_page(self, request, visitors, format_row):
+        """
+        Keyset pagination on (in_time, id), `after` is the `next` cursor of the previous page
+        """
+        try:
+            limit = min(int(request.GET.get('limit') or self.PAGE_SIZE), self.MAX_PAGE_SIZE)
+            after = request.GET.get('after')
+            after = decode_cursor(after) if after else None
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid limit or after in request')
+        if limit < 1:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid limit or after in request')
+
+        page = list(Visitor.object.keyset_page(visitors, after).values()[:limit + 1])
+        if not page and after is None:
+            return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                      'No visitors for given workbook')
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1]['in_time'], page[-1]['id'])
+
+        return BaseMapiView.render_to_response({'visitors': format_visitor_rows(page, format_row),
+                                                'next': next_cursor})
+
+    def stream_visitors(self, visitors, format_row):
+        """
+        Streams the same envelope as render_to_response, rows are read from a server
+        side iterator and serialised STREAM_CHUNK_SIZE at a time
+        """
+        visitors = Visitor.object.keyset_page(visitors).values()
+        if not visitors.exists():
+            return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                      'No visitors for given workbook')
+
+        def generate_chunks(batches):
+            separator = ''
+            for batch in batches:
+                rows = format_visitor_rows(batch, format_row)
+                if rows:
+                    yield separator + ','.join(dumps(row) for row in rows)
+                    separator = ','
+
+        def generate_batches():
+            batch = []
+            for visitor in visitors.iterator():
+                batch.append(visitor)
+                if len(batch) == self.STREAM_CHUNK_SIZE:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def generate():
+            yield '{"status":0,"message":"success","response":['
+            # runs after get() returned, as the response is sent
+            with read_only():
+                for chunk in generate_chunks(generate_batches()):
+                    yield chunk
+            yield ']}'
+
+        return StreamingHttpResponse(generate(), content_type='application/json')
+
     def post(self, request):
         params = request.POST.get('params')
         if not params:
@@ -179,18 +316,61 @@ class VisitorView(BaseMapiView):
 
         workbook = get_object_or_404(WorkBook, id=wb_id)
         workbook_type = workbook.wb_type
-        workbook_mandatory_fields = workbook_type.mandatory_fields
-        workbook_mandatory_fields_list = workbook_mandatory_fields.split(',')
-        visitor_field = Visitor.object.get_all_field_names()
-        needed_fields = set(visitor_field).intersection(workbook_mandatory_fields_list)
+        needed_fields = schema.workbook_type_fields(workbook_type).needed_fields
 
-        if 'photo' in needed_fields and not request.FILES.get('photo'):
-            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD,
-                                                      "Missing field photo in request")
+        images = self.get_visitor_images(request.FILES)
+        error = self.validate_visitor(params, images, needed_fields)
+        if error:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD, error)
 
-        if 'signature' in needed_fields and not request.FILES.get('signature'):
+        visitor = self.build_visitor(request.user, workbook, params)
+
+        import time
+        time_stamp = time.time()
+        try:
+            image_jobs = self.store_visitor_images(images, wb_id, time_stamp)
+        except IOError as e:
+            logging.error(e.message)
             return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD,
-                                                      "Missing field signature in request")
+                                                      'Uploaded image not in correct format')
+        # raw uploads are served until the workers replace them with the processed images
+        for field_name, raw_path in image_jobs:
+            setattr(visitor, field_name, raw_path)
+        if image_jobs:
+            visitor.image_status = Visitor.IMAGES_PENDING
+        try:
+            # the row is written once, with its images, or not at all
+            with transaction.atomic():
+                visitor.save(force_insert=True)
+                if image_jobs:
+                    visitor.image_status = submit_visitor_images(visitor.id, image_jobs)
+
+        except Exception as e:
+            logging.error(e.message)
+            remove_raw_uploads(image_jobs)
+            return BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR,
+                                                      'Unable to create visitor, Please try again later.')
+        if visitor:
+            return BaseMapiView.render_to_response({'visitor_id': str(visitor.id),
+                                                    'image_status': visitor.get_image_status_display().lower()})
+        else:
+            return BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR,
+                                                      'Unable to create visitor!')
+
+    @staticmethod
+    def get_visitor_images(files, suffix=''):
+        return dict((field_name, files.get(field_name + suffix)) for field_name in ['photo', 'signature'])
+
+    @staticmethod
+    def validate_visitor(params, images, needed_fields):
+        """
+        Returns the error message for the first create-visitor rule params breaks, None when valid
+        """
+        if 'photo' in needed_fields and not images.get('photo'):
+            return "Missing field photo in request"
+
+        if 'signature' in needed_fields and not images.get('signature'):
+            return "Missing field signature in request"
 
         for needed_field in needed_fields:
 
@@ -198,14 +378,14 @@ class VisitorView(BaseMapiView):
                 continue
 
             if not params.get(needed_field, None):
-                return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD,
-                                                          "Missing mandatory field in request")
-
-        name = params.get('name')
-        mobile_no = params.get('mobile_no')
-        vehicle_no = params.get('vehicle_no')
-        from_place = params.get('from_place')
-        destination_place = params.get('destination_place')
+                return "Missing mandatory field in request"
+        return None
+
+    @staticmethod
+    def build_visitor(member, workbook, params):
+        """
+        Unsaved Visitor for params, raises ValueError for a malformed in_time / out_time
+        """
         in_time = params.get('in_time')
         in_time_datetime = None
         if in_time:
@@ -224,88 +404,326 @@ class VisitorView(BaseMapiView):
             out_time_datetime.replace(tzinfo=None)
             #out_time_datetime = out_time_datetime.strftime("%I:%M %p")
 
-        photo = request.FILES.get('photo')
-        signature = request.FILES.get('signature')
-
-        import time
-        time_stamp = time.time()
+        return Visitor(member=member,
+                       workbook=workbook,
+                       name=params.get('name'),
+                       mobile_no=params.get('mobile_no'),
+                       vehicle_no=params.get('vehicle_no'),
+                       from_place=params.get('from_place'),
+                       destination_place=params.get('destination_place'),
+                       in_time=in_time_datetime,
+                       out_time=out_time_datetime)
+
+    @staticmethod
+    def store_visitor_images(images, wb_id, time_stamp):
+        """
+        Stores the raw uploads, returns their (field_name, raw_path) jobs. IOError for a file that is not an image
+        """
+        image_jobs = []
         try:
-            if photo:
-                photo = Image.open(photo)
-                # photo.verify()
-                (width, height) = photo.size
-                if width > 200 or height > 200:
-                    photo = photo.resize((200, 200), Image.ANTIALIAS)
-                visitor_img_path = settings.MEDIA_ROOT + '/uploads/member_photos/' + str(time_stamp) + '_' + wb_id+'.png'
-                photo.save(visitor_img_path)
+            for field_name in ['photo', 'signature']:
+                if images.get(field_name):
+                    image_jobs.append(store_raw_upload(images[field_name], field_name, wb_id, time_stamp))
+        except IOError:
+            remove_raw_uploads(image_jobs)
+            raise
+        return image_jobs
 
-            if signature:
-                signature = Image.open(signature)
-                # signature.verify()
-                (width, height) = signature.size
-                if width > 200 or height > 200:
-                    signature = signature.resize((200, 200), Image.ANTIALIAS)
-                signature_img_path = settings.MEDIA_ROOT + '/uploads/signature_photos/' + str(time_stamp) + '_' + wb_id+'.png'
-                signature.save(signature_img_path)
+    @csrf_exempt
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(VisitorView, self).dispatch(request, *args, **kwargs)
 
-        except IOError as e:
-            logging.error(e.message)
+
+class BulkVisitorView(VisitorView):
+    """
+    create-visitor for a batch of queued visitors, params is {"wb_id": .., "visitors": [{..}, ..]}
+    and the images of visitors[i] are posted as photo_<i> / signature_<i>.
+    Valid visitors are inserted in one transaction, the response has a result per visitor.
+    """
+
+    def get(self, request):
+        return HttpResponseNotAllowed(['POST'])
+
+    def post(self, request):
+        params = request.POST.get('params')
+        if not params:
             return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD,
-                                                      'Uploaded image not in correct format')
+                                                      'Missing params in request')
         try:
-            visitor = Visitor.object.create(member=request.user,
-                                            workbook=workbook,
-                                            name=name,
-                                            mobile_no=mobile_no,
-                                            vehicle_no=vehicle_no,
-                                            from_place=from_place,
-                                            destination_place=destination_place,
-                                            in_time=in_time_datetime,
-                                            out_time=out_time_datetime)
-            if photo or signature:
-                if photo:
-                    visitor.photo = 'uploads/member_photos/' + str(time_stamp) + '_' + wb_id + '.png'
-                if signature:
-                    visitor.signature = 'uploads/signature_photos/' + str(time_stamp) + '_' + wb_id + '.png'
-                visitor.save()
+            params = json.loads(params)
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid params in request')
+        wb_id = params.get('wb_id')
+        if not wb_id:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD,
+                                                      'Missing work book Id in request')
+        entries = params.get('visitors')
+        if not entries or not isinstance(entries, list):
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD,
+                                                      'Missing visitors in request')
+        max_visitors = getattr(settings, 'MAPI_BULK_MAX_VISITORS', 500)
+        if len(entries) > max_visitors:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'At most %s visitors per request' % max_visitors)
+
+        workbook = get_object_or_404(WorkBook, id=wb_id, member=request.user)
+        needed_fields = schema.workbook_type_fields(workbook.wb_type).needed_fields
 
+        time_stamp = time.time()
+        results, visitors, image_jobs = [], [], []
+        for index, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                results.append(self.item_error(index, 'Invalid visitor in request'))
+                continue
+            images = self.get_visitor_images(request.FILES, '_%s' % index)
+            error = self.validate_visitor(entry, images, needed_fields)
+            if error:
+                results.append(self.item_error(index, error))
+                continue
+            try:
+                visitor = self.build_visitor(request.user, workbook, entry)
+            except ValueError:
+                results.append(self.item_error(index, 'Invalid in_time or out_time'))
+                continue
+            try:
+                jobs = self.store_visitor_images(images, wb_id, time_stamp)
+            except IOError:
+                results.append(self.item_error(index, 'Uploaded image not in correct format'))
+                continue
+
+            # raw uploads are served until the workers replace them with the processed images
+            for field_name, raw_path in jobs:
+                setattr(visitor, field_name, raw_path)
+            if jobs:
+                visitor.image_status = Visitor.IMAGES_PENDING
+            results.append({'index': index, 'status': 0})
+            visitors.append(visitor)
+            image_jobs.append(jobs)
+
+        try:
+            with transaction.atomic():
+                Visitor.object.bulk_insert(visitors)
+                index_bulk_inserted_visitors(visitors)
+                for visitor, jobs in zip(visitors, image_jobs):
+                    if jobs:
+                        visitor.image_status = submit_visitor_images(visitor.id, jobs)
         except Exception as e:
             logging.error(e.message)
+            for jobs in image_jobs:
+                remove_raw_uploads(jobs)
             return BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR,
-                                                      'Unable to create visitor, Please try again later.')
-        if visitor:
-            return BaseMapiView.render_to_response()
-        else:
-            return BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR,
-                                                      'Unable to create visitor!')
+                                                      'Unable to create visitors, Please try again later.')
+
+        created = iter(visitors)
+        for result in results:
+            if result['status'] == 0:
+                visitor = next(created)
+                result['visitor_id'] = str(visitor.id)
+                result['image_status'] = visitor.get_image_status_display().lower()
+        return BaseMapiView.render_to_response(results)
+
+    @staticmethod
+    def item_error(index, message):
+        return {'index': index, 'status': MapiErrorCodes.INVALID_FIELD.code, 'message': message}
 
     @csrf_exempt
     @method_decorator(mapi_authenticate(optional=False))
     def dispatch(self, request, *args, **kwargs):
+        # a replay carries hundreds of images, spool each to disk as it is parsed instead of in memory
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
         return super(VisitorView, self).dispatch(request, *args, **kwargs)
 
 
+class CheckOutView(BaseMapiView):
+
+    @method_decorator(mapi_mandatory_parameters('visitor_id'))
+    def post(self, request):
+        out_time = request.POST.get('out_time')
+        try:
+            visitor_id = int(request.POST['visitor_id'])
+            out_time = datetime.datetime.strptime(out_time, DATE_TIME_FORMAT) if out_time else None
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid visitor_id or out_time in request')
+
+        if Visitor.object.check_out(visitor_id, request.user, out_time):
+            return BaseMapiView.render_to_response({'visitor_id': str(visitor_id)})
+        if Visitor.object.filter(id=visitor_id, member=request.user).exists():
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Visitor already checked out')
+        return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                  'Visitor doesn\'t exits')
+
+    @csrf_exempt
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(CheckOutView, self).dispatch(request, *args, **kwargs)
+
+
+class SyncView(BaseMapiView):
+    """
+    Visitors of a workbook changed since the client's token, see mapi/sync.py.
+    Rows are lists in the order of `fields`, `deleted` are visitor ids to drop.
+    With `wait` seconds a request with nothing new is held until something
+    changes (long-poll), see mapi/push.py.
+    """
+    PAGE_SIZE = 500
+    MAX_WAIT = 60
+
+    @method_decorator(read_only())
+    @method_decorator(mapi_mandatory_parameters('wb_id'))
+    def get(self, request):
+        try:
+            workbook, since = self.get_workbook(request)
+            wait = min(float(request.GET.get('wait') or 0), self.MAX_WAIT)
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid wb_id, token or wait in request')
+        if workbook is None:
+            return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                      'Workbook does\'t exits')
+
+        if since is not None and since >= workbook.change_seq and wait > 0:
+            change_seq = wait_for_change(workbook.id, since, wait)
+            if change_seq is not None:
+                workbook.change_seq = change_seq
+                # the desks long-polling the workbook are woken together, one of them reads the change
+                return BaseMapiView.render_to_response(shared_changes(workbook, since, self.get_changes))
+        return BaseMapiView.render_to_response(self.get_changes(workbook, since))
+
+    @staticmethod
+    def get_workbook(request):
+        """
+        The member's workbook of wb_id, and the token sent as `token` or, by an
+        EventSource reconnecting, as Last-Event-ID
+        """
+        token = request.GET.get('token') or request.META.get('HTTP_LAST_EVENT_ID')
+        workbook = WorkBook.objects.select_related('wb_type').filter(id=int(request.GET['wb_id']),
+                                                                     member=request.user).first()
+        return workbook, int(token) if token else None
+
+    def get_changes(self, workbook, since):
+        workbook_fields = schema.workbook_type_fields(workbook.wb_type)
+        fields = sorted(workbook_fields.needed_fields)
+        if since is not None and since >= workbook.change_seq:
+            return {'token': str(since), 'more': False, 'reset': False, 'fields': ['id'] + fields, 'rows': [],
+                    'deleted': []}
+
+        # same visitors as get-visitors: the open ones, all of them when the workbook has no in/out time
+        open_only = 'in_time' in workbook_fields.field_list and 'out_time' in workbook_fields.field_list
+        changes = workbook_changes(workbook, since, self.PAGE_SIZE, open_only)
+        rows = []
+        for visitor in changes.rows:
+            row = workbook_fields.format_row(visitor)
+            rows.append([visitor['id']] + [row[field_name] for field_name in fields])
+        return {'token': str(changes.token), 'more': changes.more, 'reset': changes.reset, 'fields': ['id'] + fields,
+                'rows': rows, 'deleted': changes.deleted}
+
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(SyncView, self).dispatch(request, *args, **kwargs)
+
+
+class VisitorEventsView(SyncView):
+    """
+    Server-Sent Events stream of the sync responses of a workbook: one `visitors`
+    event, with the token as its id, whenever the workbook changes. The stream
+    ends after MAPI_PUSH_STREAM_SECONDS, EventSource reconnects with Last-Event-ID.
+    """
+    HEARTBEAT_SECONDS = 15
+
+    @method_decorator(read_only())
+    @method_decorator(mapi_mandatory_parameters('wb_id'))
+    def get(self, request):
+        try:
+            workbook, since = self.get_workbook(request)
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid wb_id or token in request')
+        if workbook is None:
+            return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                      'Workbook does\'t exits')
+        if not stream_slots.acquire():
+            # each stream holds a thread, see mapi/push.py
+            response = BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR,
+                                                          'Too many event streams, long-poll sync with wait')
+            response.status_code = 503
+            response['Retry-After'] = str(self.MAX_WAIT)
+            return response
+
+        def generate():
+            token = since
+            end = time.time() + getattr(settings, 'MAPI_PUSH_STREAM_SECONDS', 300)
+            yield 'retry: 5000\n\n'
+            while True:
+                if token is None or token < workbook.change_seq:
+                    # the stream outlives get(), its reads are marked read only here
+                    with read_only():
+                        changes = shared_changes(workbook, token, self.get_changes)
+                    token = int(changes['token'])
+                    yield 'id: %s\nevent: visitors\ndata: %s\n\n' % (changes['token'], dumps(changes))
+                    if changes['more']:
+                        continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return
+                with read_only():
+                    change_seq = wait_for_change(workbook.id, token, min(remaining, self.HEARTBEAT_SECONDS))
+                if change_seq is None:
+                    yield ': keepalive\n\n'
+                else:
+                    workbook.change_seq = change_seq
+
+        response = StreamingHttpResponse(SlotStream(generate()), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx would buffer the events otherwise
+        return response
+
+
+class VisitorImageStatusView(BaseMapiView):
+
+    @method_decorator(mapi_mandatory_parameters('visitor_id'))
+    def get(self, request):
+        visitor = get_object_or_404(Visitor, id=request.GET['visitor_id'], member=request.user)
+        base_image_url = get_base_image_url()
+        response = {
+            'visitor_id': str(visitor.id),
+            'image_status': visitor.get_image_status_display().lower(),
+        }
+        for field_name in ['photo', 'signature']:
+            image = getattr(visitor, field_name)
+            response[field_name] = '%s%s' % (base_image_url, image.name) if image else None
+            response[field_name + '_thumb'] = None
+            if image and visitor.image_status == Visitor.IMAGES_READY:
+                response[field_name + '_thumb'] = '%s%s' % (base_image_url, rendition_path(image.name, 'thumb'))
+        return BaseMapiView.render_to_response(response)
+
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(VisitorImageStatusView, self).dispatch(request, *args, **kwargs)
+
+
 class WorkBookView(BaseMapiView):
+    @method_decorator(read_only())
     def get(self, request):
         member = request.user
 
-        workbooks = WorkBook.objects.filter(member=member)
-        return self.generate_workbook_response(workbooks)
+        workbooks = WorkBook.objects.filter(member=member).select_related('wb_type')
+        return cached_response(request, workbook_cache_key(member.id),
+                               lambda: self.generate_workbook_response(workbooks))
 
     def generate_workbook_response(self, workbooks):
         workbooks_list = []
+        base_image_url = get_base_image_url()
         for workbook in workbooks:
-            wb_mandatory_fields_string = workbook.wb_type.mandatory_fields
-            wb_mandatory_fields = []
-            if wb_mandatory_fields_string:
-                wb_mandatory_fields = wb_mandatory_fields_string.split(',')
-
             workbooks_list.append({
                 'wb_name': workbook.wb_name,
                 'wb_id': str(workbook.id),
-                'mandatory_fields': wb_mandatory_fields,
+                'mandatory_fields': list(schema.workbook_type_fields(workbook.wb_type).field_list),
                 'wb_img_url': ''.join(
-                    [get_base_image_url(), workbook.wb_type.wb_icon.name]) if workbook.wb_type.wb_icon.name else '',
+                    [base_image_url, workbook.wb_type.wb_icon.name]) if workbook.wb_type.wb_icon.name else '',
             })
         return BaseMapiView.render_to_response(workbooks_list)
 
@@ -365,10 +783,14 @@ class WorkBookView(BaseMapiView):
 
 class WorkBookTypeView(BaseMapiView):
     def get(self, request):
+        return cached_response(request, workbook_type_cache_key(), self.build_workbook_type_response)
+
+    @classmethod
+    def build_workbook_type_response(cls):
         workbooks_types = WorkBookType.objects.filter()
 
         if workbooks_types:
-            return self.generate_workbook_type_response(workbooks_types)
+            return cls.generate_workbook_type_response(workbooks_types)
         else:
             return BaseMapiView.render_error_response(MapiErrorCodes.GENERIC_ERROR,
                                                       'No workbook type configured, Please'
@@ -401,14 +823,155 @@ class WorkBookTypeView(BaseMapiView):
 '''
 
 
+class AnalyticsView(BaseMapiView):
+    """
+    Visits per day, week or hour of the day of the member's workbooks (or of wb_id)
+    from `from` to `to` included, dd-mm-yyyy, today by default. See mapi/analytics.py.
+    """
+    DATE_FORMAT = '%d-%m-%Y'
+    MAX_DAYS = 366
+
+    @method_decorator(read_only())
+    def get(self, request):
+        today = timezone.localtime(timezone.now()).date() if settings.USE_TZ else datetime.date.today()
+        group = request.GET.get('group') or 'day'
+        try:
+            start = datetime.datetime.strptime(request.GET['from'], self.DATE_FORMAT).date() \
+                if request.GET.get('from') else today
+            end = datetime.datetime.strptime(request.GET['to'], self.DATE_FORMAT).date() \
+                if request.GET.get('to') else today
+            workbooks = WorkBook.objects.filter(member=request.user).order_by('id')
+            if request.GET.get('wb_id'):
+                workbooks = workbooks.filter(id=int(request.GET['wb_id']))
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid wb_id, from or to in request')
+        if group not in analytics.GROUPS or not 0 <= (end - start).days < self.MAX_DAYS:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT,
+                                                      'Invalid group or date range in request')
+
+        workbooks = list(workbooks.values_list('id', 'wb_name'))
+        if not workbooks:
+            return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                      'Workbook does\'t exits')
+        counts = analytics.visit_counts([wb_id for wb_id, wb_name in workbooks], start, end, group)
+        response = []
+        for wb_id, wb_name in workbooks:
+            series = [[key if group == 'hour' else key.strftime(self.DATE_FORMAT), visits]
+                      for key, visits in counts[wb_id]]
+            response.append({'wb_id': str(wb_id), 'wb_name': wb_name, 'total': sum(visits for key, visits in series),
+                             'series': series})
+        return BaseMapiView.render_to_response({'from': start.strftime(self.DATE_FORMAT),
+                                                'to': end.strftime(self.DATE_FORMAT), 'group': group,
+                                                'workbooks': response})
+
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(AnalyticsView, self).dispatch(request, *args, **kwargs)
+
+
+class ExportView(BaseMapiView):
+    """
+    The member's visits, of wb_id only when given, with an in_time from `from` to `to`
+    included (dd-mm-yyyy, open ended by default), streamed as csv, jsonl or parquet.
+    See mapi/export.py.
+    """
+    DATE_FORMAT = '%d-%m-%Y'
+
+    def get(self, request):
+        export_format = request.GET.get('format') or 'csv'
+        try:
+            start = datetime.datetime.strptime(request.GET['from'], self.DATE_FORMAT).date() \
+                if request.GET.get('from') else None
+            end = datetime.datetime.strptime(request.GET['to'], self.DATE_FORMAT).date() \
+                if request.GET.get('to') else None
+            workbook = None
+            if request.GET.get('wb_id'):
+                workbook = WorkBook.objects.filter(id=int(request.GET['wb_id']), member=request.user).first()
+                if workbook is None:
+                    return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
+                                                              'Workbook does\'t exits')
+            chunks = export_visitors(export_format, member=request.user, workbook=workbook, start=start, end=end)
+        except ValueError as e:
+            # ExportError included
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT, str(e))
+
+        def generate():
+            # runs after get() returned, as the response is sent
+            with read_only():
+                for chunk in chunks:
+                    yield chunk
+
+        response = StreamingHttpResponse(generate(), content_type=EXPORT_CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = 'attachment; filename="visitors-%s-%s.%s"' % (
+            start.strftime('%Y%m%d') if start else 'all', end.strftime('%Y%m%d') if end else 'now', export_format)
+        return response
+
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        return super(ExportView, self).dispatch(request, *args, **kwargs)
+
+
+class ImportVisitorsView(BaseMapiView):
+    """
+    POST a csv or xlsx visitor register as `file` with wb_id to import it into the workbook,
+    GET job_id for the progress of the import. Posting the same file again resumes an
+    import that failed. See mapi/importer.py.
+    """
+
+    @method_decorator(mapi_mandatory_parameters('job_id'))
+    def get(self, request):
+        try:
+            job_id = int(request.GET['job_id'])
+        except ValueError:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT, 'Invalid job_id in request')
+        return BaseMapiView.render_to_response(self.job_response(get_object_or_404(VisitorImport, id=job_id,
+                                                                                   member=request.user)))
+
+    @method_decorator(mapi_mandatory_parameters('wb_id'))
+    def post(self, request):
+        register = request.FILES.get('file')
+        if register is None:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_FIELD, 'Missing file in request')
+        workbook = get_object_or_404(WorkBook, id=request.POST['wb_id'], member=request.user)
+        try:
+            path, checksum = store_upload(register)
+            job = prepare_import(request.user, workbook, path, register.name, checksum)
+        except VisitorImportError as e:
+            return BaseMapiView.render_error_response(MapiErrorCodes.INVALID_INPUT, str(e))
+        if job.status != VisitorImport.DONE:
+            start_import(job)
+        return BaseMapiView.render_to_response(self.job_response(job))
+
+    @staticmethod
+    def job_response(job):
+        return {'job_id': str(job.id),
+                'wb_id': str(job.workbook_id),
+                'source': job.source,
+                'status': job.get_status_display().lower(),
+                'rows_done': job.rows_done,
+                'inserted': job.inserted,
+                'rejected': job.rejected,
+                'errors': json.loads(job.errors),
+                'message': job.message,
+                'rows_per_second': job.rows_per_second}
+
+    @csrf_exempt
+    @method_decorator(mapi_authenticate(optional=False))
+    def dispatch(self, request, *args, **kwargs):
+        # registers can be large, spool them to disk as they are parsed
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return super(ImportVisitorsView, self).dispatch(request, *args, **kwargs)
+
+
 class SearchTermView(BaseMapiView):
 
+    @method_decorator(read_only())
     def get(self, request):
         member = request.user
         name = request.GET['name']
-        visitors = Visitor.object.filter(name__istartswith=name, member=member)
-        rect_dict = [{'wb_id': str(visitor.workbook.id), 'name': visitor.name}
-                     for visitor in visitors][:5]
+        rect_dict = [{'wb_id': str(wb_id), 'name': visitor_name}
+                     for visitor_name, wb_id in Visitor.object.autocomplete(member, name, limit=5)]
         return BaseMapiView.render_to_response(rect_dict)
 
     @method_decorator(mapi_mandatory_parameters('name'))
@@ -419,20 +982,15 @@ class SearchTermView(BaseMapiView):
 
 class SearchView(BaseMapiView):
 
+    @method_decorator(read_only())
     def get(self, request):
         member = request.user
 
         get_kwargs = dict()
         get_kwargs.update({'member': member})
-        name = request.GET.get('name')
-        if name:
-            get_kwargs.update({'name__contains': name})
-        mobile_no = request.GET.get('mobile_no')
-        if mobile_no:
-            get_kwargs.update({'mobile_no': mobile_no})
-        vehicle_no = request.GET.get('vehicle_no')
-        if vehicle_no:
-            get_kwargs.update({'vehicle_no': vehicle_no})
+        # name, mobile_no and vehicle_no go through the configured search backend
+        search_terms = dict((field_name, request.GET.get(field_name)) for field_name in SEARCH_FIELDS)
+        fuzzy = bool(request.GET.get('fuzzy'))
         from_place = request.GET.get('from_place')
         if from_place:
             get_kwargs.update({'from_place': from_place})
@@ -454,15 +1012,19 @@ class SearchView(BaseMapiView):
 
         # ExampleModel.objects.filter(some_datetime_field__range=[start, new_end]) //(today_min, today_max)
         visitors = Visitor.object.filter(**get_kwargs)
+        visitors = get_search_backend().filter(visitors, member, search_terms, fuzzy=fuzzy)
         if in_time_datetime:
             visitors = visitors.filter(in_time__gte=in_time_datetime)
         if out_time_datetime:
             visitors = visitors.filter(out_time__lte=out_time_datetime)
 
-        visitors = visitors.values()
+        visitors = list(visitors.values())
+        # visits older than the archive horizon are read only when in_time reaches back to them
+        exact = dict((field_name, value) for field_name, value in get_kwargs.items() if field_name != 'member')
+        visitors = search_archive(member, search_terms, fuzzy=fuzzy, in_time=in_time_datetime,
+                                  out_time=out_time_datetime, **exact) + visitors
         if visitors:
-            visitor_field = Visitor.object.get_all_field_names()
-            rect_dict = format_visitor_data(visitors, visitor_field)
+            rect_dict = format_visitor_rows(visitors, schema.search_formatter())
             return BaseMapiView.render_to_response(rect_dict)
         else:
             return BaseMapiView.render_error_response(MapiErrorCodes.NO_VISITOR_EXIT,
@@ -40,6 +40,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'visitorManagement.mapi.middleware.MapiMetricsMiddleware',
+    'visitorManagement.mapi.middleware.MapiCompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -73,6 +75,8 @@ DATABASES = {
         'PASSWORD': 'jugaljoshi',                  # Not used with sqlite3.
         'HOST': 'visitor.mysql.pythonanywhere-services.com',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '3306',                      # Set to empty string for default. Not used with sqlite3.
+        # keep the connection between requests, below the server's wait_timeout (300s on pythonanywhere)
+        'CONN_MAX_AGE': 280,
     }
 
     # 'default': {
@@ -103,6 +107,28 @@ DATABASES = {
     # }
 }
 
+# Read replicas for the read-only mapi views, aliases in DATABASES, see mapi/routers.py. For example
+#     DATABASES['replica'] = dict(DATABASES['default'], HOST='replica.mysql.example.com')
+#     MAPI_REPLICA_DATABASES = ('replica',)
+DATABASE_ROUTERS = ['visitorManagement.mapi.routers.ReplicaRouter']
+MAPI_REPLICA_DATABASES = ()
+MAPI_REPLICA_STICKY_SECONDS = 10  # a member reads from default this long after writing, keep it above the lag
+
+# Persistent connections idle for longer than this are pinged before a request uses them, None never pings
+MAPI_DB_HEALTH_CHECK_IDLE = 30
+
+# In-process connection pool shared by the threads of a worker (gunicorn --threads), needs djorm-ext-pool.
+# Connections go back to the pool at the end of every request, so CONN_MAX_AGE is left to the pool's recycle
+MAPI_DB_POOL = False
+DJORM_POOL_OPTIONS = {
+    'pool_size': 10,
+    'max_overflow': 5,
+    'recycle': 280,
+}
+if MAPI_DB_POOL:
+    INSTALLED_APPS += ('djorm_pool',)
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -120,6 +146,17 @@ TEMPLATES = [
     },
 ]
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'visitor-management',
+    }
+}
+# get-workbook / get-workbook-type responses, see mapi/response_cache.py. The per-process LocMemCache
+# keeps them briefly, other workers don't see its invalidations; a shared cache keeps them for a day.
+MAPI_RESPONSE_CACHE_LOCAL_TIMEOUT = 10
+MAPI_RESPONSE_CACHE_TIMEOUT = 24 * 3600
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -134,12 +171,66 @@ USE_L10N = True
 USE_TZ = False
 
 MOBILE_API = True
+
+# mapi auth tokens, see mapi/request_handler.py
+MAPI_TOKEN_LIFETIME = 30 * 24 * 3600
+MAPI_TOKEN_CACHE_TTL = 600  # seconds a worker keeps a member, changes reach it sooner through the revocation log
+MAPI_TOKEN_REVOCATION_REFRESH = 5  # seconds between reads of the revocation log in CACHES
+MAPI_LEGACY_TOKENS_UNTIL = 1800230400  # 2027-01-18 UTC, the old '0' tokens are rejected after it, None keeps them
 MEDIA_FROM_S3 = False
 DOMAIN_NAME = 'http://visitor.pythonanywhere.com'
 MEDIA_URL = '%s/media/' % DOMAIN_NAME  # s3 url check this when used
 MEDIA_ROOT = os.path.join(PROJECT_DIR, 'media')  # used in urls.py
 
 UPLOAD_DIR = MEDIA_URL  # Local image path
+
+# SearchView backend, see mapi/search.py. Build the index with "python manage.py rebuild_search_index"
+# TrigramSearchBackend and SqliteFtsSearchBackend are faster but for single process, single host servers only
+MAPI_SEARCH_BACKEND = 'visitorManagement.mapi.search.OrmSearchBackend'
+MAPI_SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search_index.sqlite3')
+MAPI_SEARCH_MAX_RESULTS = 500  # visitors an index backend answers with, below SQLite's 999 query parameters
+
+# visitor-events (Server-Sent Events) and sync?wait= long-polls, see mapi/push.py. Serve them from threaded
+# or gevent workers, every open stream holds a thread.
+MAPI_PUSH_TICK = 5  # seconds between deadline checks of the waiting desks
+MAPI_PUSH_RECHECK_SECONDS = 15  # catches changes made by other worker processes, None on a single process server
+MAPI_PUSH_STREAM_SECONDS = 300  # streams are closed after this, EventSource reconnects
+# each open visitor-events stream holds a server thread: serve mapi from gevent workers (gunicorn -k gevent) or
+# threaded ones. Above this many streams per process desks get a 503 and long-poll sync?wait= instead
+MAPI_PUSH_MAX_STREAMS = 16
+
+# Deletions are kept this long for the sync endpoint, "python manage.py prune_sync_tombstones" (daily) drops
+# older ones, clients that did not sync meanwhile get the full set again
+MAPI_SYNC_TOMBSTONE_DAYS = 30
+
+# Closed visits older than this move to gzip JSON lines files, see mapi/archive.py.
+# Run "python manage.py archive_visitors" daily. Keep the root out of MEDIA_ROOT, it is not public.
+MAPI_ARCHIVE_AFTER_DAYS = 180
+MAPI_ARCHIVE_ROOT = os.path.join(BASE_DIR, 'archive')
+
+# Visitor registers imported by the import-visitors endpoint and "python manage.py import_visitors",
+# see mapi/importer.py. Uploads are kept under the root so a failed import can be resumed.
+MAPI_IMPORT_ROOT = os.path.join(BASE_DIR, 'imports')
+MAPI_IMPORT_BATCH_SIZE = 1000  # rows per transaction, each one a checkpoint
+MAPI_IMPORT_BACKGROUND = True  # the endpoint imports in a thread and answers at once, False imports in the request
+MAPI_IMPORT_STALE_SECONDS = 300  # a running import silent for this long is taken over by the next attempt
+
+# Processes resizing create-visitor photo/signature uploads in the background, 0 resizes them in the request
+MAPI_IMAGE_WORKERS = 2
+MAPI_IMAGE_FORMAT = 'WEBP'  # or JPEG (progressive), JPEG is used when Pillow is built without WebP
+MAPI_IMAGE_QUALITY = 80
+MAPI_IMAGE_RENDITIONS = (('full', 200), ('thumb', 64))  # (name, max width/height), Visitor points at the first
+MAPI_IMAGE_PENDING_SECONDS = 600  # requeue_pending_images resubmits visitors pending longer, run it from cron
+
+# Request metrics at /mapi/metrics (Prometheus text), see mapi/metrics.py
+MAPI_METRICS_TOKEN = None  # scrapers send "Authorization: Bearer <token>", admin staff can read it without
+MAPI_METRICS_DB_SAMPLE_RATE = 0.01  # share of requests whose queries are counted and timed, through the debug cursor
+MAPI_RESPONSE_LOG_SAMPLE_RATE = 0.01  # share of successful responses logged, errors are always logged
+MAPI_RESPONSE_LOG_MAX_BYTES = 1024
+
+# mapi JSON responses are compressed, see mapi/middleware.py
+MAPI_COMPRESS_MIN_BYTES = 1024  # smaller responses are sent uncompressed
+MAPI_BROTLI_QUALITY = 5  # used when the brotli module is installed, gzip otherwise
 AWS_ACCESS_KEY_ID = ''
 AWS_SECRET_ACCESS_KEY = ''
 AWS_STORAGE_BUCKET_NAME = 'visitor_management'